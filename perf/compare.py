@@ -0,0 +1,81 @@
+"""
+Compares two benchmark result files written by the polybot and yolo5 perf suites.
+
+Prints every metric of every case with its relative change, and exits with status 1 when a metric got
+worse by more than the threshold: times, latencies, memory and errors should not grow, throughput should not drop.
+A cost growing from zero (e.g. errors 0 -> 50) is always a regression. Sizes of the run (`NEUTRAL`) are only
+printed.
+
+    python perf/compare.py baseline.json candidate.json --threshold 10
+"""
+import argparse
+import json
+import math
+import sys
+
+# Metrics where a bigger number is better, every other metric is a cost
+HIGHER_IS_BETTER = ('throughput', 'rps', 'hit_ratio', 'agreement', 'iou')
+# Metrics describing the size of the run rather than its performance, neither better nor worse when they change
+NEUTRAL = {'count', 'boxes'}
+
+
+def higher_is_better(metric):
+    return any(key in metric for key in HIGHER_IS_BETTER)
+
+
+def relative_change(old, new):
+    """:return: the change from `old` to `new` in percent, infinite from a zero baseline"""
+    if old == new:
+        return 0.0
+    if old == 0:
+        return math.copysign(math.inf, new)
+    return (new - old) / abs(old) * 100
+
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    for case in sorted(set(baseline['results']) | set(candidate['results'])):
+        before = baseline['results'].get(case)
+        after = candidate['results'].get(case)
+        if before is None or after is None:
+            print(f'{case}: only in {"candidate" if before is None else "baseline"}')
+            continue
+        for metric in sorted(set(before) & set(after)):
+            old, new = before[metric], after[metric]
+            if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+                continue
+            change = relative_change(old, new)
+            worse = -change if higher_is_better(metric) else change
+            flag = ''
+            if metric in NEUTRAL:
+                pass
+            elif worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((case, metric, change))
+            elif -worse > threshold:
+                flag = '  improved'
+            print(f'{case} {metric}: {old:.4g} -> {new:.4g} ({change:+.1f}%){flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed change in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline.get('suite') != candidate.get('suite'):
+        print(f'warning: comparing suite {baseline.get("suite")} with {candidate.get("suite")}')
+
+    regressions = compare(baseline, candidate, args.threshold)
+    print(f'{len(regressions)} regression(s) above {args.threshold:g}%')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
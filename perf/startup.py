@@ -0,0 +1,99 @@
+"""
+Measures how long a service takes to start: until /healthz answers (live) and until /readyz answers 200 (ready).
+
+The command is started, both probes are polled, and the per-step breakdown the service reports on /readyz is
+recorded with the totals. The service is stopped after each run.
+
+    cd yolo5 && python ../perf/startup.py --url http://localhost:8081 --runs 3 --output startup.json -- python app.py
+    cd polybot && python ../perf/startup.py --url http://localhost:8443 -- python app.py
+    python perf/compare.py startup_before.json startup.json
+"""
+import argparse
+import json
+import platform
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def probe(url):
+    """:return: (http status or None if nothing answers, JSON body or None)"""
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        try:
+            return e.code, json.load(e)
+        except ValueError:
+            return e.code, None
+    except (OSError, ValueError):
+        return None, None
+
+
+def measure(command, url, timeout, poll_interval):
+    start = time.monotonic()
+    process = subprocess.Popen(command)
+    live = ready = None
+    body = None
+    try:
+        while time.monotonic() - start < timeout:
+            if process.poll() is not None:
+                raise SystemExit(f'the service exited with status {process.returncode} before it was ready')
+            if live is None and probe(f'{url}/healthz')[0] == 200:
+                live = time.monotonic() - start
+            if live is not None:
+                status, body = probe(f'{url}/readyz')
+                if status == 200:
+                    ready = time.monotonic() - start
+                    break
+            time.sleep(poll_interval)
+        else:
+            raise SystemExit(f'the service was not ready after {timeout}s: {body}')
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    result = {'live_s': live, 'ready_s': ready}
+    result.update({f'step_{name}_s': seconds for name, seconds in (body or {}).get('steps', {}).items()})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', required=True, help='base URL of the service')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for readiness')
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--output', default='startup.json', help='JSON results file')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='command starting the service, after --')
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error('the command starting the service is required')
+
+    runs = [measure(command, args.url, args.timeout, args.poll_interval) for _ in range(args.runs)]
+    for i, run in enumerate(runs):
+        print(f'run {i}: ' + ', '.join(f'{metric}={seconds:.3f}' for metric, seconds in run.items()))
+
+    # Best of the runs: the first start usually also pays for a cold page cache
+    best = {metric: min(run[metric] for run in runs if metric in run) for metric in runs[0]}
+    with open(args.output, 'w') as f:
+        json.dump({
+            'suite': 'startup',
+            'created': time.time(),
+            'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'command': command,
+                     'runs': args.runs},
+            'results': {'startup': best},
+        }, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,38 @@
+from bot.startup import Startup
+
+# Created first, so the startup breakdown covers the imports below too
+startup = Startup()
+
 import flask
 from flask import request
 import os
 from bot.bot import Bot, ImageProcessingBot # ObjectDetectionBot, QuoteBot
+from bot.ingest import UpdateIngestor, UpdatePoller
+from bot.clients import s3_client
+from bot import metrics
+
+startup.mark('imports')
 
 app = flask.Flask(__name__)
+metrics.instrument(app)  # per-request counters and GET /metrics
+startup.add_probes(app)  # GET /healthz and /readyz, the webhook answers 503 (Telegram retries) until the bot is ready
 
 TELEGRAM_TOKEN_FILE = os.environ['TELEGRAM_TOKEN_FILE']  # TELEGRAM_TOKEN = os.environ['TELEGRAM_TOKEN']
 with open(TELEGRAM_TOKEN_FILE, 'r') as file:
     TELEGRAM_TOKEN = file.read().rstrip()
 
-TELEGRAM_APP_URL_FILE = os.environ['TELEGRAM_APP_URL_FILE']  # TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
-with open(TELEGRAM_APP_URL_FILE, 'r') as file:
-    TELEGRAM_APP_URL = file.read().rstrip()
+# 'webhook': Telegram posts the updates to TELEGRAM_APP_URL. 'polling': the bot fetches them with getUpdates,
+# for local and test runs where Telegram cannot reach it (no TELEGRAM_APP_URL needed)
+BOT_INGEST_MODE = os.environ.get('BOT_INGEST_MODE', 'webhook').lower()
+# Recent update ids remembered to drop redelivered updates, and updates waiting to be dispatched
+BOT_DEDUP_WINDOW = int(os.environ.get('BOT_DEDUP_WINDOW', 10000))
+BOT_UPDATE_QUEUE_SIZE = int(os.environ.get('BOT_UPDATE_QUEUE_SIZE', 1000))
+
+TELEGRAM_APP_URL = None
+if BOT_INGEST_MODE == 'webhook':
+    TELEGRAM_APP_URL_FILE = os.environ['TELEGRAM_APP_URL_FILE']  # TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
+    with open(TELEGRAM_APP_URL_FILE, 'r') as file:
+        TELEGRAM_APP_URL = file.read().rstrip()
 
 BUCKET_NAME_FILE = os.environ['BUCKET_NAME_FILE']  # BUCKET_NAME = os.environ['BUCKET_NAME']
 with open(BUCKET_NAME_FILE, 'r') as file:
@@ -19,6 +40,24 @@ with open(BUCKET_NAME_FILE, 'r') as file:
 
 YOLO5_CONT_NAME = os.environ['YOLO5_CONT_NAME']
 
+bot = None
+ingestor = None
+
+
+def init_bot():
+    global bot, ingestor
+    use_webhook = BOT_INGEST_MODE == 'webhook'
+    bot = ImageProcessingBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL, BUCKET_NAME, YOLO5_CONT_NAME, use_webhook)
+    ingestor = UpdateIngestor(bot.handle_update, BOT_DEDUP_WINDOW, BOT_UPDATE_QUEUE_SIZE)
+    if not use_webhook:
+        UpdatePoller(TELEGRAM_TOKEN, ingestor).start()
+
+
+def init_img_proc():
+    # The filters pull in matplotlib and numpy, imported here so the first filtered photo does not wait for them
+    import polybot.img_proc
+    import matplotlib.image
+
 
 @app.route('/', methods=['GET'])
 def index():
@@ -27,14 +66,24 @@ def index():
 
 @app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
 def webhook():
-    req = request.get_json()
-    bot.handle_message(req['message'])
+    # Only queued here: Telegram redelivers an update it is not answered for in time, the processing (S3, yolo5,
+    # the reply) runs on the dispatch thread
+    update = request.get_json()
+    if ingestor.submit(update) == 'busy':
+        return 'Busy', 503, {'Retry-After': '1'}
     return 'Ok'
 
 
-if __name__ == "__main__":
-    bot = ImageProcessingBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL, BUCKET_NAME, YOLO5_CONT_NAME)
+@app.route('/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    # Queue depth, running handlers and queue wait times of the per-chat scheduler
+    return flask.jsonify(bot.scheduler.stats())
+
 
+if __name__ == "__main__":
+    # The webhook registration, the S3 client and the filter imports run in parallel while the server already
+    # answers the probes
+    startup.start({'bot': init_bot, 's3': s3_client, 'img_proc': init_img_proc})
     app.run(host='0.0.0.0', port=8443)
 
 
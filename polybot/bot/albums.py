@@ -0,0 +1,57 @@
+import threading
+
+from loguru import logger
+
+
+class AlbumCollector:
+    """
+    Groups the messages of a Telegram album, which arrive one by one and share a `media_group_id`.
+
+    An album is complete once no message of it arrived for `window` seconds, or once it has `max_size`
+    messages (Telegram albums have at most 10). `on_album` is then called, on a timer thread, with its messages
+    in the order they were sent.
+    """
+
+    def __init__(self, on_album, window=1.0, max_size=10):
+        self.on_album = on_album
+        self.window = window
+        self.max_size = max_size
+        self._albums = {}  # media_group_id -> (messages, timer)
+        self._lock = threading.Lock()
+
+    def add(self, msg):
+        group_id = msg['media_group_id']
+        with self._lock:
+            messages, timer = self._albums.get(group_id, ([], None))
+            if timer is not None:
+                timer.cancel()
+            messages.append(msg)
+            if len(messages) >= self.max_size:
+                self._albums.pop(group_id, None)  # not there yet if this message alone fills the album
+                complete = True
+            else:
+                timer = threading.Timer(self.window, self._flush, args=(group_id,))
+                timer.daemon = True
+                self._albums[group_id] = (messages, timer)
+                timer.start()
+                complete = False
+        if complete:
+            self._deliver(group_id, messages)
+
+    def _flush(self, group_id):
+        with self._lock:
+            messages, _ = self._albums.pop(group_id, (None, None))
+        if messages:
+            self._deliver(group_id, messages)
+
+    def _deliver(self, group_id, messages):
+        messages.sort(key=lambda msg: msg['message_id'])
+        logger.info(f'Album {group_id}: {len(messages)} messages')
+        try:
+            self.on_album(messages)
+        except Exception:
+            logger.exception(f'Album {group_id}: failed to handle it')
+
+    def pending(self):
+        with self._lock:
+            return len(self._albums)
@@ -1,15 +1,54 @@
 import telebot
+from telebot import apihelper
 from loguru import logger
 import os
-import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from telebot.types import InputFile
-from polybot.img_proc import Img
+from bot.scheduler import ChatScheduler
+from bot import metrics
+from bot.metrics import stage
+from bot.local_cache import LocalCache
+from bot.albums import AlbumCollector
+from bot.resilience import CircuitBreaker, RetryPolicy, ServiceUnavailable
+from bot.clients import S3_TRANSFER_CONFIG, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, http_session, s3_client
 import logging
-import boto3
 from botocore.exceptions import ClientError
+import re
 import requests
 import requests.exceptions
 
+# Caption keywords of every action, a caption may chain several filters, e.g. "blur contour rotate"
+CAPTION_ACTIONS = {
+    'blur': ['blur', 'טשטוש'],
+    'contour': ['contour', 'קווי מתאר'],
+    'salt_n_pepper': ['salt n pepper', 'salt and pepper', 'מלח פלפל'],
+    'segment': ['segment', 'חלוקה'],
+    'rotate': ['rotate', 'סיבוב'],
+    'detect': ['detect', 'זיהוי'],
+}
+CAPTION_ACTIONS_RE = re.compile('|'.join(re.escape(keyword) for keywords in CAPTION_ACTIONS.values()
+                                         for keyword in keywords))
+KEYWORD_ACTIONS = {keyword: action for action, keywords in CAPTION_ACTIONS.items() for keyword in keywords}
+
+# Downloaded photos are kept in a bounded local cache under `photos/`; Telegram photos are always JPEGs
+PHOTO_CACHE_MAX_MB = float(os.environ.get('PHOTO_CACHE_MAX_MB', 512))
+PHOTO_CACHE_TTL = float(os.environ.get('PHOTO_CACHE_TTL', 3600))
+PHOTO_SUFFIX = '.jpg'
+
+# Calls to yolo5 give up after YOLO5_DEADLINE seconds, retries included, with jittered exponential backoff between
+# attempts. After YOLO5_BREAKER_FAILURES failures in a row yolo5 is not called for YOLO5_BREAKER_RESET seconds.
+YOLO5_DEADLINE = float(os.environ.get('YOLO5_DEADLINE', 30))
+YOLO5_RETRY_BASE_DELAY = float(os.environ.get('YOLO5_RETRY_BASE_DELAY', 0.2))
+YOLO5_RETRY_MAX_DELAY = float(os.environ.get('YOLO5_RETRY_MAX_DELAY', 5))
+YOLO5_BREAKER_FAILURES = int(os.environ.get('YOLO5_BREAKER_FAILURES', 5))
+YOLO5_BREAKER_RESET = float(os.environ.get('YOLO5_BREAKER_RESET', 30))
+
+# The photos of an album arrive as separate messages; the album is processed once none arrived for this long
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', 1.0))
+# Bots can only download files up to 20 MB from Telegram
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+
 
 # Static Helper Methods
 def upload_file(file_name, bucket, object_name=None):
@@ -26,15 +65,49 @@ def upload_file(file_name, bucket, object_name=None):
         object_name = os.path.basename(file_name)
 
     # Upload the file
-    s3_client = boto3.client('s3')
     try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
+        with stage('s3_upload'):
+            response = s3_client().upload_file(file_name, bucket, object_name, Config=S3_TRANSFER_CONFIG)
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
+def parse_photo_targets(spec):
+    """
+    :param spec: e.g. "detect=640,blur=800"; a value of 0 means the largest photo Telegram has
+    :return: dict of action -> target size of the longest photo side in pixels (None for the largest)
+    """
+    targets = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        action, _, size = item.partition('=')
+        targets[action.strip()] = int(size) or None
+    return targets
+
+
+def select_photo_size(photo_sizes, target):
+    """
+    :param photo_sizes: the `photo` array of a Telegram message, every size Telegram has of the same photo
+    :param target: wanted size of the longest side in pixels, None for the largest photo
+    :return: the smallest photo size whose longest side reaches `target`, or the largest one if none does
+    """
+    by_size = sorted(photo_sizes, key=lambda size: size['width'] * size['height'])
+    if target is None:
+        return by_size[-1]
+    for size in by_size:
+        if max(size['width'], size['height']) >= target:
+            return size
+    return by_size[-1]
+
+
+def parse_caption(caption):
+    """
+    :return: the actions named in the caption, in the order they appear
+    """
+    return [KEYWORD_ACTIONS[match.group(0)] for match in CAPTION_ACTIONS_RE.finditer(caption.lower())]
+
+
 def count_prediction_msg(json_summery):
     labels = json_summery['labels']  # gets the list of all the labels from the json
     counted_dict = {}  # empty dict to store the counted results
@@ -47,64 +120,165 @@ def count_prediction_msg(json_summery):
     return formatted_message
 
 
+def count_album_msg(predictions):
+    labels = [label for prediction in predictions for label in prediction['labels']]
+    if not labels:
+        return f'No detections found in your {len(predictions)} photos.'
+    with_objects = sum(1 for prediction in predictions if prediction['labels'])
+    return (f'Detected objects in {with_objects} of your {len(predictions)} photos:\n'
+            f'{count_prediction_msg({"labels": labels})}')
+
+
+def count_video_msg(result):
+    if not result['classes']:
+        return f'No detections found in the {result["frames"]} frames I looked at.'
+    formatted_message = f'Detected objects in the {result["frames"]} frames I looked at:\n'
+    for row in result['classes']:
+        formatted_message += (f'{row["class"].capitalize()}: {row["max_per_frame"]} '
+                              f'(seen in {row["frames"]} frames)\n')
+    return formatted_message
+
+
+def message_kind(msg):
+    """Kind of content of a message, as counted in the metrics"""
+    if 'video' in msg or 'animation' in msg:
+        return 'video'
+    return 'photo' if 'photo' in msg else 'text' if 'text' in msg else 'other'
+
+
+def parse_stats_days(message, default=7):
+    """
+    :param message: a "/stats" command, optionally followed by the number of days, e.g. "/stats 30"
+    :return: the number of days the stats should cover
+    """
+    parts = message.split()
+    if len(parts) > 1 and parts[1].isdigit() and int(parts[1]) > 0:
+        return min(int(parts[1]), 365)
+    return default
+
+
+def format_stats_msg(stats, days):
+    if not stats['predictions']:
+        return f'No detections in your photos in the last {days} day(s).'
+    formatted_message = (f'In the last {days} day(s) I looked at {stats["predictions"]} of your photos and found '
+                         f'{stats["objects"]} objects:\n')
+    for row in stats['classes']:
+        formatted_message += f'{row["class"].capitalize()}: {row["count"]} ({row["avg_confidence"]:.0%} confidence)\n'
+    return formatted_message
+
+
 class Bot:
 
-    def __init__(self, token, telegram_chat_url, bucket_name, yolo5_cont_name):
+    def __init__(self, token, telegram_chat_url, bucket_name, yolo5_cont_name, use_webhook=True):
+        """
+        :param use_webhook: False when updates are fetched with `getUpdates` (see `bot.ingest.UpdatePoller`)
+            instead, the webhook is then deleted as Telegram refuses `getUpdates` while one is set
+        """
+        # Telegram calls share the process-wide keep-alive session instead of one session per thread
+        apihelper.session = http_session()
+        apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+        apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
         # create a new instance of the TeleBot class.
         # all communication with Telegram servers are done using self.telegram_bot_client
         self.telegram_bot_client = telebot.TeleBot(token)
 
-        # remove any existing webhooks configured in Telegram servers
-        self.telegram_bot_client.remove_webhook()
-        time.sleep(0.5)
-
-        # set the webhook URL
-        self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=60)
+        # set the webhook URL, it replaces any webhook already configured in Telegram servers.
+        # The bot information is only logged, it is fetched at the same time.
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            me = pool.submit(self.telegram_bot_client.get_me)
+            if use_webhook:
+                self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}/{token}/', timeout=60)
+            else:
+                self.telegram_bot_client.delete_webhook()
 
         self.bucket_name = bucket_name
         self.yolo5_cont_name = yolo5_cont_name
+        self.photo_cache = LocalCache('photos', PHOTO_CACHE_MAX_MB * 1024 * 1024, PHOTO_CACHE_TTL)
 
-        logger.info(f'Telegram Bot information\n\n{self.telegram_bot_client.get_me()}\n\n')
+        logger.info(f'Telegram Bot information\n\n{me.result()}\n\n')
         logger.info(f'******{self.bucket_name}******\n******{self.yolo5_cont_name}******')
 
     def send_text(self, chat_id, text):
-        self.telegram_bot_client.send_message(chat_id, text)
+        with stage('telegram_send'):
+            self.telegram_bot_client.send_message(chat_id, text)
 
     def send_text_with_quote(self, chat_id, text, quoted_msg_id):
-        self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
+        with stage('telegram_send'):
+            self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
 
     def is_current_msg_photo(self, msg):
         return 'photo' in msg
 
-    def download_user_photo(self, msg):
+    def download_user_photo(self, msg, target=None):
+        """
+        Downloads the photo that was sent to the Bot to the local photo cache (under `photos/`)
+        :param target: see `download_user_photo_bytes`
+        :return: path of the photo in the cache
+        """
+        photo_size, key = self._photo_cache_key(msg, target)
+        path = self.photo_cache.lookup(key, PHOTO_SUFFIX)
+        if path is None:
+            path = self.photo_cache.put(key, self._download_photo_size(photo_size, target), PHOTO_SUFFIX)
+        return str(path)
+
+    def download_user_photo_bytes(self, msg, target=None):
         """
-        Downloads the photos that sent to the Bot to `photos` directory (should be existed)
-        :return:
+        Downloads the photo that was sent to the Bot into memory, and keeps it in the local photo cache
+        :param target: size of the longest side needed, the smallest Telegram photo size that has it is downloaded.
+            None downloads the largest one.
+        :return: (file name, unique to the photo, e.g. `photos/<hash>.jpg`, photo bytes)
         """
+        photo_size, key = self._photo_cache_key(msg, target)
+        data = self.photo_cache.get(key, PHOTO_SUFFIX)
+        if data is None:
+            data = self._download_photo_size(photo_size, target)
+            self.photo_cache.put(key, data, PHOTO_SUFFIX)
+        return f'photos/{self.photo_cache.path(key, PHOTO_SUFFIX).name}', data
+
+    def _photo_cache_key(self, msg, target):
         if not self.is_current_msg_photo(msg):
             raise RuntimeError(f'Message content of type \'photo\' expected')
 
-        file_info = self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
-        data = self.telegram_bot_client.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
-
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
-
-        with open(file_info.file_path, 'wb') as photo:
-            photo.write(data)
+        photo_size = select_photo_size(msg['photo'], target)
+        # The same photo sent again, or forwarded, has the same unique id: it is not downloaded twice
+        return photo_size, f'telegram/{photo_size.get("file_unique_id", photo_size["file_id"])}'
 
-        return file_info.file_path
+    def _download_photo_size(self, photo_size, target):
+        logger.info(f'Downloading photo size {photo_size["width"]}x{photo_size["height"]} (target {target})')
+        with stage('telegram_download'):
+            file_info = self.telegram_bot_client.get_file(photo_size['file_id'])
+            return self.telegram_bot_client.download_file(file_info.file_path)
 
-    def send_photo(self, chat_id, img_path, caption=None):
-        if not os.path.exists(img_path):
+    def send_photo(self, chat_id, img, caption=None):
+        """
+        :param img: path of the image file, or the encoded image itself as bytes
+        """
+        if isinstance(img, (bytes, bytearray)):
+            photo = img
+        elif not os.path.exists(img):
             raise RuntimeError("Image path doesn't exist")
+        else:
+            photo = InputFile(img)
+
+        with stage('telegram_send'):
+            self.telegram_bot_client.send_photo(
+                chat_id,
+                photo,
+                caption
+            )
 
-        self.telegram_bot_client.send_photo(
-            chat_id,
-            InputFile(img_path),
-            caption
-        )
+    def handle_update(self, update):
+        """
+        Dispatches a Telegram update: new and edited messages go to `handle_message`, the other update types
+        (e.g. channel posts or callback queries) are not used by the bot and only logged
+        """
+        update_type = next((key for key in update if key != 'update_id'), 'unknown')
+        metrics.UPDATES.labels(type=update_type).inc()
+        if update_type in ('message', 'edited_message'):
+            self.handle_message(update[update_type])
+        else:
+            logger.info(f'Ignoring update {update.get("update_id")} of type {update_type}')
 
     def handle_message(self, msg):
         """Bot Main message handler"""
@@ -113,35 +287,104 @@ class Bot:
 
 
 class ImageProcessingBot(Bot):
-    def __init__(self, token, telegram_chat_url, bucket_name, yolo5_cont_name):
-        super().__init__(token, telegram_chat_url, bucket_name, yolo5_cont_name)
-        self.processing_completed = True
+    def __init__(self, token, telegram_chat_url, bucket_name, yolo5_cont_name, use_webhook=True):
+        super().__init__(token, telegram_chat_url, bucket_name, yolo5_cont_name, use_webhook)
         self.enjoy_msg = 'Enjoy!'
-        self.s3_client = boto3.client('s3')
+        self.s3_client = s3_client()
+        self.http = http_session()
+        # Send detect photos in the request body instead of through S3 (the old `imgName` path)
+        self.yolo5_direct_upload = os.environ.get('YOLO5_DIRECT_UPLOAD', 'true').lower() == 'true'
+        self.yolo5_policy = RetryPolicy(CircuitBreaker('yolo5', YOLO5_BREAKER_FAILURES, YOLO5_BREAKER_RESET),
+                                        YOLO5_DEADLINE, YOLO5_RETRY_BASE_DELAY, YOLO5_RETRY_MAX_DELAY,
+                                        HTTP_CONNECT_TIMEOUT)
+
+        # Longest side (pixels) each action needs: the smallest Telegram photo size reaching it is downloaded.
+        # YOLOv5 resizes to 640 anyway; filters default to the 1280 px Telegram usually keeps as its largest size.
+        self.photo_targets = {'detect': 640, 'blur': 1280, 'contour': 1280, 'salt_n_pepper': 1280, 'segment': 1280,
+                              'rotate': 1280}
+        self.photo_targets.update(parse_photo_targets(os.environ.get('PHOTO_TARGET_SIZES', '')))
+        # Debugging: also write each filtered image to IMG_FILTERED_DIR, as `<name>_filtered.<format>`. Not next to
+        # the downloaded photo: that is the photo cache, which would adopt the files as its entries after a restart.
+        self.save_filtered = os.environ.get('IMG_SAVE_FILTERED', 'false').lower() == 'true'
+        self.filtered_dir = Path(os.environ.get('IMG_FILTERED_DIR', 'filtered'))
+
+        # Different chats are processed concurrently, messages of the same chat one after the other
+        self.scheduler = ChatScheduler(workers=int(os.environ.get('BOT_WORKERS', 4)),
+                                       per_chat_limit=int(os.environ.get('BOT_CHAT_QUEUE_LIMIT', 3)))
+        metrics.SCHEDULER_QUEUED.set_function(lambda: self.scheduler.stats()['queued'])
+        self.albums = AlbumCollector(self.handle_album, ALBUM_WINDOW)
+
+    def photo_target(self, actions):
+        """The resolution a list of actions needs is the largest any of them needs"""
+        targets = [self.photo_targets.get(action) for action in actions]
+        return None if None in targets else max(targets, default=None)
 
     def handle_message(self, msg):
-        if not self.processing_completed:
-            logger.info("Previous message processing is not completed. Ignoring current message.")
+        if 'photo' in msg and 'media_group_id' in msg:
+            # The photos of an album are handled together, once all of them arrived (see `handle_album`)
+            metrics.MESSAGES.labels(kind='album_photo').inc()
+            self.albums.add(msg)
             return
+        metrics.MESSAGES.labels(kind=message_kind(msg)).inc()
+        self.schedule(msg, lambda: self.process_message(msg))
+
+    def handle_album(self, msgs):
+        """Called by the album collector with every message of an album"""
+        self.schedule(msgs[0], lambda: self.process_message(msgs[0], lambda msg: self.process_album(msgs)))
+
+    def schedule(self, msg, handler):
+        chat_id = msg['chat']['id']
+        ahead = self.scheduler.submit(chat_id, handler)
+        if ahead is None:
+            metrics.MESSAGES_REJECTED.inc()
+            logger.info(f"Chat {chat_id} has too many queued messages. Rejecting current message.")
+            self.send_text(chat_id, f'Busy, {self.scheduler.per_chat_limit} of your requests are already queued.\n'
+                                    f'Please wait for them to complete and send it again.')
+        elif ahead and message_kind(msg) in ('photo', 'video'):
+            self.send_text(chat_id, f'Busy, queued {ahead}. Your {message_kind(msg)} will be processed right after '
+                                    f'the previous ones.')
+
+    def process_message(self, msg, route=None):
+        """
+        :param route: function handling the message, `route_message` by default
+        """
+        try:
+            with metrics.MESSAGES_IN_FLIGHT.track_inprogress():
+                (route or self.route_message)(msg)
+        except Exception:
+            metrics.MESSAGE_ERRORS.inc()
+            logger.exception(f'Failed to process message {msg.get("message_id")}')
+            self.send_text(msg['chat']['id'], 'Oh no!\nSomething went wrong while processing your message, '
+                                              'please try again.')
+
+    def process_album(self, msgs):
+        """
+        Applies the caption of an album, Telegram sends it with one of its photos, to all of them: the detection
+        runs on all the photos in one yolo5 request, with one reply
+        """
+        captioned = next((msg for msg in msgs if 'caption' in msg), msgs[0])
+        actions = parse_caption(captioned.get('caption', ''))
+        filters = [action for action in actions if action != 'detect']
+        if filters:
+            logger.info(f"Received album of {len(msgs)} photos with filters caption: {filters}.")
+            for msg in msgs:
+                self.process_image(msg, filters)
+        elif 'detect' in actions:
+            logger.info(f"Received album of {len(msgs)} photos with detect caption.")
+            self.detect_objects_in_album(msgs)
+        else:
+            self.route_message(captioned)  # the same answers as a single photo without a valid caption
 
+    def route_message(self, msg):
         if "photo" in msg:
             # If the message contains a photo, check if it also has a caption
             if "caption" in msg:
-                caption = msg["caption"]
-                if "blur" in caption.lower() or "טשטוש" in caption.lower():
-                    logger.info("Received photo with blur caption.")
-                    self.process_image_blur(msg)
-                elif "contour" in caption.lower() or "קווי מתאר" in caption.lower():
-                    logger.info("Received photo with contour caption.")
-                    self.process_image_contur(msg)
-                elif ("salt n pepper" in caption.lower() or "salt and pepper" in caption.lower()
-                      or "מלח פלפל" in caption.lower()):
-                    logger.info("Received photo with salt n pepper caption.")
-                    self.process_image_salt_n_pepper(msg)
-                elif "segment" in caption.lower() or "חלוקה" in caption.lower():
-                    logger.info("Received photo with segment caption.")
-                    self.process_image_segment(msg)
-                elif "detect" in caption.lower() or "זיהוי" in caption.lower():
+                actions = parse_caption(msg["caption"])
+                filters = [action for action in actions if action != 'detect']
+                if filters:
+                    logger.info(f"Received photo with filters caption: {filters}.")
+                    self.process_image(msg, filters)
+                elif 'detect' in actions:
                     logger.info("Received photo with detect caption.")
                     self.detect_objects_in_img(msg)
                 else:
@@ -157,6 +400,15 @@ class ImageProcessingBot(Bot):
                             f' send it again with the fiter you want to apply in the \"caption\" of the picture.\n\nFor'
                             f' the list of available filters you can type \"/actions\"')
                 self.send_text(msg['chat']['id'], response)
+        elif "video" in msg or "animation" in msg:
+            if 'detect' in parse_caption(msg.get('caption', '')):
+                logger.info("Received video with detect caption.")
+                self.detect_objects_in_video(msg)
+            else:
+                logger.info("Received video without a detect caption.")
+                response = (f'Oh no!\nVideos and GIFs can only be sent for object detection.\n Please send it again '
+                            f'with \"detect\" in the \"caption\".')
+                self.send_text(msg['chat']['id'], response)
         elif "text" in msg:
             message = msg['text'].lower()
             if '/start' in message:
@@ -168,15 +420,27 @@ class ImageProcessingBot(Bot):
                 logger.info("Received text with command /help.")
                 response = (f'In order to use the bot properly you should send any photo, and in the \"caption'
                             f'\" type in the name of the action you want to apply.\n\nFor the list of actions available'
-                            f' right now you can type \"/actions\".')
+                            f' right now you can type \"/actions\".\nFor what was detected in your photos type '
+                            f'\"/stats\", or e.g. \"/stats 30\" for the last 30 days.')
+                self.send_text(msg['chat']['id'], response)
+            elif message.startswith('/stats'):
+                logger.info("Received text with command /stats.")
+                days = parse_stats_days(message)
+                stats = self.yolo5_stats(msg['chat']['id'], days * 86400)
+                if stats is None:
+                    response = 'Oh no!\nThe stats are not available right now, please try again later.'
+                else:
+                    response = format_stats_msg(stats, days)
                 self.send_text(msg['chat']['id'], response)
             elif '/actions' in message:
                 logger.info("Received text with command /actions.")
                 response = (f'The list of actions\\filters is:\n\nBlur - Blurs the image.\nContour - Shows only outline'
                             f's.\nSalt n Pepper - Randomly place white and black pixels over the picture.\nSegment -'
-                            f' Makes all the bright parts white and all the dark parts black.\n\nNEW!!!\nDetect - detec'
-                            f'ts objects in the given photo and prints what\'s detected. \n\nFor information on how'
-                            f' to use the actions you can type \"/help\".')
+                            f' Makes all the bright parts white and all the dark parts black.\nRotate - Rotates the '
+                            f'image clockwise.\n\nNEW!!!\nDetect - detects objects in the given photo and prints what'
+                            f'\'s detected. It also works on albums, GIFs and videos.\nFilters can be chained in one '
+                            f'caption, e.g. \"blur contour rotate\".\n\n'
+                            f'For information on how to use the actions you can type \"/help\".')
                 self.send_text(msg['chat']['id'], response)
             elif 'i hate you' in message:
                 logger.info("Received text that says \"i hate you\".")
@@ -200,123 +464,163 @@ class ImageProcessingBot(Bot):
                 self.send_text(msg['chat']['id'], response)
             # super().handle_message(msg)  # Call the parent class method to handle text messages
 
-    def process_image_segment(self, msg):
-        self.processing_completed = False
-        self.send_text(msg['chat']['id'], text=f'Processing...')
-
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-
-        # Process the image using your custom methods (e.g., apply filter)
-        image.segment()  # rotate the image
-
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_text(msg['chat']['id'], text=f'Completed!\nHere\'s the result:')
-            self.send_photo(msg['chat']['id'], processed_image_path, caption=self.enjoy_msg)
-
-        self.processing_completed = True
-
-    def process_image_blur(self, msg):
-        self.processing_completed = False
-        self.send_text(msg['chat']['id'], text=f'Processing...')
-
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-
-        # Process the image using your custom methods (e.g., apply filter)
-        image.blur()  # Blurs the image
-
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_text(msg['chat']['id'], text=f'Completed!\nHere\'s the result:')
-            self.send_photo(msg['chat']['id'], processed_image_path, caption=self.enjoy_msg)
+    def process_image(self, msg, filters):
+        """
+        Applies the filters named in the caption, in order, and sends the result back
 
-        self.processing_completed = True
+        :param filters: list of `Img` filter names, e.g. ['blur', 'contour', 'rotate']
+        """
+        from polybot.img_proc import ENCODE_FORMAT, Img  # matplotlib and numpy, imported in the background at startup
 
-    def process_image_contur(self, msg):
-        self.processing_completed = False
         self.send_text(msg['chat']['id'], text=f'Processing...')
 
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
-
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
-
-        # Process the image using your custom methods (e.g., apply filter)
-        image.contour()  # contur the image
-
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
-
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_text(msg['chat']['id'], text=f'Completed!\nHere\'s the result:')
-            self.send_photo(msg['chat']['id'], processed_image_path, caption=self.enjoy_msg)
-
-        self.processing_completed = True
+        target = self.photo_target(filters)
+        image_path = self.download_user_photo(msg, target)
+        image = Img(image_path, max_size=target)
+
+        # The filters are only recorded here, they all run in one pass when the image is saved
+        for image_filter in filters:
+            getattr(image, image_filter)()
+
+        with stage('filter'):
+            image.data  # runs the recorded filters
+        # The result goes to Telegram straight from memory; the `_filtered` file is only written for debugging
+        with stage('encode'):
+            processed_image = image.encode()
+        if self.save_filtered:
+            self.filtered_dir.mkdir(parents=True, exist_ok=True)
+            filtered_path = self.filtered_dir / f'{Path(image_path).stem}_filtered.{ENCODE_FORMAT.lower()}'
+            filtered_path.write_bytes(processed_image)
+
+        # Send the processed image back to the user
+        self.send_text(msg['chat']['id'], text=f'Completed!\nHere\'s the result:')
+        self.send_photo(msg['chat']['id'], processed_image, caption=self.enjoy_msg)
+
+    def yolo5_call(self, method, path, **kwargs):
+        """
+        Calls yolo5 through the retry policy: a deadline, jittered exponential backoff and a circuit breaker
 
-    def process_image_salt_n_pepper(self, msg):
-        self.processing_completed = False
-        self.send_text(msg['chat']['id'], text=f'Processing...')
+        :return: the response, whatever its status once it is not worth retrying
+        :raise ServiceUnavailable: if yolo5 could not answer within the deadline or its circuit is open
+        """
+        yolo5_api_url = f'http://{self.yolo5_cont_name}:8081{path}'  # yolo5_api_url = f'http://localhost:8081/predict'
 
-        # Download the two photos sent by the user
-        image_path = self.download_user_photo(msg)
+        def send(timeout):
+            with stage('yolo5_request'):
+                return self.http.request(method, yolo5_api_url, timeout=timeout, **kwargs)
 
-        # Create two different Img objects from the downloaded images
-        image = Img(image_path)
+        try:
+            return self.yolo5_policy.call(send)
+        except requests.exceptions.RequestException as e:  # not one of the RETRY_ERRORS, not retried
+            raise ServiceUnavailable(f'yolo5: {e}') from e
 
-        # Process the image using your custom methods (e.g., apply filter)
-        image.salt_n_pepper()  # rotate the image
+    def yolo5_request(self, s3_photo_path, chat_id=None):
+        """
+        :return: (response, prediction summary), or (None, None) if yolo5 refused the request (e.g. 404 when
+            nothing was detected)
+        :raise ServiceUnavailable: see `yolo5_call`
+        """
+        response = self.yolo5_call('POST', '/predict', params={'imgName': s3_photo_path, 'chatId': chat_id})
+        try:
+            response.raise_for_status()
+            return response, response.json()
+        except requests.exceptions.HTTPError as e:
+            logger.info(f'Error: {e}')
+            return None, None
 
-        # Save the processed image to the specified folder
-        processed_image_path = image.save_img()
+    def yolo5_request_image(self, img_bytes, img_name, chat_id=None):
+        """
+        Sends the photo itself to yolo5, which archives it to S3 under `img_name` after answering
+        :return: see `yolo5_request`
+        """
+        response = self.yolo5_call('POST', '/predict/image', params={'name': img_name, 'chatId': chat_id},
+                                   data=img_bytes, headers={'Content-Type': 'application/octet-stream'})
+        try:
+            response.raise_for_status()
+            return response, response.json()
+        except requests.exceptions.HTTPError as e:
+            logger.info(f'Error: {e}')
+            return None, None
 
-        if processed_image_path is not None:
-            # Send the processed image back to the user
-            self.send_text(msg['chat']['id'], text=f'Completed!\nHere\'s the result:')
-            self.send_photo(msg['chat']['id'], processed_image_path, caption=self.enjoy_msg)
+    def yolo5_request_images(self, images, chat_id=None):
+        """
+        Sends several photos to yolo5 in one request, which archives them to S3 after answering
 
-        self.processing_completed = True
+        :param images: list of (S3 name, photo bytes)
+        :return: the prediction summaries in the same order (without labels for the photos where nothing was
+            detected), or None if yolo5 refused the request
+        :raise ServiceUnavailable: see `yolo5_call`
+        """
+        response = self.yolo5_call('POST', '/predict/images',
+                                   params={'name': [img_name for img_name, _ in images], 'chatId': chat_id},
+                                   files=[('images', (Path(img_name).name, img_bytes, 'image/jpeg'))
+                                          for img_name, img_bytes in images])
+        try:
+            response.raise_for_status()
+            return response.json()['predictions']
+        except requests.exceptions.HTTPError as e:
+            logger.info(f'Error: {e}')
+            return None
 
-    def yolo5_request(self, s3_photo_path):
-        yolo5_cont_name = self.yolo5_cont_name
-        yolo5_api_url = f'http://{yolo5_cont_name}:8081/predict'  # yolo5_api_url = f'http://localhost:8081/predict'
+    def yolo5_request_video(self, video_bytes, video_name, chat_id=None):
+        """
+        :return: the per-class counts across the frames yolo5 sampled, or None if yolo5 refused the request
+        :raise ServiceUnavailable: see `yolo5_call`
+        """
+        response = self.yolo5_call('POST', '/predict/video', params={'name': video_name, 'chatId': chat_id},
+                                   data=video_bytes, headers={'Content-Type': 'application/octet-stream'})
         try:
-            response = requests.post(f"{yolo5_api_url}?imgName={s3_photo_path}")
             response.raise_for_status()
-            return response, response.json()
+            return response.json()
         except requests.exceptions.HTTPError as e:
             logger.info(f'Error: {e}')
-            return None, None
+            return None
+
+    def yolo5_stats(self, chat_id, window):
+        """
+        :param window: seconds back from now the stats cover
+        :return: the class frequencies of the chat's predictions from yolo5, or None if yolo5 could not answer
+        """
+        try:
+            response = self.yolo5_call('GET', '/predictions/stats', params={'chatId': chat_id, 'window': window})
+            response.raise_for_status()
+            return response.json()
+        except (ServiceUnavailable, requests.exceptions.RequestException) as e:
+            logger.info(f'Error: {e}')
+            return None
+
+    def request_detection(self, msg):
+        """
+        :return: (response, prediction summary) as returned by `yolo5_request`, and the S3 name of the photo
+        :raise ServiceUnavailable: see `yolo5_call`
+        """
+        if self.yolo5_direct_upload:
+            # The photo goes straight from memory to yolo5, the S3 archive happens there after the prediction
+            photo_path, img_bytes = self.download_user_photo_bytes(msg, self.photo_target(['detect']))
+            img_name = f'tg-photos/{photo_path}'
+            response_code, json_response = self.yolo5_request_image(img_bytes, img_name, msg['chat']['id'])
+        else:
+            photo_path = self.download_user_photo(msg, self.photo_target(['detect']))
+            bucket = self.bucket_name
+            img_name = f'tg-photos/photos/{Path(photo_path).name}'
+            upload_response = upload_file(photo_path, bucket, img_name)  # upload the photo to S3
+            if not upload_response:
+                raise ClientError
+            else:
+                logger.info(f'Successfully uploaded {photo_path} to {bucket}/{img_name}')
+            response_code, json_response = self.yolo5_request(img_name, msg['chat']['id'])  # send a request to the `yolo5` service for prediction
+        return response_code, json_response, img_name
 
     def detect_objects_in_img(self, msg):
-        self.processing_completed = False
         self.send_text(msg['chat']['id'], text=f'Processing...')
-        photo_path = self.download_user_photo(msg)
-        bucket = self.bucket_name
-        img_name = f'tg-photos/{photo_path}'
-        upload_response = upload_file(photo_path, bucket, img_name)  # upload the photo to S3
-        if not upload_response:
-            raise ClientError
-        else:
-            logger.info(f'Successfully uploaded {photo_path} to {bucket}/{img_name}')
-        logger.info(f'before request')
-        response_code, json_response = self.yolo5_request(img_name)  # send a request to the `yolo5` service for prediction
-        logger.info(f'after request')
+        try:
+            response_code, json_response, img_name = self.request_detection(msg)
+        except ServiceUnavailable as e:
+            logger.warning(f'Detection of message {msg.get("message_id")} failed: {e}')
+            self.send_text(msg['chat']['id'], 'Oh no!\nThe object detection is overloaded right now, please send '
+                                              'your photo again in a minute.')
+            return
+        logger.info(f'yolo5 prediction of {img_name} received')
         if response_code is None:
             self.send_text(msg['chat']['id'], 'Completed!')
             self.send_text(msg['chat']['id'], 'No detections found with your img.')
@@ -325,4 +629,48 @@ class ImageProcessingBot(Bot):
             counted_response_msg = count_prediction_msg(json_response)
             self.send_text(msg['chat']['id'], f'Detected objects: \n{counted_response_msg}')
 
-        self.processing_completed = True
\ No newline at end of file
+    def detect_objects_in_album(self, msgs):
+        chat_id = msgs[0]['chat']['id']
+        self.send_text(chat_id, text=f'Processing {len(msgs)} photos...')
+        target = self.photo_target(['detect'])
+        images = []
+        for msg in msgs:
+            photo_path, img_bytes = self.download_user_photo_bytes(msg, target)
+            images.append((f'tg-photos/{photo_path}', img_bytes))
+        try:
+            predictions = self.yolo5_request_images(images, chat_id)
+        except ServiceUnavailable as e:
+            logger.warning(f'Detection of album {msgs[0].get("media_group_id")} failed: {e}')
+            self.send_text(chat_id, 'Oh no!\nThe object detection is overloaded right now, please send your photos '
+                                    'again in a minute.')
+            return
+        self.send_text(chat_id, 'Completed!')
+        if predictions is None:
+            self.send_text(chat_id, 'Oh no!\nI could not look at your photos, please try again.')
+        else:
+            self.send_text(chat_id, count_album_msg(predictions))
+
+    def detect_objects_in_video(self, msg):
+        chat_id = msg['chat']['id']
+        media = msg.get('animation') or msg['video']
+        if media.get('file_size', 0) > TELEGRAM_DOWNLOAD_LIMIT:
+            self.send_text(chat_id, f'Oh no!\nYour video is too big, I can only look at videos up to '
+                                    f'{TELEGRAM_DOWNLOAD_LIMIT // (1024 * 1024)} MB.')
+            return
+        self.send_text(chat_id, text=f'Processing...')
+        # Only the encoded file is downloaded, yolo5 decodes and samples its frames one at a time
+        with stage('telegram_download'):
+            file_info = self.telegram_bot_client.get_file(media['file_id'])
+            video_bytes = self.telegram_bot_client.download_file(file_info.file_path)
+        try:
+            result = self.yolo5_request_video(video_bytes, Path(file_info.file_path).name, chat_id)
+        except ServiceUnavailable as e:
+            logger.warning(f'Detection of message {msg.get("message_id")} failed: {e}')
+            self.send_text(chat_id, 'Oh no!\nThe object detection is overloaded right now, please send your video '
+                                    'again in a minute.')
+            return
+        self.send_text(chat_id, 'Completed!')
+        if result is None:
+            self.send_text(chat_id, 'Oh no!\nI could not read your video, please try again with another one.')
+        else:
+            self.send_text(chat_id, count_video_msg(result))
@@ -0,0 +1,61 @@
+# Kept identical in polybot/bot/clients.py, the canonical copy, and yolo5/clients.py: each service is built from its
+# own directory and cannot import the other's code. Edit the polybot copy and copy it over,
+# polybot/test/test_shared_modules.py fails while they differ.
+import os
+import threading
+
+import boto3
+import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+
+# One keep-alive connection pool per process for every outgoing HTTP call (polybot: yolo5 and Telegram, yolo5: the
+# job callbacks)
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+
+# Enough S3 connections for every request thread and background worker to download or upload at once
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,  # photos and annotated images are smaller, they go in a single PUT
+    max_concurrency=4,
+    use_threads=True,
+)
+
+_lock = threading.Lock()
+_http_session = None
+_s3_client = None
+
+
+def http_session():
+    """
+    :return: the process-wide `requests.Session`, with a connection pool of HTTP_POOL_SIZE connections per host
+    """
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def http_timeout(read_timeout=None):
+    """(connect, read) timeout for `requests` calls, the read timeout is HTTP_READ_TIMEOUT unless given"""
+    return HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT
+
+
+def s3_client():
+    """
+    :return: the process-wide S3 client. boto3 clients are thread-safe, only their creation is not.
+    """
+    global _s3_client
+    with _lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                                          retries={'mode': 'standard'}))
+        return _s3_client
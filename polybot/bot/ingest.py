@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+from telebot import apihelper
+
+from bot import metrics
+
+
+class UpdateDeduplicator:
+    """
+    Remembers the last `size` Telegram `update_id`s, so an update delivered twice is only processed once.
+
+    Telegram redelivers a webhook update it did not get a 2xx for in time, and a restarted poller may fetch
+    updates again before its offset catches up.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, update_id):
+        """
+        Records `update_id`
+        :return: True if it was already recorded
+        """
+        with self._lock:
+            if update_id in self._ids:
+                return True
+            self._ids[update_id] = None
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            return False
+
+    def forget(self, update_id):
+        """Lets `update_id` through again, e.g. when it could not be queued and will be redelivered"""
+        with self._lock:
+            self._ids.pop(update_id, None)
+
+
+class UpdateIngestor:
+    """
+    Accepts Telegram updates and hands them to `handler` on a dispatch thread, so the webhook (or the poller) is
+    never held by the processing of an update.
+
+    Duplicated updates are dropped, and at most `queue_size` updates wait for the dispatch thread: beyond that
+    `submit` refuses the update, and the webhook answers an error so Telegram delivers it again later.
+    """
+
+    def __init__(self, handler, dedup_size=10000, queue_size=1000):
+        """
+        :param handler: called with each update dict, on the dispatch thread
+        :param dedup_size: number of recent update ids remembered, see `UpdateDeduplicator`
+        """
+        self.handler = handler
+        self.dedup = UpdateDeduplicator(dedup_size)
+        self._queue = queue.Queue(maxsize=queue_size)
+        metrics.UPDATES_QUEUED.set_function(self._queue.qsize)
+        threading.Thread(target=self._dispatch, name='update-dispatcher', daemon=True).start()
+
+    def submit(self, update):
+        """
+        :return: 'accepted', 'duplicate' (already accepted before, dropped) or 'busy' (the queue is full)
+        """
+        update_id = update.get('update_id')
+        if update_id is not None and self.dedup.seen(update_id):
+            metrics.UPDATES_DUPLICATE.inc()
+            logger.info(f'Dropping duplicate update {update_id}')
+            return 'duplicate'
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            if update_id is not None:
+                self.dedup.forget(update_id)
+            metrics.UPDATES_REJECTED.inc()
+            logger.warning(f'Update queue full, refusing update {update_id}')
+            return 'busy'
+        return 'accepted'
+
+    def _dispatch(self):
+        while True:
+            update = self._queue.get()
+            try:
+                self.handler(update)
+            except Exception:
+                logger.exception(f'Failed to handle update {update.get("update_id")}')
+
+
+class UpdatePoller:
+    """
+    Long-polls Telegram's `getUpdates` and feeds the updates to an `UpdateIngestor`, instead of a webhook.
+
+    Meant for local and test runs, where Telegram cannot reach the bot. Telegram refuses `getUpdates` while a
+    webhook is set, the bot has to delete it first.
+    """
+
+    def __init__(self, token, ingestor, long_polling_timeout=30, limit=100, retry_delay=1):
+        self.token = token
+        self.ingestor = ingestor
+        self.long_polling_timeout = long_polling_timeout
+        self.limit = limit
+        self.retry_delay = retry_delay
+        self.offset = None  # the id after the last update accepted, Telegram forgets the updates before it
+
+    def start(self):
+        threading.Thread(target=self.run, name='update-poller', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                updates = apihelper.get_updates(self.token, offset=self.offset, limit=self.limit,
+                                                timeout=apihelper.CONNECT_TIMEOUT,
+                                                long_polling_timeout=self.long_polling_timeout)
+            except Exception:
+                logger.exception('getUpdates failed')
+                time.sleep(self.retry_delay)
+                continue
+            if not self.poll_once(updates):
+                time.sleep(self.retry_delay)
+
+    def poll_once(self, updates):
+        """
+        Submits a batch of updates in order and advances the offset past the accepted ones
+        :return: False if the ingestor was busy, the rest of the batch is fetched again on the next call
+        """
+        for update in sorted(updates, key=lambda update: update['update_id']):
+            if self.ingestor.submit(update) == 'busy':
+                return False
+            self.offset = update['update_id'] + 1
+        return True
@@ -0,0 +1,185 @@
+# Kept identical in polybot/bot/local_cache.py, the canonical copy, and yolo5/local_cache.py: each service is
+# built from its own directory and cannot import the other's code. Edit the polybot copy and copy it over,
+# polybot/test/test_shared_modules.py fails while they differ.
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from loguru import logger
+
+
+def _size_of(path):
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+    return path.stat().st_size
+
+
+def _remove(path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+class LocalCache:
+    """
+    Bounded on-disk working set: files, or directories of files, under `root` with a total byte budget.
+
+    Entries are named after a hash of their key, so keys of different users or requests can never collide
+    whatever the original file names. The least recently used entries are evicted once the budget is exceeded,
+    and a background thread drops entries not used for `ttl` seconds. Entries found on disk at creation (from
+    a previous run) are adopted, oldest first.
+    """
+
+    def __init__(self, root, max_bytes, ttl=None, sweep_interval=60):
+        """
+        :param max_bytes: total size of the entries above which the least recently used ones are evicted
+        :param ttl: seconds an entry is kept after it was last used, None to only evict by size
+        :param sweep_interval: seconds between two sweeps of the expired entries
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # entry name -> (size, last used), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._adopt()
+        if ttl is not None:
+            threading.Thread(target=self._sweep_loop, args=(sweep_interval,), name=f'cache-sweeper-{self.root.name}',
+                             daemon=True).start()
+
+    def path(self, key, suffix=''):
+        """Where the entry of `key` lives; nothing needs to be there yet"""
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.root / digest[:2] / f'{digest}{suffix}'
+
+    def lookup(self, key, suffix=''):
+        """:return: the path of the entry of `key` and marks it used, or None if it is not cached"""
+        path = self.path(key, suffix)
+        with self._lock:
+            entry = self._entries.get(path.name)
+            if entry is None or not path.exists():
+                self.misses += 1
+                return None
+            self._entries[path.name] = (entry[0], time.time())
+            self._entries.move_to_end(path.name)
+            self.hits += 1
+        return path
+
+    def get(self, key, suffix=''):
+        """:return: the content of the cached file of `key`, or None if it is not cached"""
+        path = self.lookup(key, suffix)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:  # evicted in between
+            return None
+
+    def put(self, key, data, suffix=''):
+        """
+        Stores `data` as the file of `key`, atomically, and returns its path
+        """
+        path = self.path(key, suffix)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._track(path, len(data))
+        return path
+
+    def add(self, key, suffix=''):
+        """
+        Registers the file or directory written by the caller at `path(key, suffix)`, and returns its path
+        """
+        path = self.path(key, suffix)
+        self._track(path, _size_of(path))
+        return path
+
+    def remove(self, key, suffix=''):
+        path = self.path(key, suffix)
+        with self._lock:
+            entry = self._entries.pop(path.name, None)
+            if entry is not None:
+                self._bytes -= entry[0]
+        _remove(path)
+
+    def _track(self, path, size):
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(path.name, None)
+            if previous is not None:
+                self._bytes -= previous[0]
+            self._entries[path.name] = (size, time.time())
+            self._bytes += size
+            # The entry just added is the most recently used one, it is evicted last
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                name, (evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+                evicted.append(name)
+        for name in evicted:
+            _remove(self.root / name[:2] / name)
+
+    def _adopt(self):
+        found = []
+        for path in self.root.glob('*/*'):
+            if path.name.endswith('.tmp'):  # an interrupted write
+                _remove(path)
+                continue
+            found.append((path.stat().st_mtime, path))
+        for mtime, path in sorted(found):
+            self._track(path, _size_of(path))
+            self._entries[path.name] = (self._entries[path.name][0], mtime)
+        if found:
+            logger.info(f'local cache {self.root}: adopted {len(found)} entries, {self._bytes / 1e6:.1f} MB')
+
+    def sweep(self):
+        """Removes the entries not used for `ttl` seconds, returns how many were removed"""
+        deadline = time.time() - self.ttl
+        expired = []
+        with self._lock:
+            for name, (size, last_used) in self._entries.items():
+                if last_used >= deadline:
+                    break  # the rest was used more recently
+                expired.append((name, size))
+            for name, size in expired:
+                del self._entries[name]
+                self._bytes -= size
+        for name, _ in expired:
+            _remove(self.root / name[:2] / name)
+        return len(expired)
+
+    def _sweep_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                removed = self.sweep()
+            except Exception:
+                logger.exception(f'local cache {self.root}: sweep failed')
+                continue
+            if removed:
+                logger.info(f'local cache {self.root}: removed {removed} expired entries')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'root': str(self.root),
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
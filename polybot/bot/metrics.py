@@ -0,0 +1,76 @@
+import time
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Stage latencies range from sub-millisecond filters on small photos to multi-second yolo5 calls
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGES = ('telegram_download', 's3_upload', 'yolo5_request', 'filter', 'encode', 'telegram_send')
+
+STAGE_SECONDS = Histogram('polybot_stage_seconds', 'Time spent in each stage of handling a message', ['stage'],
+                          buckets=STAGE_BUCKETS)
+REQUESTS = Counter('polybot_requests_total', 'HTTP requests handled', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('polybot_request_seconds', 'HTTP request latency', ['endpoint'], buckets=STAGE_BUCKETS)
+ERRORS = Counter('polybot_errors_total', 'HTTP requests that raised an exception', ['endpoint'])
+IN_FLIGHT = Gauge('polybot_in_flight_requests', 'HTTP requests being handled right now')
+
+MESSAGES = Counter('polybot_messages_total', 'Telegram messages received', ['kind'])
+MESSAGE_ERRORS = Counter('polybot_message_errors_total', 'Telegram messages whose processing failed')
+MESSAGES_REJECTED = Counter('polybot_messages_rejected_total', 'Telegram messages refused because the chat was busy')
+MESSAGES_IN_FLIGHT = Gauge('polybot_messages_in_flight', 'Telegram messages being processed right now')
+SCHEDULER_QUEUED = Gauge('polybot_scheduler_queued', 'Telegram messages waiting for a scheduler worker')
+
+SERVICE_RETRIES = Counter('polybot_service_retries_total', 'Calls to another service retried', ['service'])
+SERVICE_UNAVAILABLE = Counter('polybot_service_unavailable_total', 'Calls to another service given up',
+                              ['service', 'reason'])
+CIRCUIT_OPEN = Gauge('polybot_circuit_open', 'Whether the circuit breaker of a service is open (or half-open)',
+                     ['service'])
+
+UPDATES = Counter('polybot_updates_total', 'Telegram updates dispatched', ['type'])
+UPDATES_DUPLICATE = Counter('polybot_updates_duplicate_total', 'Telegram updates dropped as already received')
+UPDATES_REJECTED = Counter('polybot_updates_rejected_total', 'Telegram updates refused because the queue was full')
+UPDATES_QUEUED = Gauge('polybot_updates_queued', 'Telegram updates waiting for the dispatch thread')
+
+# Label lookups take a lock and a dict access, the hot path uses the children resolved here once
+_stage_children = {stage: STAGE_SECONDS.labels(stage=stage) for stage in STAGES}
+
+
+def stage(name):
+    """
+    Times a block of code into the `polybot_stage_seconds` histogram, e.g. `with stage('yolo5_request'): ...`
+    """
+    return _stage_children[name].time()
+
+
+def _endpoint():
+    # The view function name, not the path: /jobs/<job_id> is one series and the webhook's token is never exposed
+    return request.endpoint or 'unmatched'
+
+
+def instrument(app):
+    """
+    Counts and times every request of a Flask app and serves the metrics on GET /metrics
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = _endpoint()
+        REQUESTS.labels(endpoint=endpoint, status=response.status_code).inc()
+        REQUEST_SECONDS.labels(endpoint=endpoint).observe(time.perf_counter() - g.metrics_start)
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        if 'metrics_start' not in g:
+            return
+        IN_FLIGHT.dec()
+        if exc is not None:
+            ERRORS.labels(endpoint=_endpoint()).inc()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
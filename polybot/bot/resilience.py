@@ -0,0 +1,147 @@
+import random
+import threading
+import time
+
+import requests
+from loguru import logger
+
+from bot import metrics
+
+# Statuses worth trying again: the service is overloaded, starting or restarting
+RETRY_STATUSES = {429, 502, 503, 504}
+# Transport errors worth trying again: the connection failed, timed out or broke off in the middle of the response
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError)
+
+
+class ServiceUnavailable(Exception):
+    """The service could not answer within the deadline, or its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while, instead of adding load to it and making every caller wait for
+    its timeouts.
+
+    After `failure_threshold` failures in a row the circuit opens and calls are refused for `reset_timeout`
+    seconds. Then one trial call is let through (half-open): its success closes the circuit, its failure opens
+    it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False  # a half-open trial call is in progress
+        self._lock = threading.Lock()
+        metrics.CIRCUIT_OPEN.labels(service=name).set_function(lambda: self.state != 'closed')
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self.opened_at < self.reset_timeout else 'half_open'
+
+    def allow(self):
+        """:return: whether a call may go through now"""
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self._state() != 'open':
+                    logger.warning(f'{self.name}: circuit open after {self.failures} failures in a row')
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Full jitter: a random delay up to the exponential backoff of the attempt, so retrying callers spread out"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RetryPolicy:
+    """
+    Calls a service with a deadline, jittered exponential backoff between attempts and a circuit breaker.
+
+    The `RETRY_ERRORS` and the `RETRY_STATUSES` are retried while the deadline allows; a `Retry-After`
+    sent by the service is respected, and such a response does not count as a failure for the circuit breaker.
+    Other responses, 4xx included, are returned to the caller as they are; other exceptions count as failures
+    and are raised.
+    """
+
+    def __init__(self, breaker, deadline=30, base_delay=0.2, max_delay=5, connect_timeout=5):
+        """
+        :param deadline: seconds the whole call may take, all attempts and delays included
+        """
+        self.breaker = breaker
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connect_timeout = connect_timeout
+
+    def call(self, send):
+        """
+        :param send: function sending the request, called with the `timeout` of the attempt, returning the response
+        :return: the response of the first attempt that is not retried
+        :raise ServiceUnavailable: if the circuit is open or no attempt succeeded before the deadline
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.SERVICE_UNAVAILABLE.labels(service=self.breaker.name, reason='circuit_open').inc()
+                raise ServiceUnavailable(f'{self.breaker.name}: circuit open')
+            remaining = deadline - time.monotonic()
+            retry_after = None
+            try:
+                response = send(timeout=(min(self.connect_timeout, remaining), remaining))
+            except RETRY_ERRORS as e:
+                error = e
+            except BaseException:
+                # Not retried, but still an outcome: a half-open trial call must never be left in progress, or the
+                # circuit would refuse every later call
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                error = f'HTTP {response.status_code}'
+                retry_after = response.headers.get('Retry-After')
+            if retry_after is None:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()  # shedding load but answering, the service is up
+
+            delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            if time.monotonic() + delay >= deadline:
+                metrics.SERVICE_UNAVAILABLE.labels(service=self.breaker.name, reason='deadline').inc()
+                raise ServiceUnavailable(f'{self.breaker.name}: no answer within {self.deadline}s, last error: '
+                                         f'{error}')
+            logger.info(f'{self.breaker.name}: attempt {attempt + 1} failed ({error}), retrying in {delay:.2f}s')
+            metrics.SERVICE_RETRIES.labels(service=self.breaker.name).inc()
+            time.sleep(delay)
+            attempt += 1
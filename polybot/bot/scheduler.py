@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+
+class ChatScheduler:
+    """
+    Runs message handlers on a bounded pool of worker threads.
+
+    Handlers of different chats run concurrently; handlers of the same chat run one at a time, in the order
+    they were submitted. Each chat can have at most `per_chat_limit` handlers waiting or running; beyond that
+    `submit` refuses the new one so the caller can tell the user instead of silently dropping it.
+    """
+
+    def __init__(self, workers=4, per_chat_limit=5, wait_samples=1000):
+        self.per_chat_limit = per_chat_limit
+        self._chats = {}  # chat id -> deque of (handler, enqueued at) waiting to run
+        self._active = set()  # chats with a handler running or waiting in `_ready`
+        self._running = set()  # chats with a handler running right now
+        self._ready = queue.Queue()  # chats whose next handler can run now
+        self._lock = threading.Lock()
+
+        self._waits = deque(maxlen=wait_samples)  # recent queue wait times, seconds
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'chat-worker-{i}', daemon=True).start()
+
+    def submit(self, chat_id, handler):
+        """
+        Queues `handler` (a callable without arguments) behind the other handlers of the chat
+
+        :return: how many handlers of the chat are ahead of it, or None if the chat's queue is full
+        """
+        with self._lock:
+            pending = self._chats.setdefault(chat_id, deque())
+            ahead = len(pending) + (1 if chat_id in self._running else 0)
+            if ahead >= self.per_chat_limit:
+                self.rejected += 1
+                return None
+            pending.append((handler, time.monotonic()))
+            if chat_id not in self._active:
+                self._active.add(chat_id)
+                self._ready.put(chat_id)
+            return ahead
+
+    def _run(self):
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                handler, enqueued_at = self._chats[chat_id].popleft()
+                self._waits.append(time.monotonic() - enqueued_at)
+                self._running.add(chat_id)
+            failed = False
+            try:
+                handler()
+            except Exception:
+                failed = True
+                logger.exception(f'chat {chat_id}: message handler failed')
+            finally:
+                with self._lock:
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+                    self._running.discard(chat_id)
+                    if self._chats[chat_id]:
+                        self._ready.put(chat_id)
+                    else:
+                        del self._chats[chat_id]
+                        self._active.discard(chat_id)
+
+    def stats(self):
+        with self._lock:
+            depths = [len(pending) for pending in self._chats.values()]
+            running = len(self._running)
+            waits = sorted(self._waits)
+        return {
+            'queued': sum(depths),
+            'max_chat_queue': max(depths, default=0),
+            'chats': len(depths),
+            'running': running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'wait_p50_ms': waits[len(waits) // 2] * 1000 if waits else 0.0,
+            'wait_p95_ms': waits[int(len(waits) * 0.95)] * 1000 if waits else 0.0,
+            'wait_max_ms': waits[-1] * 1000 if waits else 0.0,
+        }
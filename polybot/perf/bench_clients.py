@@ -0,0 +1,73 @@
+"""
+Per-call overhead of a new client per call vs the shared, long-lived clients in `bot.clients`.
+
+- S3: `boto3.client('s3')` per call (what `upload_file` used to do) vs reusing `s3_client()`. Only the client
+  creation is timed, no request leaves the machine.
+- HTTP: `requests.post` (new connection every call) vs the keep-alive `http_session()`, against a local
+  HTTP server standing in for the yolo5 container.
+
+Run from the polybot directory:
+    python -m perf.bench_clients --repeat 200
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import requests
+
+from bot.clients import http_session, s3_client
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+    wbufsize = -1  # send the headers and the body in one write
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"labels": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def per_call_ms(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return statistics.fmean(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-central-1')
+    new_client = per_call_ms(lambda: boto3.client('s3'), max(1, args.repeat // 10))
+    shared_client = per_call_ms(s3_client, args.repeat)
+    print(f's3 client: new per call {new_client:.3f} ms, shared {shared_client:.5f} ms')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/predict'
+    session = http_session()
+    new_connection = per_call_ms(lambda: requests.post(url, params={'imgName': 'x.jpg'}), args.repeat)
+    keep_alive = per_call_ms(lambda: session.post(url, params={'imgName': 'x.jpg'}), args.repeat)
+    server.shutdown()
+    print(f'http post: new connection {new_connection:.3f} ms, keep-alive session {keep_alive:.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
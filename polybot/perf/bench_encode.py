@@ -0,0 +1,73 @@
+"""
+Encode time and payload size of a filtered image: the old matplotlib `imsave` to a `_filtered` file (re-read for
+the upload) against the in-memory `Img.encode` path in each format.
+
+The test image is a smooth synthetic scene with a little noise, roughly what a blurred or segmented photo
+compresses like.
+
+Run from the polybot directory:
+    python -m perf.bench_encode --sizes 640 1280 2560 --output encode.json
+    python ../perf/compare.py encode_before.json encode.json
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from matplotlib.image import imsave
+
+from perf.common import write_results
+from polybot.img_proc import encode_image, to_gray_bytes
+
+
+def synthetic_image(size):
+    y, x = np.mgrid[0:size, 0:size] / size
+    rng = np.random.default_rng(0)
+    return 128 + 60 * np.sin(8 * x) * np.cos(5 * y) + 40 * x + rng.normal(0, 4, (size, size))
+
+
+def matplotlib_file(data, path):
+    imsave(path, data, cmap='gray')
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[640, 1280, 2560], help='square image sides')
+    parser.add_argument('--formats', nargs='+', default=['JPEG', 'PNG', 'WEBP'])
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='bench_encode.json', help='JSON results file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            data = synthetic_image(size)
+            cases = {'matplotlib_png_file': lambda: matplotlib_file(data, os.path.join(tmp, 'img_filtered.png'))}
+            for image_format in args.formats:
+                cases[image_format.lower()] = (
+                    lambda image_format=image_format: encode_image(to_gray_bytes(data), image_format, args.quality,
+                                                                   None))
+            for name, fn in cases.items():
+                seconds, encoded = best_of(fn, args.repeat)
+                case = f'{name}/{size}'
+                results[case] = {'seconds': seconds, 'size_kb': len(encoded) / 1024}
+                print(f'{case}: {seconds * 1000:.1f} ms, {len(encoded) / 1024:.0f} KB')
+
+    write_results(args.output, 'encode', results, {'quality': args.quality})
+
+
+if __name__ == '__main__':
+    main()
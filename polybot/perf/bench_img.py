@@ -0,0 +1,63 @@
+"""
+Time and peak memory of every Img filter across image sizes.
+
+Each filter runs `--repeat` times per size on a synthetic JPEG; the best time is kept, and the peak of the
+memory allocated while filtering (tracemalloc, which also tracks NumPy buffers) is recorded.
+
+Run from the polybot directory:
+    python -m perf.bench_img --sizes 512 1024 2048 --output img.json
+    python ../perf/compare.py img_before.json img.json
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from matplotlib.image import imsave
+
+from perf.common import write_results
+from polybot.img_proc import Img
+
+FILTERS = ['blur', 'contour', 'segment', 'salt_n_pepper']
+
+
+def bench_filter(path, image_filter, repeat):
+    best = float('inf')
+    peak = 0
+    for _ in range(repeat):
+        img = Img(path)
+        tracemalloc.start()
+        start = time.perf_counter()
+        getattr(img, image_filter)()
+        img.data  # the pipeline is lazy, reading the data runs it
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_mb': peak / 1024 / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048], help='square image sides')
+    parser.add_argument('--filters', nargs='+', default=FILTERS, choices=FILTERS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench_img.json', help='JSON results file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f'bench_{size}.jpg')
+            imsave(path, np.random.default_rng(size).integers(0, 256, (size, size, 3), dtype=np.uint8))
+            for image_filter in args.filters:
+                case = f'{image_filter}/{size}'
+                results[case] = bench_filter(path, image_filter, args.repeat)
+                print(f'{case}: {results[case]["seconds"] * 1000:.1f} ms, peak {results[case]["peak_mb"]:.1f} MB')
+
+    write_results(args.output, 'img_filters', results, {'sizes': args.sizes, 'repeat': args.repeat})
+
+
+if __name__ == '__main__':
+    main()
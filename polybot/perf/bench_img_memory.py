@@ -0,0 +1,103 @@
+"""
+Peak RSS of Img filters against image size, in-memory vs tiled.
+
+Every measurement runs in a fresh subprocess so its peak RSS only covers one image and one mode.
+Two numbers are reported: the peak RSS from getrusage, which also counts the file-backed pages of the
+memory-mapped scratch files (the kernel can drop those under pressure), and the peak anonymous RSS sampled
+from /proc/self/status, which is the memory that cannot be reclaimed.
+The outputs of both modes are also compared, they must be identical.
+
+Run from the polybot directory:
+    python -m perf.bench_img_memory --sizes 1000 2000 4000 --filter blur
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from matplotlib.image import imsave
+
+
+def make_image(path, size):
+    rng = np.random.default_rng(size)
+    imsave(path, rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def anon_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def child(path, image_filter, tiled):
+    from polybot.img_proc import Img
+
+    peak_anon = [anon_rss_mb()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.005):
+            peak_anon[0] = max(peak_anon[0], anon_rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    start = time.perf_counter()
+    img = Img(path, tiled=tiled)
+    getattr(img, image_filter)()
+    data = img.data
+    seconds = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    digest = hashlib.sha256(np.ascontiguousarray(data).tobytes()).hexdigest()
+    print(json.dumps({
+        'seconds': seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_anon_rss_mb': peak_anon[0],
+        'digest': digest,
+    }))
+
+
+def measure(path, image_filter, tiled):
+    output = subprocess.run([sys.executable, '-m', 'perf.bench_img_memory', '--child', path, image_filter,
+                             str(tiled)], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000], help='square image sides')
+    parser.add_argument('--filter', default='blur', choices=['blur', 'contour', 'segment'])
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        path, image_filter, tiled = args.child
+        child(path, image_filter, tiled == 'True')
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f'bench_{size}.jpg')
+            make_image(path, size)
+            in_memory = measure(path, args.filter, False)
+            tiled = measure(path, args.filter, True)
+            print(f'{size}x{size} {args.filter}: '
+                  f'in-memory {in_memory["peak_rss_mb"]:.0f} MB rss, {in_memory["peak_anon_rss_mb"]:.0f} MB anon, '
+                  f'{in_memory["seconds"]:.2f}s | '
+                  f'tiled {tiled["peak_rss_mb"]:.0f} MB rss, {tiled["peak_anon_rss_mb"]:.0f} MB anon, '
+                  f'{tiled["seconds"]:.2f}s | '
+                  f'identical: {in_memory["digest"] == tiled["digest"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,41 @@
+import io
+import os
+import tempfile
 from pathlib import Path
-from matplotlib.image import imread, imsave
-import random
+import numpy as np
+from PIL import Image
+from polybot.parallel import get_executor
+
+# Number of pixels a fused run of pointwise filters processes at a time, small enough to stay in cache
+FUSED_CHUNK_PIXELS = 1 << 16
+
+# Filters run over bands of this many output rows (plus the overlap they need), whatever the storage.
+# It is fixed so tiled and in-memory processing give exactly the same result.
+BAND_ROWS = 256
+
+# Images whose grayscale data is bigger than this are processed tiled, on memory-mapped scratch files
+TILED_THRESHOLD_BYTES = int(float(os.environ.get('IMG_TILED_THRESHOLD_MB', 64)) * 1024 * 1024)
+SCRATCH_DIR = os.environ.get('IMG_SCRATCH_DIR') or None  # None: the system temp dir
+
+# Filtered images are encoded in memory (see `Img.encode`): format, quality of lossy formats, and a cap on the size
+ENCODE_FORMAT = os.environ.get('IMG_ENCODE_FORMAT', 'JPEG')  # JPEG, PNG or WEBP
+ENCODE_QUALITY = int(os.environ.get('IMG_ENCODE_QUALITY', 85))
+ENCODE_MAX_BYTES = int(float(os.environ.get('IMG_ENCODE_MAX_MB', 5)) * 1024 * 1024)
+LOSSY_FORMATS = {'JPEG', 'WEBP'}
+
+# The 8-bit levels of matplotlib's 'gray' colormap, `imsave(..., cmap='gray')` maps pixels through it
+GRAY_LUT = (np.linspace(0, 1, 256) * 255).astype(np.uint8)
+
+
+def imread(path):
+    # matplotlib takes longer to import than the rest of the bot, it is only loaded when an image is read
+    from matplotlib.image import imread as matplotlib_imread
+    return matplotlib_imread(path)
+
+
+def imsave(path, arr, **kwargs):
+    from matplotlib.image import imsave as matplotlib_imsave
+    matplotlib_imsave(path, arr, **kwargs)
 
 
 def rgb2gray(rgb):
@@ -9,14 +44,215 @@ def rgb2gray(rgb):
     return gray
 
 
+def read_image(path, max_size=None):
+    """
+    Reads an image the way `matplotlib.image.imread` does.
+
+    When `max_size` is given and the file is a JPEG whose longest side is bigger than it, the JPEG is decoded at
+    a reduced scale (1/2, 1/4 or 1/8, draft mode) that still keeps the longest side at `max_size` or more.
+    That saves most of the decode time and memory of big photos.
+    """
+    if max_size:
+        with Image.open(path) as im:
+            width, height = im.size
+            if im.format == 'JPEG' and max(width, height) > max_size:
+                scale = max_size / max(width, height)
+                im.draft('RGB', (max(1, int(width * scale + 0.999)), max(1, int(height * scale + 0.999))))
+                return np.asarray(im)
+    return imread(path)
+
+
+def to_gray_bytes(data):
+    """
+    Converts a grayscale image to 8 bits exactly like `imsave(..., cmap='gray')`: the darkest pixel becomes black
+    and the brightest white. Works band by band, so memory-mapped images are not loaded whole.
+    """
+    rows = data.shape[0]
+    low = min(data[start:stop].min() for start, stop in _bands(rows))
+    high = max(data[start:stop].max() for start, stop in _bands(rows))
+    scale = 256 / (high - low) if high > low else 0.0
+    out = np.empty(data.shape, dtype=np.uint8)
+    for start, stop in _bands(rows):
+        levels = (data[start:stop] - low) * scale
+        np.minimum(levels, 255, out=levels)
+        out[start:stop] = GRAY_LUT[levels.astype(np.intp)]
+    return out
+
+
+def encode_image(gray, image_format=ENCODE_FORMAT, quality=ENCODE_QUALITY, max_bytes=ENCODE_MAX_BYTES):
+    """
+    Encodes an 8-bit grayscale image in memory with Pillow
+
+    :param max_bytes: above this size the quality of lossy formats is lowered down to 40, then the image is scaled
+        down by 3/4 steps until it fits. None for no cap.
+    :return: the encoded bytes
+    """
+    image_format = image_format.upper()
+    im = Image.fromarray(gray)
+    while True:
+        buffer = io.BytesIO()
+        im.save(buffer, format=image_format, **({'quality': quality} if image_format in LOSSY_FORMATS else {}))
+        if max_bytes is None or buffer.tell() <= max_bytes or min(im.size) <= 16:
+            return buffer.getvalue()
+        if image_format in LOSSY_FORMATS and quality > 40:
+            quality = max(40, quality - 15)
+        else:
+            im = im.resize((max(1, im.width * 3 // 4), max(1, im.height * 3 // 4)), Image.BILINEAR)
+
+
+def scratch_array(shape):
+    """A float array backed by a temp file (unlinked right away), the OS pages it in and out as needed"""
+    with tempfile.NamedTemporaryFile(dir=SCRATCH_DIR, prefix='img-', suffix='.scratch') as f:
+        f.truncate(max(1, int(np.prod(shape))) * np.dtype(float).itemsize)
+        return np.memmap(f, dtype=float, mode='r+', shape=shape)
+
+
+def _bands(rows, start=0, stop=None):
+    """Bands of `BAND_ROWS` rows between `start` (a band boundary) and `stop`"""
+    stop = rows if stop is None else min(stop, rows)
+    for band_start in range(start, stop, BAND_ROWS):
+        yield band_start, min(band_start + BAND_ROWS, stop)
+
+
+def _blur(data, out, blur_level, start=0, stop=None):
+    # Every output pixel is the floored mean of the blur_level x blur_level window below and to the right of it.
+    # The window sums come from a summed-area table: 4 lookups per pixel, whatever the blur_level.
+    # The table is built per band of output rows, from the band and the blur_level - 1 rows below it.
+    filter_sum = blur_level ** 2
+    width = data.shape[1]
+    for start, stop in _bands(out.shape[0], start, stop):
+        rows = np.asarray(data[start:stop + blur_level - 1], dtype=float)
+        sat = np.zeros((rows.shape[0] + 1, width + 1))
+        sat[1:, 1:] = rows.cumsum(axis=0).cumsum(axis=1)
+        window_sum = (sat[blur_level:, blur_level:] - sat[:-blur_level, blur_level:]
+                      - sat[blur_level:, :-blur_level] + sat[:-blur_level, :-blur_level])
+        out[start:stop] = window_sum // filter_sum
+
+
+def _blur_shape(shape, blur_level):
+    return max(0, shape[0] - blur_level + 1), max(0, shape[1] - blur_level + 1)
+
+
+def _contour(data, out, start=0, stop=None):
+    for start, stop in _bands(out.shape[0], start, stop):
+        out[start:stop] = np.abs(np.diff(data[start:stop], axis=1))
+
+
+def _rotate(data):
+    # 90 degrees clockwise, a view of the same pixels
+    return np.rot90(data, k=-1)
+
+
+def _concat(data, other_data, direction, out):
+    axis = 1 if direction == 'horizontal' else 0
+    for start, stop in _bands(data.shape[0]):
+        out[start:stop, :data.shape[1]] = data[start:stop]
+    if axis == 1:
+        for start, stop in _bands(other_data.shape[0]):
+            out[start:stop, data.shape[1]:] = other_data[start:stop]
+    else:
+        for start, stop in _bands(other_data.shape[0]):
+            out[data.shape[0] + start:data.shape[0] + stop] = other_data[start:stop]
+
+
+def _concat_shape(shape, other_shape, direction):
+    if direction == 'horizontal':
+        if shape[0] != other_shape[0]:
+            raise RuntimeError('Images must have the same height to be concatenated horizontally')
+        return shape[0], shape[1] + other_shape[1]
+    if direction == 'vertical':
+        if shape[1] != other_shape[1]:
+            raise RuntimeError('Images must have the same width to be concatenated vertically')
+        return shape[0] + other_shape[0], shape[1]
+    raise RuntimeError(f'Unknown concat direction: {direction}')
+
+
+# Pointwise filters work in place on a block of pixels, so consecutive ones can be fused into one pass
+def _segment_inplace(block):
+    np.multiply(block > 100, 255.0, out=block)
+
+
+def _salt_n_pepper_inplace(block):
+    rand = np.random.random(block.shape)
+    block[rand < 0.2] = 255.0
+    block[rand > 0.8] = 0.0
+
+
+POINTWISE_OPS = {
+    'segment': _segment_inplace,
+    'salt_n_pepper': _salt_n_pepper_inplace,
+}
+
+
+def _run_pointwise(data, out, ops, start=0, stop=None):
+    """Copies `data` into `out` and applies a run of pointwise ops on it, chunk by chunk"""
+    stop = out.shape[0] if stop is None else stop
+    rows_per_chunk = max(1, FUSED_CHUNK_PIXELS // max(1, out.shape[1]))
+    for chunk_start in range(start, stop, rows_per_chunk):
+        chunk_stop = min(chunk_start + rows_per_chunk, stop)
+        block = out[chunk_start:chunk_stop]
+        block[...] = data[chunk_start:chunk_stop]
+        for name, _ in ops:
+            POINTWISE_OPS[name](block)
+
+
+# Row-range kernels: kernel(data, out, *args, start, stop) fills out[start:stop]. `start` must be a band boundary.
+KERNELS = {
+    'blur': _blur,
+    'contour': _contour,
+    'pointwise': _run_pointwise,
+}
+
+
 class Img:
+    """
+    A grayscale image and a lazy pipeline of filters.
+
+    Filter methods only record an operation. The pipeline runs in one go the first time `data` is read
+    (or the image is saved): consecutive pointwise filters are fused into a single pass over one buffer,
+    and rotate returns a view instead of a copy.
 
-    def __init__(self, path):
+    Every filter runs over bands of rows, so the same code works on in-memory arrays and, for images above
+    `TILED_THRESHOLD_BYTES` (or with `tiled=True`), on memory-mapped scratch files, with identical results.
+    In-memory images big enough for it are split into strips filtered in parallel by a process pool
+    (see `polybot.parallel`).
+    """
+
+    def __init__(self, path, tiled=None, max_size=None):
         """
-        Do not change the constructor implementation
+        Loads the image as a 2D grayscale NumPy array (rows x columns of floats)
+
+        :param tiled: keep the data in memory-mapped scratch files; None decides by the image size
+        :param max_size: longest side needed; bigger JPEGs are decoded at a reduced resolution (see `read_image`)
         """
         self.path = Path(path)
-        self.data = rgb2gray(imread(path)).tolist()
+        rgb = read_image(path, max_size)
+        height, width = rgb.shape[:2]
+        self.tiled = height * width * np.dtype(float).itemsize > TILED_THRESHOLD_BYTES if tiled is None else tiled
+        if self.tiled:
+            self._data = scratch_array((height, width))
+            for start, stop in _bands(height):
+                self._data[start:stop] = rgb2gray(rgb[start:stop])
+        else:
+            self._data = np.asarray(rgb2gray(rgb), dtype=float)
+        self._ops = []
+
+    @property
+    def data(self):
+        if self._ops:
+            self._run_pipeline()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._ops = []
+
+    def tolist(self):
+        """
+        The image as nested Python lists, the way `data` used to be stored
+        """
+        return self.data.tolist()
 
     def save_img(self):
         """
@@ -26,63 +262,79 @@ class Img:
         imsave(new_path, self.data, cmap='gray')
         return new_path
 
-    def blur(self, blur_level=16):
+    def encode(self, image_format=None, quality=None, max_bytes=ENCODE_MAX_BYTES):
+        """
+        Encodes the filtered image in memory, with the same gray levels `save_img` writes
 
-        height = len(self.data)
-        width = len(self.data[0])
-        filter_sum = blur_level ** 2
+        :param image_format: Pillow format name, `ENCODE_FORMAT` by default
+        :param quality: quality of lossy formats, `ENCODE_QUALITY` by default
+        :param max_bytes: cap on the encoded size, see `encode_image`
+        :return: the encoded bytes
+        """
+        return encode_image(to_gray_bytes(self.data), image_format or ENCODE_FORMAT, quality or ENCODE_QUALITY,
+                            max_bytes)
 
-        result = []
-        for i in range(height - blur_level + 1):
-            row_result = []
-            for j in range(width - blur_level + 1):
-                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
-                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
-                row_result.append(average)
-            result.append(row_result)
+    def _alloc(self, shape):
+        return scratch_array(shape) if self.tiled else np.empty(shape)
 
-        self.data = result
+    def _apply(self, kernel, data, out_shape, *args):
+        # Tiled images stay on their scratch files, copying them to shared memory would defeat the memory bound
+        executor = None if self.tiled else get_executor(data.size)
+        if executor is not None:
+            return executor.run(kernel, data, out_shape, args)
+        out = self._alloc(out_shape)
+        KERNELS[kernel](data, out, *args)
+        return out
 
-    def contour(self):
-        for i, row in enumerate(self.data):
-            res = []
-            for j in range(1, len(row)):
-                res.append(abs(row[j-1] - row[j]))
+    def _run_pipeline(self):
+        data, ops, self._ops = self._data, self._ops, []
+        i = 0
+        while i < len(ops):
+            name, args = ops[i]
+            if name in POINTWISE_OPS:
+                j = i
+                while j < len(ops) and ops[j][0] in POINTWISE_OPS:
+                    j += 1
+                data = self._apply('pointwise', data, data.shape, ops[i:j])
+                i = j
+                continue
+            if name == 'blur':
+                data = self._apply('blur', data, _blur_shape(data.shape, *args), *args)
+            elif name == 'contour':
+                data = self._apply('contour', data, (data.shape[0], max(0, data.shape[1] - 1)))
+            elif name == 'rotate':
+                data = _rotate(data)
+            elif name == 'concat':
+                other_data, direction = args
+                out = self._alloc(_concat_shape(data.shape, other_data.shape, direction))
+                _concat(data, other_data, direction, out)
+                data = out
+            i += 1
+        self._data = data
 
-            self.data[i] = res
+    def blur(self, blur_level=16):
+        self._ops.append(('blur', (blur_level,)))
+        return self
+
+    def contour(self):
+        self._ops.append(('contour', ()))
+        return self
 
     def rotate(self):
-        # TODO remove the `raise` below, and write your implementation
-        raise NotImplementedError()
+        self._ops.append(('rotate', ()))
+        return self
 
     def salt_n_pepper(self):
-        for row_num, row_data in enumerate(self.data):
-            res = []
-            for i in range(0, len(row_data)):
-                pixel = row_data[i]
-                rand = random.random()
-                if rand < 0.2:
-                    pixel = 255
-                if rand > 0.8:
-                    pixel = 0
-                res.append(pixel)
-            self.data[row_num] = res
+        self._ops.append(('salt_n_pepper', ()))
+        return self
 
     def concat(self, other_img, direction='horizontal'):
-        # TODO remove the `raise` below, and write your implementation
-        raise NotImplementedError()
+        self._ops.append(('concat', (other_img.data, direction)))
+        return self
 
     def segment(self):
-        for row_num, row_data in enumerate(self.data):
-            res = []
-            for i in range(0, len(row_data)):
-                pixel = row_data[i]
-                if pixel > 100:
-                    pixel = 255
-                else:
-                    pixel = 0
-                res.append(pixel)
-            self.data[row_num] = res
+        self._ops.append(('segment', ()))
+        return self
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Size of the process pool that filters image strips. 0 or 1 keeps every filter on the serial path.
+IMG_WORKERS = int(os.environ.get('IMG_WORKERS', os.cpu_count() or 1))
+# Images with fewer pixels than this are filtered serially, the pool round trip is not worth it for them
+IMG_PARALLEL_MIN_PIXELS = int(os.environ.get('IMG_PARALLEL_MIN_PIXELS', 1_000_000))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(pixels):
+    """
+    :param pixels: size of the image about to be filtered
+    :return: the shared `StripExecutor`, or None if the image should be filtered serially
+    """
+    global _executor
+    if IMG_WORKERS <= 1 or pixels < IMG_PARALLEL_MIN_PIXELS:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = StripExecutor(IMG_WORKERS)
+        return _executor
+
+
+def _shared_array(shm, shape):
+    return np.ndarray(shape, dtype=float, buffer=shm.buf)
+
+
+def _run_strip(kernel, args, src_name, src_shape, out_name, out_shape, start, stop, seed):
+    # Runs in a pool process: attaches to both shared blocks and fills rows [start, stop) of the output
+    from polybot.img_proc import KERNELS
+
+    src_shm = SharedMemory(name=src_name)
+    out_shm = SharedMemory(name=out_name)
+    try:
+        np.random.seed(seed)  # pool processes would otherwise all draw the same random numbers
+        KERNELS[kernel](_shared_array(src_shm, src_shape), _shared_array(out_shm, out_shape), *args,
+                        start=start, stop=stop)
+    finally:
+        src_shm.close()
+        out_shm.close()
+
+
+class StripExecutor:
+    """
+    Filters an image in horizontal strips on a persistent process pool.
+
+    The input and output images live in shared memory, so only their names and shapes are sent to the
+    workers. Strips start on band boundaries (`img_proc.BAND_ROWS`) and each worker reads the rows below
+    its strip that neighborhood filters need, so the stitched output is the same as the serial one.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        # forkserver: the bot is multithreaded, forking it directly is not safe
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+
+    def _strips(self, rows):
+        from polybot.img_proc import BAND_ROWS
+
+        bands = -(-rows // BAND_ROWS)
+        per_worker = -(-bands // self.workers)
+        for first_band in range(0, bands, per_worker):
+            yield first_band * BAND_ROWS, min((first_band + per_worker) * BAND_ROWS, rows)
+
+    def run(self, kernel, data, out_shape, args):
+        """
+        Runs one of `img_proc.KERNELS` over the image and returns the output as a regular array
+        """
+        src_shm = SharedMemory(create=True, size=max(1, data.size * 8))
+        out_shm = SharedMemory(create=True, size=max(1, int(np.prod(out_shape)) * 8))
+        try:
+            src = _shared_array(src_shm, data.shape)
+            src[...] = data
+            futures = [
+                self._pool.submit(_run_strip, kernel, args, src_shm.name, data.shape, out_shm.name, out_shape,
+                                  start, stop, np.random.randint(2 ** 32))
+                for start, stop in self._strips(out_shape[0])
+            ]
+            for future in futures:
+                future.result()
+            result = _shared_array(out_shm, out_shape).copy()
+            del src
+            return result
+        finally:
+            src_shm.close()
+            src_shm.unlink()
+            out_shm.close()
+            out_shm.unlink()
@@ -0,0 +1,54 @@
+import threading
+import unittest
+
+from bot.albums import AlbumCollector
+
+
+def message(message_id, group_id='g1'):
+    return {'message_id': message_id, 'media_group_id': group_id}
+
+
+class TestAlbumCollector(unittest.TestCase):
+    def setUp(self):
+        self.albums = []
+        self.delivered = threading.Event()
+
+    def on_album(self, messages):
+        self.albums.append([msg['message_id'] for msg in messages])
+        self.delivered.set()
+
+    def test_album_is_delivered_in_order_after_the_window(self):
+        collector = AlbumCollector(self.on_album, window=0.05)
+        for message_id in (3, 1, 2):
+            collector.add(message(message_id))
+        self.assertTrue(self.delivered.wait(5))
+        self.assertEqual(self.albums, [[1, 2, 3]])
+        self.assertEqual(collector.pending(), 0)
+
+    def test_full_album_is_delivered_right_away(self):
+        collector = AlbumCollector(self.on_album, window=60, max_size=2)
+        collector.add(message(1))
+        collector.add(message(2))
+        self.assertEqual(self.albums, [[1, 2]])
+        self.assertEqual(collector.pending(), 0)
+
+    def test_albums_are_kept_apart(self):
+        collector = AlbumCollector(self.on_album, window=60, max_size=2)
+        collector.add(message(1, 'a'))
+        collector.add(message(2, 'b'))
+        self.assertEqual(self.albums, [])
+        self.assertEqual(collector.pending(), 2)
+        collector.add(message(3, 'a'))
+        self.assertEqual(self.albums, [[1, 3]])
+
+    def test_handler_error_is_contained(self):
+        def fail(messages):
+            raise RuntimeError('boom')
+
+        collector = AlbumCollector(fail, window=60, max_size=1)
+        collector.add(message(1))  # logged, not raised
+        self.assertEqual(collector.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import io
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+from matplotlib.image import imread, imsave
+from PIL import Image
+
+from polybot import img_proc, parallel
+from polybot.img_proc import Img, rgb2gray, to_gray_bytes
+
+
+class BaselineImg:
+    """
+    The list-based `Img` the NumPy pipeline replaced, as it was, to pin the results of the new one
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = rgb2gray(imread(path)).tolist()
+
+    def blur(self, blur_level=16):
+        height = len(self.data)
+        width = len(self.data[0])
+        filter_sum = blur_level ** 2
+
+        result = []
+        for i in range(height - blur_level + 1):
+            row_result = []
+            for j in range(width - blur_level + 1):
+                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
+                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
+                row_result.append(average)
+            result.append(row_result)
+
+        self.data = result
+
+    def contour(self):
+        for i, row in enumerate(self.data):
+            res = []
+            for j in range(1, len(row)):
+                res.append(abs(row[j-1] - row[j]))
+
+            self.data[i] = res
+
+    def salt_n_pepper(self):
+        for row_num, row_data in enumerate(self.data):
+            res = []
+            for i in range(0, len(row_data)):
+                pixel = row_data[i]
+                rand = random.random()
+                if rand < 0.2:
+                    pixel = 255
+                if rand > 0.8:
+                    pixel = 0
+                res.append(pixel)
+            self.data[row_num] = res
+
+    def segment(self):
+        for row_num, row_data in enumerate(self.data):
+            res = []
+            for i in range(0, len(row_data)):
+                pixel = row_data[i]
+                if pixel > 100:
+                    pixel = 255
+                else:
+                    pixel = 0
+                res.append(pixel)
+            self.data[row_num] = res
+
+
+class ImgTestCase(unittest.TestCase):
+    # Heights and widths that are not multiples of the patched band size, so bands end mid-image
+    SHAPE = (45, 38)
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        # A JPEG, read as 8-bit like the photos the bot gets, so the gray levels span 0-255
+        rgb = np.random.default_rng(7).integers(0, 256, (*self.SHAPE, 3), dtype=np.uint8)
+        self.path = self.tmp / 'image.jpg'
+        Image.fromarray(rgb).save(self.path, quality=95)
+
+    def assert_same(self, baseline, img):
+        np.testing.assert_array_equal(img.data, np.array(baseline.data))
+
+    def check_filters(self, **img_kwargs):
+        for name, filters in [('blur 16', [('blur', 16)]), ('blur 3', [('blur', 3)]), ('contour', [('contour',)]),
+                              ('segment', [('segment',)]),
+                              ('pipeline', [('blur', 3), ('contour',), ('segment',)])]:
+            with self.subTest(filters=name):
+                baseline, img = BaselineImg(self.path), Img(self.path, **img_kwargs)
+                for method, *args in filters:
+                    getattr(baseline, method)(*args)
+                    getattr(img, method)(*args)
+                self.assert_same(baseline, img)
+
+
+class TestImgFilters(ImgTestCase):
+    def test_filters_match_the_baseline(self):
+        self.check_filters(tiled=False)
+
+    def test_filters_are_lazy(self):
+        img = Img(self.path).blur(3).contour()
+        self.assertEqual([name for name, _ in img._ops], ['blur', 'contour'])
+        self.assertEqual(img.data.shape, (self.SHAPE[0] - 2, self.SHAPE[1] - 3))
+        self.assertEqual(img._ops, [])
+
+    def test_fused_pointwise_filters(self):
+        baseline, img = BaselineImg(self.path), Img(self.path)
+        baseline.blur(3)
+        baseline.segment()
+        baseline.segment()
+        img.blur(3).segment().segment()
+        with patch.object(img_proc, 'FUSED_CHUNK_PIXELS', 100):  # several chunks, each one row or more
+            self.assert_same(baseline, img)
+
+    def test_salt_n_pepper_only_sets_black_and_white(self):
+        original = Img(self.path).data
+        noisy = Img(self.path).salt_n_pepper().data
+        changed = noisy != original
+        self.assertTrue(set(np.unique(noisy[changed])) <= {0.0, 255.0})
+        # The baseline turns about 20% of the pixels white and 20% black
+        self.assertAlmostEqual(np.mean(noisy[changed] == 255), 0.5, delta=0.1)
+        self.assertAlmostEqual(changed.mean(), 0.4, delta=0.1)
+
+    def test_salt_n_pepper_fused_with_segment(self):
+        baseline, img = BaselineImg(self.path), Img(self.path)
+        baseline.segment()
+        baseline.salt_n_pepper()
+        img.segment().salt_n_pepper()
+        self.assertEqual(set(np.unique(img.data)), set(np.unique(baseline.data)))
+        self.assertEqual(img.data.shape, np.array(baseline.data).shape)
+
+
+class TestTiledImg(ImgTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(img_proc, 'BAND_ROWS', 8)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_data_is_memory_mapped(self):
+        self.assertIsInstance(Img(self.path, tiled=True)._data, np.memmap)
+
+    def test_filters_match_the_baseline(self):
+        # blur 16 reads 15 rows past each band, across the next one and beyond
+        self.check_filters(tiled=True)
+
+    def test_band_boundaries(self):
+        for band_rows in (1, 7, self.SHAPE[0] - 1, self.SHAPE[0], 100):
+            with self.subTest(band_rows=band_rows), patch.object(img_proc, 'BAND_ROWS', band_rows):
+                tiled = Img(self.path, tiled=True).blur(5).contour().data
+                in_memory = Img(self.path, tiled=False).blur(5).contour().data
+                np.testing.assert_array_equal(tiled, in_memory)
+
+
+class TestParallelImg(ImgTestCase):
+    def setUp(self):
+        super().setUp()
+        # Strips of whole bands, filtered by two pool processes in shared memory, even for this small image
+        patch.object(img_proc, 'BAND_ROWS', 8).start()
+        patch.object(parallel, 'IMG_PARALLEL_MIN_PIXELS', 0).start()
+        patch.object(parallel, 'IMG_WORKERS', 2).start()
+        patch.object(parallel, '_executor', None).start()
+        # The pool processes import `polybot.img_proc` again, from the path they inherit: pytest puts the repository
+        # root first, where `polybot` is the service directory, so the package directory goes before it
+        patch.object(sys, 'path', [str(Path(parallel.__file__).parents[1])] + sys.path).start()
+        self.addCleanup(patch.stopall)
+        self.addCleanup(self.shutdown_executor)
+
+    def shutdown_executor(self):
+        if parallel._executor is not None:
+            parallel._executor._pool.shutdown()
+
+    def test_image_is_split_into_strips(self):
+        self.assertIsNotNone(parallel.get_executor(1))
+        self.assertEqual(list(parallel._executor._strips(self.SHAPE[0])), [(0, 24), (24, 45)])
+
+    def test_filters_match_the_baseline(self):
+        self.check_filters(tiled=False)
+
+
+class TestEncoding(ImgTestCase):
+    def imsave_levels(self, data):
+        # What `save_img` writes: the gray colormap as RGBA, the same level in R, G and B
+        path = self.tmp / 'saved.png'
+        imsave(path, data, cmap='gray')
+        return np.asarray(Image.open(path))[..., 0]
+
+    def test_to_gray_bytes_matches_imsave(self):
+        for name, img in [('original', Img(self.path)), ('blurred', Img(self.path).blur(3)),
+                          ('contour', Img(self.path).contour()), ('segment', Img(self.path).segment())]:
+            with self.subTest(image=name):
+                np.testing.assert_array_equal(to_gray_bytes(img.data), self.imsave_levels(img.data))
+
+    def test_to_gray_bytes_across_bands(self):
+        data = Img(self.path).blur(3).data
+        with patch.object(img_proc, 'BAND_ROWS', 4):
+            np.testing.assert_array_equal(to_gray_bytes(data), self.imsave_levels(data))
+
+    def test_flat_image_is_black(self):
+        np.testing.assert_array_equal(to_gray_bytes(np.full((3, 4), 42.0)), self.imsave_levels(np.full((3, 4), 42.0)))
+
+    def test_encode_matches_save_img(self):
+        img = Img(self.path).blur(3)
+        encoded = np.asarray(Image.open(io.BytesIO(img.encode('PNG'))))
+        np.testing.assert_array_equal(encoded, self.imsave_levels(img.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
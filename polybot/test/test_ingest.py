@@ -0,0 +1,79 @@
+import threading
+import unittest
+from unittest.mock import Mock
+
+from bot.ingest import UpdateDeduplicator, UpdateIngestor, UpdatePoller
+
+
+class TestUpdateDeduplicator(unittest.TestCase):
+    def test_seen_and_forget(self):
+        dedup = UpdateDeduplicator(size=2)
+        self.assertFalse(dedup.seen(1))
+        self.assertTrue(dedup.seen(1))
+        dedup.forget(1)
+        self.assertFalse(dedup.seen(1))
+
+    def test_remembers_the_last_ids_only(self):
+        dedup = UpdateDeduplicator(size=2)
+        for update_id in (1, 2, 3):
+            dedup.seen(update_id)
+        self.assertFalse(dedup.seen(1))
+        self.assertTrue(dedup.seen(3))
+
+
+class TestUpdateIngestor(unittest.TestCase):
+    def test_dispatches_each_update_once(self):
+        handled = []
+        done = threading.Event()
+        ingestor = UpdateIngestor(lambda update: (handled.append(update['update_id']), done.set()))
+        self.assertEqual(ingestor.submit({'update_id': 7}), 'accepted')
+        self.assertEqual(ingestor.submit({'update_id': 7}), 'duplicate')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(handled, [7])
+
+    def test_full_queue_refuses_and_forgets_the_update(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def handler(update):
+            started.set()
+            release.wait(5)
+
+        ingestor = UpdateIngestor(handler, queue_size=1)
+        ingestor.submit({'update_id': 1})
+        self.assertTrue(started.wait(5))  # the dispatch thread is busy with update 1
+        self.assertEqual(ingestor.submit({'update_id': 2}), 'accepted')
+        self.assertEqual(ingestor.submit({'update_id': 3}), 'busy')
+        release.set()
+        # Refused, not recorded: its redelivery is accepted once there is room
+        self.assertFalse(ingestor.dedup.seen(3))
+
+    def test_handler_error_keeps_dispatching(self):
+        done = threading.Event()
+
+        def handler(update):
+            if update['update_id'] == 1:
+                raise RuntimeError('boom')
+            done.set()
+
+        ingestor = UpdateIngestor(handler)
+        ingestor.submit({'update_id': 1})
+        ingestor.submit({'update_id': 2})
+        self.assertTrue(done.wait(5))
+
+
+class TestUpdatePoller(unittest.TestCase):
+    def test_offset_advances_past_accepted_updates_only(self):
+        ingestor = Mock()
+        ingestor.submit.side_effect = ['accepted', 'busy']
+        poller = UpdatePoller('token', ingestor)
+        self.assertFalse(poller.poll_once([{'update_id': 11}, {'update_id': 10}]))
+        self.assertEqual(poller.offset, 11)  # 10 was accepted, 11 is fetched again
+
+        ingestor.submit.side_effect = ['accepted']
+        self.assertTrue(poller.poll_once([{'update_id': 11}]))
+        self.assertEqual(poller.offset, 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
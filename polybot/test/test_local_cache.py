@@ -0,0 +1,53 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from bot.local_cache import LocalCache
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name) / 'photos'
+
+    def test_put_and_get(self):
+        cache = LocalCache(self.root, max_bytes=100)
+        path = cache.put('chat/1', b'abc', '.jpg')
+        self.assertTrue(path.is_relative_to(self.root))
+        self.assertEqual(path.suffix, '.jpg')
+        self.assertEqual(cache.get('chat/1', '.jpg'), b'abc')
+        self.assertIsNone(cache.get('chat/2', '.jpg'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(self.root, max_bytes=10)
+        first = cache.put('a', b'x' * 4)
+        cache.put('b', b'x' * 4)
+        cache.get('a')  # b is now the least recently used
+        cache.put('c', b'x' * 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertTrue(first.exists())
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+    def test_sweep_removes_expired_entries(self):
+        cache = LocalCache(self.root, max_bytes=100, ttl=60, sweep_interval=3600)
+        path = cache.put('a', b'x')
+        cache._entries[path.name] = (1, time.time() - 61)
+        self.assertEqual(cache.sweep(), 1)
+        self.assertFalse(path.exists())
+
+    def test_adopts_previous_entries(self):
+        LocalCache(self.root, max_bytes=100).put('a', b'abc')
+        (self.root / 'ab').mkdir()
+        (self.root / 'ab' / 'interrupted.tmp').write_bytes(b'x')
+        cache = LocalCache(self.root, max_bytes=100)
+        self.assertEqual(cache.get('a'), b'abc')
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertFalse((self.root / 'ab' / 'interrupted.tmp').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import requests
+
+from bot.resilience import CircuitBreaker, RetryPolicy, ServiceUnavailable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def response(status, headers=None):
+    return Mock(status_code=status, headers=headers or {})
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch('bot.resilience.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+
+    def test_opens_after_threshold(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_lets_one_trial_through(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_trial_success_closes(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_trial_failure_reopens(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker._trial)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch('bot.resilience.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+        self.policy = RetryPolicy(self.breaker, deadline=10, base_delay=0.1, max_delay=1)
+
+    def open_until_half_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.clock.now += 30
+
+    def test_returns_first_answer(self):
+        send = Mock(return_value=response(200))
+        self.assertEqual(self.policy.call(send).status_code, 200)
+        self.assertEqual(send.call_count, 1)
+
+    def test_client_errors_are_not_retried(self):
+        send = Mock(return_value=response(404))
+        self.assertEqual(self.policy.call(send).status_code, 404)
+        self.assertEqual(send.call_count, 1)
+
+    def test_retries_transient_errors(self):
+        send = Mock(side_effect=[requests.exceptions.ConnectionError(), requests.exceptions.ChunkedEncodingError(),
+                                 response(200)])
+        self.assertEqual(self.policy.call(send).status_code, 200)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_honors_retry_after(self):
+        send = Mock(side_effect=[response(503, {'Retry-After': '3'}), response(200)])
+        start = self.clock.now
+        self.assertEqual(self.policy.call(send).status_code, 200)
+        self.assertGreaterEqual(self.clock.now - start, 3)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_gives_up_at_deadline(self):
+        send = Mock(return_value=response(503, {'Retry-After': '4'}))
+        with self.assertRaises(ServiceUnavailable):
+            self.policy.call(send)
+        self.assertLessEqual(send.call_count, 3)
+
+    def test_open_circuit_refuses_without_calling(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        send = Mock(return_value=response(200))
+        with self.assertRaises(ServiceUnavailable):
+            self.policy.call(send)
+        send.assert_not_called()
+
+    def test_unexpected_error_on_trial_does_not_wedge_the_circuit(self):
+        self.open_until_half_open()
+        send = Mock(side_effect=requests.exceptions.InvalidHeader())
+        with self.assertRaises(requests.exceptions.InvalidHeader):
+            self.policy.call(send)
+        self.assertFalse(self.breaker._trial)
+        self.assertEqual(self.breaker.state, 'open')
+
+        self.clock.now += 30
+        send = Mock(return_value=response(200))
+        self.assertEqual(self.policy.call(send).status_code, 200)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_transient_error_on_trial_reopens(self):
+        self.open_until_half_open()
+        send = Mock(side_effect=requests.exceptions.ChunkedEncodingError())
+        with self.assertRaises(ServiceUnavailable):
+            self.policy.call(send)
+        self.assertFalse(self.breaker._trial)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import threading
+import time
+import unittest
+
+from bot.scheduler import ChatScheduler
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.01)
+
+
+class TestChatScheduler(unittest.TestCase):
+    def test_same_chat_runs_in_order_one_at_a_time(self):
+        scheduler = ChatScheduler(workers=4, per_chat_limit=10)
+        order, running, overlaps = [], [], []
+        lock = threading.Lock()
+
+        def handler(i):
+            with lock:
+                if running:
+                    overlaps.append(i)
+                running.append(i)
+            time.sleep(0.01)
+            with lock:
+                running.remove(i)
+                order.append(i)
+
+        for i in range(5):
+            scheduler.submit(1, lambda i=i: handler(i))
+        wait_for(lambda: len(order) == 5)
+        self.assertEqual(order, [0, 1, 2, 3, 4])
+        self.assertEqual(overlaps, [])
+
+    def test_different_chats_run_concurrently(self):
+        scheduler = ChatScheduler(workers=2)
+        started = threading.Barrier(2, timeout=5)
+        done = []
+        scheduler.submit(1, lambda: done.append(started.wait()))
+        scheduler.submit(2, lambda: done.append(started.wait()))
+        wait_for(lambda: len(done) == 2)  # each handler waits for the other one to start
+
+    def test_full_chat_queue_rejects(self):
+        scheduler = ChatScheduler(workers=1, per_chat_limit=2)
+        release = threading.Event()
+        self.assertEqual(scheduler.submit(1, release.wait), 0)
+        wait_for(lambda: scheduler.stats()['running'] == 1)
+        self.assertEqual(scheduler.submit(1, lambda: None), 1)
+        self.assertIsNone(scheduler.submit(1, lambda: None))
+        self.assertEqual(scheduler.submit(2, lambda: None), 0)  # other chats are not affected
+        release.set()
+        wait_for(lambda: scheduler.stats()['completed'] == 3)
+        self.assertEqual(scheduler.stats()['rejected'], 1)
+
+    def test_failing_handler_does_not_stop_the_chat(self):
+        scheduler = ChatScheduler(workers=1)
+        done = threading.Event()
+
+        def fail():
+            raise RuntimeError('boom')
+
+        scheduler.submit(1, fail)
+        scheduler.submit(1, done.set)
+        self.assertTrue(done.wait(5))
+        wait_for(lambda: scheduler.stats()['completed'] == 1)
+        self.assertEqual(scheduler.stats()['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[2]
+
+# Modules both services need, each kept as a copy in the service's own build context: polybot copy -> yolo5 copy
+SHARED_MODULES = {
+    'polybot/bot/local_cache.py': 'yolo5/local_cache.py',
+    'polybot/bot/startup.py': 'yolo5/startup.py',
+    'polybot/bot/clients.py': 'yolo5/clients.py',
+    'polybot/perf/common.py': 'yolo5/perf/common.py',
+}
+
+
+@unittest.skipUnless((REPO / 'yolo5').is_dir(), 'needs the whole repository, not only the polybot directory')
+class TestSharedModules(unittest.TestCase):
+    def test_copies_match(self):
+        for canonical, copy in SHARED_MODULES.items():
+            with self.subTest(module=canonical):
+                self.assertEqual((REPO / canonical).read_text(), (REPO / copy).read_text(),
+                                 f'{copy} differs from {canonical}, copy the polybot module over')
+
+
+if __name__ == '__main__':
+    unittest.main()
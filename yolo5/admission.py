@@ -0,0 +1,110 @@
+import math
+import threading
+import time
+
+from flask import g, request
+
+import metrics
+
+
+class AdmissionController:
+    """
+    Bounds the work a service takes on: at most `max_concurrent` requests run at once, at most `max_queue` more
+    wait for a slot, each for at most `queue_timeout` seconds. Anything beyond is rejected right away, so a burst
+    gets quick 503s instead of every request slowing down until the clients time out.
+
+    The time requests take once admitted is tracked as an exponentially weighted moving average, which gives the
+    rejected clients a `Retry-After` matching how long the queue takes to drain.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=16, queue_timeout=10, alpha=0.2):
+        """
+        :param alpha: weight of the latest service time in the moving average
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.alpha = alpha
+        self.service_time = None  # seconds, moving average
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Takes a slot, waiting for one if the queue has room
+        :return: None once admitted, or why the request is rejected: 'queue_full' or 'timeout'
+        """
+        with self._cond:
+            if self.running >= self.max_concurrent:
+                if self.waiting >= self.max_queue:
+                    return self._reject('queue_full')
+                self.waiting += 1
+                metrics.ADMISSION_WAITING.inc()
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.running >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._reject('timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    metrics.ADMISSION_WAITING.dec()
+            self.running += 1
+            self.admitted += 1
+            return None
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        metrics.ADMISSION_REJECTED.labels(reason=reason).inc()
+        return reason
+
+    def release(self, service_time):
+        """Frees the slot taken by `acquire`, `service_time` is how long the request held it"""
+        with self._cond:
+            self.running -= 1
+            self.service_time = service_time if self.service_time is None else (
+                self.alpha * service_time + (1 - self.alpha) * self.service_time)
+            self._cond.notify()
+
+    def retry_after(self):
+        """Seconds after which a rejected request may find a slot: the time the requests ahead of it take"""
+        with self._cond:
+            if self.service_time is None:
+                return 1
+            ahead = self.running + self.waiting + 1
+            return max(1, math.ceil(self.service_time * ahead / self.max_concurrent))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'running': self.running,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'service_time_ms': self.service_time * 1000 if self.service_time is not None else None,
+            }
+
+    def protect(self, app, endpoints):
+        """
+        Applies the admission control to the given endpoints (view function names) of a Flask app, the others are
+        not limited
+        """
+        @app.before_request
+        def admit():
+            if request.endpoint not in endpoints:
+                return None
+            reason = self.acquire()
+            if reason is not None:
+                return f'overloaded ({reason}), retry later', 503, {'Retry-After': str(self.retry_after())}
+            g.admitted_at = time.perf_counter()
+
+        @app.teardown_request
+        def release(exc):
+            if 'admitted_at' in g:
+                self.release(time.perf_counter() - g.pop('admitted_at'))
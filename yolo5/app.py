@@ -1,16 +1,44 @@
+from startup import Startup
+
+# Created first, so the startup breakdown covers the imports below too
+startup = Startup()
+
 import time
 from pathlib import Path
 from flask import Flask, request, jsonify
-from detect import run
+from admission import AdmissionController
+from batcher import MicroBatcher
+from pred_cache import PredictionCache, image_hash
+from history import PredictionHistory
+from local_cache import LocalCache
+from jobs import InProcessJobQueue, JobRunner, MongoJobQueue
+from video import FrameCounts, batched, sample_frames
+from mongo_writer import BulkWriter, ensure_indexes, with_write_concern
+from clients import S3_TRANSFER_CONFIG, http_session, http_timeout, s3_client
+import metrics
+from metrics import stage
+import cv2
+import io
+import numpy as np
+from PIL import Image, UnidentifiedImageError
 import uuid
 import yaml
 from loguru import logger
 import os
-import boto3
+import atexit
+import fcntl
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import signal
+import sys
+import tempfile
+import threading
 import logging
 from botocore.exceptions import ClientError
 import pymongo
 
+startup.mark('imports')
+
 # define bucket name
 BUCKET_NAME_FILE = os.environ['BUCKET_NAME_FILE']  # images_bucket = os.environ['BUCKET_NAME']
 with open(BUCKET_NAME_FILE, 'r') as file:
@@ -20,17 +48,223 @@ with open(BUCKET_NAME_FILE, 'r') as file:
 database_name = "mydb"
 collection_name = "predictions"
 mongodb_uri = f'mongodb://mongo1:27017,mongo2:27018,mongo3:27019/{database_name}?replicaSet=myReplicaSet'
-client = pymongo.MongoClient(mongodb_uri)
-db = client[database_name]
-collection = db[collection_name]
+MONGO_WRITE_CONCERN = os.environ.get('MONGO_WRITE_CONCERN', '')  # e.g. 1, majority. empty: the server default
+
+# Prediction summaries are buffered and written with insert_many off the request path
+MONGO_BULK_WRITES = os.environ.get('MONGO_BULK_WRITES', 'true').lower() == 'true'
+MONGO_BULK_MAX_BATCH = int(os.environ.get('MONGO_BULK_MAX_BATCH', 100))
+MONGO_BULK_FLUSH_INTERVAL = float(os.environ.get('MONGO_BULK_FLUSH_INTERVAL', 1.0))
+
+# Inference backend: pytorch, onnx or onnx-int8 (see `detector.BACKENDS`). The converted models are exported at
+# startup the first time and kept in MODEL_CACHE_DIR, mount it as a volume to keep them across restarts
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'pytorch').lower()
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', 'model_cache')
+
+# Opt-in micro-batching: concurrent requests arriving within the window share one forward pass
+BATCH_ENABLED = os.environ.get('BATCH_ENABLED', 'false').lower() == 'true'
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 8))
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 10))
+
+# Admission control of the prediction endpoints: at most ADMISSION_MAX_CONCURRENT run at once and
+# ADMISSION_MAX_QUEUE more wait, each at most ADMISSION_QUEUE_TIMEOUT seconds. The rest get a 503 right away, with a
+# Retry-After from the recent service times. Under prefork serving the limits are per worker, and gunicorn.conf.py
+# gives each worker enough request threads to hold all of these requests: the ones past the threads would wait in
+# gunicorn's own queue, unseen by the admission control.
+# A batch only fills with requests running at once: with micro-batching ADMISSION_MAX_CONCURRENT defaults to
+# BATCH_MAX_SIZE, and a lower value caps the batches at it (gunicorn.conf.py derives it the same way).
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', BATCH_MAX_SIZE if BATCH_ENABLED else 4))
+ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 16))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10))
+
+# Set by gunicorn.conf.py: the app is imported in the gunicorn master and served by forked workers
+PREFORK = os.environ.get('PREFORK', 'false').lower() == 'true'
+
+# Decode images much bigger than the model input at a reduced resolution
+DECODE_REDUCED = os.environ.get('DECODE_REDUCED', 'true').lower() == 'true'
+
+# Zero-disk mode: download, annotate and upload from memory, nothing is written under `photos/` or `static/data`
+PREDICT_IN_MEMORY = os.environ.get('PREDICT_IN_MEMORY', 'false').lower() == 'true'
+
+# Bounded local caches of the on-disk mode: S3 downloads under `photos/`, per-request annotated images and labels
+# under `static/data/`. Least recently used entries go first once over budget, unused ones after the TTL.
+# Under prefork serving each of the WEB_WORKERS workers has caches of its own, in `worker-<slot>` subdirectories,
+# with its share of the budgets (see `init_local_caches`): the budgets stay the totals of the container.
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1)) if PREFORK else 1
+PHOTO_CACHE_MAX_MB = float(os.environ.get('PHOTO_CACHE_MAX_MB', 1024))
+ARTIFACT_CACHE_MAX_MB = float(os.environ.get('ARTIFACT_CACHE_MAX_MB', 1024))
+LOCAL_CACHE_TTL = float(os.environ.get('LOCAL_CACHE_TTL', 24 * 3600))
+
+# Uploads of images received in the request body run here, after the response was sent. At most
+# ARCHIVE_MAX_PENDING of them wait or run at once, each holding its image in memory; past that the request
+# uploads its image itself, so a slow S3 slows the requests down instead of growing the backlog.
+ARCHIVE_WORKERS = int(os.environ.get('ARCHIVE_WORKERS', 4))
+ARCHIVE_MAX_PENDING = int(os.environ.get('ARCHIVE_MAX_PENDING', 64))
+archive_pool = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS, thread_name_prefix='s3-archive')
+archive_slots = threading.BoundedSemaphore(ARCHIVE_MAX_PENDING)
 
-with open("data/coco128.yaml", "r") as stream:
-    names = yaml.safe_load(stream)['names']
+# Multi-image requests (Telegram albums have up to 10 photos), and videos or GIFs: frames are sampled at
+# VIDEO_SAMPLE_FPS, up to VIDEO_MAX_FRAMES of them, and run through the model BATCH_MAX_SIZE at a time
+PREDICT_MAX_IMAGES = int(os.environ.get('PREDICT_MAX_IMAGES', 10))
+VIDEO_SAMPLE_FPS = float(os.environ.get('VIDEO_SAMPLE_FPS', 2))
+VIDEO_MAX_FRAMES = int(os.environ.get('VIDEO_MAX_FRAMES', 120))
+VIDEO_MAX_MB = float(os.environ.get('VIDEO_MAX_MB', 50))
 
-# Initialize the S3 client
-s3 = boto3.client('s3')
+# Content-addressed prediction cache: in-process LRU first, then the `predictions` collection. Each process checks
+# every PRED_CACHE_SYNC_INTERVAL seconds whether another one was told to invalidate it.
+PRED_CACHE_SIZE = int(os.environ.get('PRED_CACHE_SIZE', 1024))
+PRED_CACHE_TTL = float(os.environ.get('PRED_CACHE_TTL', 3600))
+PRED_CACHE_SYNC_INTERVAL = float(os.environ.get('PRED_CACHE_SYNC_INTERVAL', 1.0))
+
+# Prediction history reads: stats are cached for a few seconds and read from secondaries when there are any
+HISTORY_STATS_TTL = float(os.environ.get('HISTORY_STATS_TTL', 30))
+HISTORY_READ_SECONDARY = os.environ.get('HISTORY_READ_SECONDARY', 'true').lower() == 'true'
+
+# Asynchronous detection jobs: POST /jobs enqueues, a pool of workers runs the predictions. Prefork workers share
+# the mongo queue: a job submitted to one worker may be polled on another (gunicorn.conf.py refuses `memory` then).
+JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'mongo' if PREFORK else 'memory')  # memory | mongo
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_CALLBACK_TIMEOUT = float(os.environ.get('JOB_CALLBACK_TIMEOUT', 10))  # read timeout of the callbackUrl POSTs
+# Seconds after which a job a dead worker left `running` in the mongo queue is run again
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 300))
+
+# Set up by the startup steps below, the endpoints using them answer 503 until they all ran
+client = db = collection = mongo_writer = None
+photo_cache = artifact_cache = None
+worker_slot_locks = []
+names = None
+s3 = None
+detector = batcher = None
+prediction_cache = prediction_history = None
+job_queue = job_runner = None
 
 app = Flask(__name__)
+metrics.instrument(app)  # per-request counters and GET /metrics
+startup.add_probes(app)  # GET /healthz and /readyz
+admission = None
+if ADMISSION_ENABLED:
+    if BATCH_ENABLED and ADMISSION_MAX_CONCURRENT < BATCH_MAX_SIZE:
+        logger.warning(f'ADMISSION_MAX_CONCURRENT={ADMISSION_MAX_CONCURRENT} lets batches of at most '
+                       f'{ADMISSION_MAX_CONCURRENT} images form, not BATCH_MAX_SIZE={BATCH_MAX_SIZE}')
+    admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+    admission.protect(app, {'predict', 'predict_image', 'predict_images', 'predict_video'})
+
+
+def init_mongo():
+    global client, db, collection, mongo_writer
+    client = pymongo.MongoClient(mongodb_uri)
+    db = client[database_name]
+    collection = with_write_concern(db[collection_name], MONGO_WRITE_CONCERN)
+    ensure_indexes(collection)  # the first round trip, waits for the replica set
+    mongo_writer = BulkWriter(collection, MONGO_BULK_MAX_BATCH, MONGO_BULK_FLUSH_INTERVAL) if MONGO_BULK_WRITES else None
+    if mongo_writer:
+        atexit.register(mongo_writer.close)  # flush what is still buffered on shutdown
+
+
+def init_local_caches():
+    global photo_cache, artifact_cache
+    photos_root, artifacts_root = Path('photos'), Path('static/data')
+    if PREFORK:
+        # A `LocalCache` only accounts for its own process: workers sharing a directory would adopt and evict
+        # each other's entries and each fill the whole budget
+        slot = claim_worker_slot(photos_root)
+        photos_root, artifacts_root = photos_root / f'worker-{slot}', artifacts_root / f'worker-{slot}'
+    photo_cache = LocalCache(photos_root, PHOTO_CACHE_MAX_MB * 1024 * 1024 / WEB_WORKERS, LOCAL_CACHE_TTL)
+    artifact_cache = LocalCache(artifacts_root, ARTIFACT_CACHE_MAX_MB * 1024 * 1024 / WEB_WORKERS, LOCAL_CACHE_TTL)
+
+
+def claim_worker_slot(lock_dir):
+    """
+    :return: the lowest slot number no other live worker holds, held by this process until it exits. The slot
+        is an flock on `lock_dir/worker-<slot>.lock`, released by the OS with the process: a worker replacing a
+        dead one takes its slot, and the cache entries the dead one left there.
+    """
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    slot = 0
+    while True:
+        lock_file = open(lock_dir / f'worker-{slot}.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:  # a live worker has it
+            lock_file.close()
+            slot += 1
+            continue
+        worker_slot_locks.append(lock_file)  # kept open, closing it would release the slot
+        return slot
+
+
+def init_names():
+    global names
+    with open("data/coco128.yaml", "r") as stream:
+        names = yaml.safe_load(stream)['names']
+
+
+def init_s3():
+    # The S3 client is shared by every request thread and background worker
+    global s3
+    s3 = s3_client()
+
+
+def init_model(warmup=True):
+    # torch and the yolov5 code are only imported here, off the main thread, while the probes already answer
+    from detector import Detector
+
+    # Load the model once, every request is served by the same warmed-up detector
+    global detector
+    detector = Detector(weights='yolov5s.pt', data='data/coco128.yaml', backend=MODEL_BACKEND,
+                        cache_dir=MODEL_CACHE_DIR, warmup=warmup)
+
+
+def preload_model():
+    # Loads the weights in the gunicorn master, for the prefork workers to share them copy-on-write. Nothing runs
+    # the model here, and torch is held to one thread while loading: an OpenMP thread pool started before the fork
+    # does not exist in the workers and hangs their first inference. Each worker warms the model up after the
+    # fork instead (`warm_up_model`), with the thread count gunicorn.conf.py gives it.
+    import torch
+
+    torch.set_num_threads(1)
+    init_model(warmup=False)
+
+
+def warm_up_model():
+    detector.warmup()
+
+
+def prepare_model():
+    # Exports the converted model once, before the prefork workers are forked, so they only load it. The export
+    # runs torch in a separate process: the OpenMP threads it starts would not survive the fork.
+    from detector import prepare_weights
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pool.submit(prepare_weights, 'yolov5s.pt', MODEL_BACKEND, 640, 'data/coco128.yaml', MODEL_CACHE_DIR).result()
+
+
+def init_batcher():
+    global batcher
+    if BATCH_ENABLED:
+        detector.warmup(BATCH_MAX_SIZE)  # full batches letterbox to another input shape than single images
+        batcher = MicroBatcher(detector.detect_batch, BATCH_MAX_SIZE, BATCH_WINDOW_MS)
+
+
+def init_prediction_cache():
+    global prediction_cache
+    prediction_cache = PredictionCache(collection, detector.version, PRED_CACHE_SIZE, PRED_CACHE_TTL,
+                                       db['cache_state'], PRED_CACHE_SYNC_INTERVAL)
+
+
+def init_history():
+    global prediction_history
+    history_collection = collection
+    if HISTORY_READ_SECONDARY:
+        history_collection = collection.with_options(read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED)
+    prediction_history = PredictionHistory(history_collection, HISTORY_STATS_TTL)
+
+
+def init_jobs():
+    global job_queue, job_runner
+    job_queue = MongoJobQueue(db['jobs'], lease=JOB_LEASE) if JOB_QUEUE_BACKEND == 'mongo' else InProcessJobQueue()
+    job_runner = JobRunner(job_queue, run_prediction_job, JOB_WORKERS, http_session(),
+                           http_timeout(JOB_CALLBACK_TIMEOUT))
 
 
 def upload_file(file_name, bucket, object_name=None):
@@ -47,98 +281,560 @@ def upload_file(file_name, bucket, object_name=None):
         object_name = os.path.basename(file_name)
 
     # Upload the file
-    s3_client = boto3.client('s3')
     try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
+        with stage('s3_upload'):
+            response = s3.upload_file(file_name, bucket, object_name, Config=S3_TRANSFER_CONFIG)
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    # Generates a UUID for this current prediction HTTP request. This id can be used as a reference in logs to
+class NotAnImage(ValueError):
+    """The bytes given as an image are not in a format the decoders read"""
+
+
+def decode_image(img_bytes):
+    """
+    Decodes an image to BGR like `cv2.imread`. Big images are decoded at 1/2, 1/4 or 1/8 scale (for JPEGs the
+    decoder itself skips the detail) as long as the longest side stays at or above the model input size.
+    Labels are normalized to the decoded image, so they are the same as for the full-resolution one.
+
+    :raise NotAnImage: if the bytes cannot be decoded
+    """
+    flags = cv2.IMREAD_COLOR
+    if DECODE_REDUCED:
+        try:
+            longest_side = max(Image.open(io.BytesIO(img_bytes)).size)  # only reads the header
+        except UnidentifiedImageError:
+            raise NotAnImage('not an image') from None
+        for factor, reduced_flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                      (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if longest_side / factor >= max(detector.imgsz):
+                flags = reduced_flags
+                break
+    with stage('decode'):
+        im0 = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), flags)
+    if im0 is None:
+        raise NotAnImage('not an image')
+    return im0
+
+
+def to_labels(rows):
+    """Converts (cls, cx, cy, width, height, conf) rows to the label dicts stored in the prediction summary"""
+    return [{
+        'class': names[int(cls)],
+        'cx': float(cx),
+        'cy': float(cy),
+        'width': float(width),
+        'height': float(height),
+        'confidence': float(conf),
+    } for cls, cx, cy, width, height, conf in rows]
+
+
+def detect(im0):
+    """Runs the model on a decoded image, through the micro-batcher when it is enabled"""
+    with stage('inference'):
+        return batcher.submit(im0).result() if batcher else detector.detect(im0)
+
+
+def predicted_s3_path(img_name):
+    """The predicted image is uploaded next to the original one, with a `predicted_` prefix"""
+    filename = img_name.split('/')[-1]
+    return '/'.join(img_name.split('/')[:-1]) + f'/predicted_{filename}'
+
+
+def photo_key(img_name, etag):
+    """
+    Local cache key of a version of an image of the bucket: an object overwritten under the same key has another
+    ETag, so it is another entry and the old bytes are never served for it
+    """
+    return f'{images_bucket}/{img_name}@{etag}'
+
+
+def predict_on_disk(prediction_id, img_name, img_bytes, photo_cache_key):
+    """
+    Keeps the downloaded image in the local photo cache, writes the annotated image and labels to a directory of
+    the local artifact cache and uploads the annotated image to S3. Both caches are bounded (see `LocalCache`).
+
+    :param photo_cache_key: key of the image in the photo cache, see `photo_key`
+    :return: (labels or None if nothing was detected, original_img_path, predicted_img_path)
+    """
+    filename = img_name.split('/')[-1]  # Get the filename alone as srt
+    suffix = Path(filename).suffix
+    original_img_path = str(photo_cache.lookup(photo_cache_key, suffix)
+                            or photo_cache.put(photo_cache_key, img_bytes, suffix))
+
+    # Predicts the objects in the image, writes the annotated image and the labels the same way `detect.run()` did
+    im0 = decode_image(img_bytes)
+    det = detect(im0)
+    save_dir = artifact_cache.path(prediction_id)  # one directory per request, named after its unique id
+    try:
+        (save_dir / 'labels').mkdir(parents=True, exist_ok=True)
+        with stage('annotate'):
+            cv2.imwrite(str(save_dir / filename), detector.annotate(im0, det))
+        if len(det):
+            with open(save_dir / 'labels' / f'{Path(filename).stem}.txt', 'w') as f:
+                for line in detector.labels(det, im0.shape):
+                    f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+        logger.info(f'prediction: {prediction_id}, path: {original_img_path}. done')
+
+        # This is the path for the predicted image with labels The predicted image typically includes bounding boxes
+        # drawn around the detected objects, along with class labels and possibly confidence scores.
+        predicted_img_path = str(save_dir / filename)
+        # Uploads the predicted image next to the original one, with a `predicted_` prefix
+        upload_response = upload_file(predicted_img_path, images_bucket, predicted_s3_path(img_name))
+        if not upload_response:
+            raise ClientError
+
+        # Parse prediction labels
+        pred_summary_path = save_dir / 'labels' / f'{Path(filename).stem}.txt'
+        logger.info(f'prediction: {prediction_id}, sum path: {pred_summary_path}. done')
+        if not pred_summary_path.exists():
+            return None, original_img_path, predicted_img_path
+
+        with stage('label_parse'), open(pred_summary_path) as f:
+            labels = to_labels(line.split(' ') for line in f.read().splitlines())
+        return labels, original_img_path, predicted_img_path
+    finally:
+        artifact_cache.add(prediction_id)  # counted in the cache budget from now on, evicted when least used
+
+
+def upload_bytes(data, key):
+    """Uploads an in-memory file to the images bucket"""
+    with stage('s3_upload'):
+        s3.upload_fileobj(io.BytesIO(data), images_bucket, key, Config=S3_TRANSFER_CONFIG)
+
+
+def archive_in_background(data, key):
+    """
+    Uploads an in-memory file to the images bucket from the archive pool, off the request path, or right away
+    when ARCHIVE_MAX_PENDING uploads are already pending. A failed upload is logged, never raised.
+    """
+    if not archive_slots.acquire(blocking=False):
+        logger.warning(f'archive backlog full ({ARCHIVE_MAX_PENDING} uploads), uploading {key} in the request')
+        try:
+            upload_bytes(data, key)
+        except Exception as e:
+            logger.error(f'archive of {key} to {images_bucket} failed: {e}')
+        return
+
+    def done(future):
+        archive_slots.release()
+        metrics.ARCHIVE_PENDING.dec()
+        if future.exception() is not None:
+            logger.error(f'archive of {key} to {images_bucket} failed: {future.exception()}')
+
+    metrics.ARCHIVE_PENDING.inc()
+    archive_pool.submit(upload_bytes, data, key).add_done_callback(done)
+
+
+def detect_many(im0s):
+    """Runs the model on several decoded images, in batches of up to BATCH_MAX_SIZE"""
+    dets = []
+    for batch in batched(im0s, BATCH_MAX_SIZE):
+        with stage('inference'):
+            dets += detector.detect_batch(batch)
+    return dets
+
+
+def predict_in_memory(prediction_id, img_name, img_bytes, upload=upload_bytes, detected=None):
+    """
+    Same as `predict_on_disk` without touching the local disk: the image is decoded from memory, the labels
+    come straight from the model output and the annotated image is encoded and uploaded from a buffer.
+
+    :param upload: function(data, key) that stores the annotated image
+    :param detected: (decoded image, detections) when the model already ran on the image, e.g. in a batch
+    :return: (labels or None if nothing was detected, original_img_path, predicted_img_path), both paths are S3 keys
+    """
+    if detected is None:
+        im0 = decode_image(img_bytes)
+        det = detect(im0)
+    else:
+        im0, det = detected
+    logger.info(f'prediction: {prediction_id}, key: {img_name}. done')
+
+    predicted_img_path = predicted_s3_path(img_name)
+    with stage('annotate'):
+        ok, encoded = cv2.imencode(Path(img_name).suffix or '.jpg', detector.annotate(im0, det))
+    if not ok:
+        raise RuntimeError(f'prediction: {prediction_id}. could not encode the predicted image')
+    upload(encoded.tobytes(), predicted_img_path)
+
+    if not len(det):
+        return None, img_name, predicted_img_path
+    with stage('label_parse'):
+        labels = to_labels(detector.labels(det, im0.shape))
+    return labels, img_name, predicted_img_path
+
+
+def run_prediction(img_name, chat_id=None):
+    """
+    Predicts the objects in the S3 image `img_name` and stores the summary in MongoDB
+
+    :param chat_id: Telegram chat the prediction was requested from, stored with the summary for its history
+
+    :return: (response body, http status), the body is the prediction summary on success
+    """
+    # Generates a UUID for this current prediction. This id can be used as a reference in logs to
     # identify and track individual prediction requests.
     prediction_id = str(uuid.uuid4())
 
     logger.info(f'prediction: {prediction_id}. start processing')
 
-    # Receives a URL parameter representing the image to download from S3
-    img_name = request.args.get('imgName')
+    # A recent image is read from the local photo cache instead of S3. The cache is keyed by the object's ETag,
+    # a HEAD request away, so an image overwritten in the bucket is downloaded again rather than served stale.
+    suffix = Path(img_name).suffix
+    img_bytes = cache_key = None
+    if not PREDICT_IN_MEMORY:
+        with stage('s3_head'):
+            cache_key = photo_key(img_name, s3.head_object(Bucket=images_bucket, Key=img_name)['ETag'])
+        img_bytes = photo_cache.get(cache_key, suffix)
+    if img_bytes is not None:
+        logger.info(f'prediction id: {prediction_id}, key: \"{img_name}\" read from the local cache')
+    else:
+        with stage('s3_download'):
+            s3_object = s3.get_object(Bucket=images_bucket, Key=img_name)
+            img_bytes = s3_object['Body'].read()
+        logger.info(f'prediction id: {prediction_id}, key: \"{img_name}\" Download img completed')
+        if not PREDICT_IN_MEMORY:
+            cache_key = photo_key(img_name, s3_object['ETag'])  # it may have been overwritten since the HEAD
+            photo_cache.put(cache_key, img_bytes, suffix)
 
-    # TODO download img_name from S3, store the local image path in original_img_path
-    #  The bucket name should be provided as an env var BUCKET_NAME.
-    filename = img_name.split('/')[-1]  # Get the filename alone as srt
-    local_dir = 'photos/'  # str of dir to save to
-    os.makedirs(local_dir, exist_ok=True)  # make sure the dir exists
-    original_img_path = local_dir + filename  # assign the full path of the file to download
-    s3.download_file(images_bucket, img_name, original_img_path)  # download the file
-
-    logger.info(f'prediction id: {prediction_id}, path: \"{original_img_path}\" Download img completed')
-
-    # Predicts the objects in the image
-    run(
-        weights='yolov5s.pt',
-        data='data/coco128.yaml',
-        source=original_img_path,
-        project='static/data',
-        name=prediction_id,
-        save_txt=True
-    )
-
-    logger.info(f'prediction: {prediction_id}, path: {original_img_path}. done')
-
-    # This is the path for the predicted image with labels The predicted image typically includes bounding boxes
-    # drawn around the detected objects, along with class labels and possibly confidence scores.
-    predicted_img_path = f'static/data/{prediction_id}/{filename}'  # predicted_img_path = Path(f'static/data/{prediction_id}/{filename}')  # get the result path
-    # TODO Uploads the predicted image (predicted_img_path) to S3 (be careful not to override the original image).
-    predicted_img_name = f'predicted_{filename}'  # assign the new name
-    os.rename(f'/usr/src/app/static/data/{prediction_id}/{filename}',
-              f'/usr/src/app/static/data/{prediction_id}/{predicted_img_name}')  # rename the file before upload
-    s3_path_to_upload_to = '/'.join(img_name.split('/')[:-1]) + f'/{predicted_img_name}'  # assign the path on s3 as str
-    file_to_upload = f'/usr/src/app/static/data/{prediction_id}/{predicted_img_name}'  # assign the path locally as str
-    upload_response = upload_file(file_to_upload, images_bucket, s3_path_to_upload_to)  # upload the file to same path with new name s3
-    if not upload_response:
-        raise ClientError
-    os.rename(f'/usr/src/app/static/data/{prediction_id}/{predicted_img_name}',
-              f'/usr/src/app/static/data/{prediction_id}/{filename}')  # rename the file back after upload
-
-    # Parse prediction labels and create a summary
-    filename_no_ext = filename.split('.')[0]
-    pred_summary_path = Path(f'static/data/{prediction_id}/labels/{filename_no_ext}.txt')
-    logger.info(f'prediction: {prediction_id}, sum path: static/data/{prediction_id}/labels/{filename_no_ext}.txt. done')
-    if pred_summary_path.exists():
-        with open(pred_summary_path) as f:
-            labels = f.read().splitlines()
-            labels = [line.split(' ') for line in labels]
-            labels = [{
-                'class': names[int(l[0])],
-                'cx': float(l[1]),
-                'cy': float(l[2]),
-                'width': float(l[3]),
-                'height': float(l[4]),
-            } for l in labels]
-
-        logger.info(f'prediction: {prediction_id}/{original_img_path}. prediction summary:\n\n{labels}')
-
-        prediction_summary = {
-            'prediction_id': prediction_id,
-            'original_img_path': original_img_path,
-            'predicted_img_path': predicted_img_path,
-            'labels': labels,
-            'time': time.time()
-        }
-
-        logger.info(f'prediction: {prediction_id}/{original_img_path}. created prediction summery')
-        insert_id = collection.insert_one(prediction_summary)  # TODO store the prediction_summary in MongoDB
+    return summarize_prediction(prediction_id, img_name, img_bytes, chat_id=chat_id, photo_cache_key=cache_key)
+
+
+def store_summary(prediction_summary):
+    """Writes a prediction summary to MongoDB, through the bulk writer when it is enabled"""
+    prediction_id = prediction_summary['prediction_id']
+    original_img_path = prediction_summary['original_img_path']
+    if mongo_writer:
+        mongo_writer.write(dict(prediction_summary))  # a copy, insert_many adds the `_id` to the document
+        logger.info(f'prediction: {prediction_id}/{original_img_path}. queued for the mongodb cluster')
+    else:
+        with stage('mongo_insert'):
+            insert_id = collection.insert_one(prediction_summary)
         logger.info(f'prediction: {prediction_id}/{original_img_path}. written to mongodb cluster. ID:{insert_id}')
         prediction_summary.pop('_id')
-        logger.info(f'prediction: {prediction_id}/{original_img_path}. current pred_sum: {prediction_summary}')
-        return prediction_summary
+
+
+def summarize_prediction(prediction_id, img_name, img_bytes, archive=False, chat_id=None, photo_cache_key=None):
+    """
+    Predicts the objects in an image already in memory and stores the summary in MongoDB
+
+    :param img_name: S3 key of the image
+    :param archive: the image is not in S3 yet; upload it and the annotated image in the background
+    :param chat_id: Telegram chat the prediction was requested from
+    :param photo_cache_key: key of the downloaded image in the photo cache, when it is kept on disk
+    :return: (response body, http status), the body is the prediction summary on success
+    """
+    # The same image bytes with the same model always give the same prediction
+    img_hash = image_hash(img_bytes)
+    cached_summary = cached_prediction(prediction_id, img_hash, chat_id)
+    if cached_summary is not None:
+        return cached_summary, 200
+    try:
+        return new_prediction(prediction_id, img_name, img_bytes, img_hash, archive, chat_id,
+                              photo_cache_key=photo_cache_key)
+    except NotAnImage as e:
+        logger.info(f'prediction: {prediction_id}/{img_name}. {e}')
+        return f'{img_name}: {e}', 400
+
+
+def cached_prediction(prediction_id, img_hash, chat_id=None):
+    """
+    :return: the summary of a previous prediction of the same image, stored again as prediction `prediction_id`,
+        or None on a cache miss
+    """
+    cached_summary = cache_lookup(img_hash)
+    return None if cached_summary is None else store_cache_hit(prediction_id, img_hash, cached_summary, chat_id)
+
+
+def cache_lookup(img_hash):
+    """:return: the cached summary of a previous prediction of the same image, or None on a cache miss"""
+    cached_summary = prediction_cache.get(img_hash)
+    (metrics.CACHE_MISSES if cached_summary is None else metrics.CACHE_HITS).inc()
+    return cached_summary
+
+
+def store_cache_hit(prediction_id, img_hash, cached_summary, chat_id=None):
+    """:return: `cached_summary` stored again as prediction `prediction_id`"""
+    logger.info(f'prediction: {prediction_id}. cache hit for {img_hash}, '
+                f'returning prediction {cached_summary["prediction_id"]}')
+    # The request still goes into the history, under its own id and chat, with the cached labels
+    prediction_summary = dict(cached_summary, prediction_id=prediction_id, chat_id=chat_id, time=time.time(),
+                              cached_from=cached_summary.get('cached_from', cached_summary['prediction_id']))
+    store_summary(prediction_summary)
+    return prediction_summary
+
+
+def new_prediction(prediction_id, img_name, img_bytes, img_hash, archive=False, chat_id=None, detected=None,
+                   photo_cache_key=None):
+    """
+    The cache miss path of `summarize_prediction`
+
+    :param detected: (decoded image, detections) when the model already ran on the image, only with `archive`
+    :param photo_cache_key: key of the image in the photo cache, for an S3 image predicted on disk
+    """
+    if archive:
+        labels, original_img_path, predicted_img_path = predict_in_memory(prediction_id, img_name, img_bytes,
+                                                                          upload=archive_in_background,
+                                                                          detected=detected)
+        archive_in_background(img_bytes, img_name)  # once decoded, bytes that are not an image are not archived
+    elif PREDICT_IN_MEMORY:
+        labels, original_img_path, predicted_img_path = predict_in_memory(prediction_id, img_name, img_bytes)
     else:
+        labels, original_img_path, predicted_img_path = predict_on_disk(prediction_id, img_name, img_bytes,
+                                                                        photo_cache_key)
+
+    if labels is None:
         return f'prediction: {prediction_id}/{original_img_path}. prediction result not found', 404
 
+    logger.info(f'prediction: {prediction_id}/{original_img_path}. prediction summary:\n\n{labels}')
+
+    prediction_summary = {
+        'prediction_id': prediction_id,
+        'original_img_path': original_img_path,
+        'predicted_img_path': predicted_img_path,
+        'labels': labels,
+        'time': time.time(),
+        'image_hash': img_hash,
+        'model_version': detector.version,
+        'chat_id': chat_id,
+    }
+
+    logger.info(f'prediction: {prediction_id}/{original_img_path}. created prediction summery')
+    store_summary(prediction_summary)
+    prediction_cache.put(img_hash, prediction_summary)
+    logger.info(f'prediction: {prediction_id}/{original_img_path}. current pred_sum: {prediction_summary}')
+    return prediction_summary, 200
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    # Receives a URL parameter representing the image to download from S3
+    img_name = request.args.get('imgName')
+    return run_prediction(img_name, request.args.get('chatId', type=int))
+
+
+@app.route('/predict/image', methods=['POST'])
+def predict_image():
+    # The image comes in the request body, as a multipart `image` file or as the raw body.
+    # `name` is the S3 key it is archived under, together with the annotated image, after the response.
+    prediction_id = str(uuid.uuid4())
+    logger.info(f'prediction: {prediction_id}. start processing')
+
+    if 'image' in request.files:
+        upload = request.files['image']
+        img_bytes = upload.read()
+        default_name = f'uploads/{prediction_id}{Path(upload.filename or "").suffix or ".jpg"}'
+    else:
+        img_bytes = request.get_data()
+        default_name = f'uploads/{prediction_id}.jpg'
+    if not img_bytes:
+        return 'image bytes are required, as a multipart "image" file or as the request body', 400
+
+    img_name = request.args.get('name') or default_name
+    return summarize_prediction(prediction_id, img_name, img_bytes, archive=True,
+                                chat_id=request.args.get('chatId', type=int))
+
+
+@app.route('/predict/images', methods=['POST'])
+def predict_images():
+    # Several images in one request, e.g. a Telegram album, as multipart `images` files. They are archived to S3
+    # under the `name` arguments, in the same order, after the response. The images missing from the prediction
+    # cache go through the model together, in batches.
+    uploads = request.files.getlist('images')
+    if not uploads:
+        return 'images are required, as multipart "images" files', 400
+    if len(uploads) > PREDICT_MAX_IMAGES:
+        return f'at most {PREDICT_MAX_IMAGES} images per request', 400
+    chat_id = request.args.get('chatId', type=int)
+    img_names = request.args.getlist('name')
+
+    items = []
+    for i, upload in enumerate(uploads):
+        prediction_id = str(uuid.uuid4())
+        img_bytes = upload.read()
+        if not img_bytes:
+            return f'image {i} is empty', 400
+        default_name = f'uploads/{prediction_id}{Path(upload.filename or "").suffix or ".jpg"}'
+        items.append((prediction_id, img_names[i] if i < len(img_names) else default_name, img_bytes,
+                      image_hash(img_bytes)))
+    logger.info(f'predictions: {", ".join(item[0] for item in items)}. start processing')
+
+    # Every entry is checked before anything goes into the history, a bad image answers 400 without leaving the
+    # entries before it stored. A cache hit was decoded fine before, only the misses need decoding.
+    cached = [cache_lookup(img_hash) for *_, img_hash in items]
+    misses = [i for i, cached_summary in enumerate(cached) if cached_summary is None]
+    im0s = []
+    for i in misses:
+        try:
+            im0s.append(decode_image(items[i][2]))
+        except NotAnImage as e:
+            return f'image {i}: {e}', 400
+    summaries = [None if cached_summary is None else store_cache_hit(prediction_id, img_hash, cached_summary, chat_id)
+                 for (prediction_id, _, _, img_hash), cached_summary in zip(items, cached)]
+    for i, im0, det in zip(misses, im0s, detect_many(im0s)):
+        prediction_id, img_name, img_bytes, img_hash = items[i]
+        summary, status = new_prediction(prediction_id, img_name, img_bytes, img_hash, archive=True, chat_id=chat_id,
+                                         detected=(im0, det))
+        # Nothing detected: an entry without labels, so the answer still has one entry per image
+        summaries[i] = summary if status == 200 else {'prediction_id': prediction_id, 'original_img_path': img_name,
+                                                      'labels': []}
+    return jsonify({'predictions': summaries})
+
+
+@app.route('/predict/video', methods=['POST'])
+def predict_video():
+    # A video or an animated GIF in the request body. The decoder needs a file, so the body is spooled to a
+    # temporary one; the frames are then streamed: sampled (sampleFps, maxFrames), run through the model in
+    # batches and counted, a batch at a time. Answers the per-class counts across the sampled frames.
+    sample_fps = request.args.get('sampleFps', VIDEO_SAMPLE_FPS, type=float)
+    max_frames = min(request.args.get('maxFrames', VIDEO_MAX_FRAMES, type=int), VIDEO_MAX_FRAMES)
+    if not sample_fps > 0 or max_frames <= 0:
+        return 'sampleFps and maxFrames must be positive numbers', 400
+    max_bytes = VIDEO_MAX_MB * 1024 * 1024
+    if request.content_length and request.content_length > max_bytes:
+        return f'videos are limited to {VIDEO_MAX_MB:g} MB', 413
+
+    with tempfile.NamedTemporaryFile(suffix=Path(request.args.get('name', '')).suffix or '.mp4') as video_file:
+        size = 0
+        for chunk in iter(lambda: request.stream.read(1 << 20), b''):
+            size += len(chunk)
+            if size > max_bytes:
+                return f'videos are limited to {VIDEO_MAX_MB:g} MB', 413
+            video_file.write(chunk)
+        if not size:
+            return 'video bytes are required in the request body', 400
+        video_file.flush()
+
+        counts = FrameCounts(names)
+        try:
+            for batch in batched(sample_frames(video_file.name, sample_fps, max_frames), BATCH_MAX_SIZE):
+                with stage('inference'):
+                    dets = detector.detect_batch([frame for _, _, frame in batch])
+                for det in dets:
+                    counts.add(det)
+        except ValueError as e:
+            return str(e), 400
+
+    logger.info(f'video of {size} bytes: {counts.frames} frames sampled at {sample_fps:g} fps')
+    return jsonify({'frames': counts.frames, 'sample_fps': sample_fps, 'classes': counts.summary()})
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    # Same input as /predict, but returns right away; the result is polled from /jobs/<job_id> or POSTed to callbackUrl
+    img_name = request.args.get('imgName')
+    if not img_name:
+        return 'imgName is required', 400
+    job = job_runner.submit({'img_name': img_name, 'chat_id': request.args.get('chatId', type=int)},
+                            request.args.get('callbackUrl'))
+    return jsonify({'job_id': job['job_id'], 'status': job['status']}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.status(job_id)
+    if job is None:
+        return f'job: {job_id} not found', 404
+    return jsonify(job)
+
+
+@app.route('/admission/stats', methods=['GET'])
+def admission_stats():
+    # Slots in use, waiting requests, rejections and the service time the Retry-After is based on
+    return jsonify(admission.stats() if admission else {'enabled': False})
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(prediction_cache.stats())
+
+
+@app.route('/cache/local', methods=['GET'])
+def local_cache_stats():
+    # Under prefork serving, the caches of the worker answering
+    return jsonify({'photos': photo_cache.stats(), 'artifacts': artifact_cache.stats()})
+
+
+@app.route('/cache/invalidate', methods=['POST'])
+def cache_invalidate():
+    # Drops the in-process summaries, e.g. after predictions were deleted or corrected in Mongo, in every worker
+    # (within PRED_CACHE_SYNC_INTERVAL). Replaced weights need no call: they are loaded at startup, with a new model
+    # version the previous summaries never match.
+    prediction_cache.invalidate()
+    logger.info(f'prediction cache invalidated, generation {prediction_cache.generation}, '
+                f'model version: {prediction_cache.model_version}')
+    return jsonify(prediction_cache.stats())
+
+
+@app.route('/predictions', methods=['GET'])
+def list_predictions():
+    # Recent predictions, newest first, of one chat (chatId) or of every chat. `fields` is a comma separated
+    # projection; the next page is fetched with the returned `next_cursor` as `cursor`.
+    fields = request.args.get('fields')
+    try:
+        summaries, next_cursor = prediction_history.recent(
+            chat_id=request.args.get('chatId', type=int),
+            limit=request.args.get('limit', 20, type=int),
+            cursor=request.args.get('cursor'),
+            fields=fields.split(',') if fields else None,
+        )
+    except ValueError as e:
+        return str(e), 400
+    return jsonify({'predictions': summaries, 'next_cursor': next_cursor})
+
+
+@app.route('/predictions/stats', methods=['GET'])
+def prediction_stats():
+    # Class frequencies of the predictions of the last `window` seconds, of one chat (chatId) or of every chat
+    return jsonify(prediction_history.class_stats(
+        chat_id=request.args.get('chatId', type=int),
+        window=request.args.get('window', 86400, type=int),
+        top=request.args.get('top', 10, type=int),
+    ))
+
+
+def run_prediction_job(payload):
+    return run_prediction(payload['img_name'], payload.get('chat_id'))
+
+
+# Steps starting threads or opening connections (Mongo, S3, the cache sweepers, the batcher and job workers):
+# none of these survive a fork, under prefork serving they run in every worker after it was forked
+WORKER_STEPS = {'mongo': init_mongo, 's3': init_s3, 'local_caches': init_local_caches}
+FINAL_STEPS = {'prediction_cache': init_prediction_cache, 'history': init_history, 'jobs': init_jobs,
+               'batcher': init_batcher}
+
+if not PREFORK:
+    # Independent steps run in parallel: the model load and warm-up overlap the Mongo, S3 and label setup.
+    # The service is ready, and /readyz answers 200, once every step is done.
+    startup.start({'labels': init_names, 'model': init_model, **WORKER_STEPS}, FINAL_STEPS)
+elif MODEL_BACKEND == 'pytorch':
+    # The weights are loaded once in the gunicorn master, without a forward pass (see `preload_model`), the
+    # workers share them copy-on-write and each warms the model up
+    if not startup.run({'labels': init_names, 'model': preload_model}, ready=False):
+        raise RuntimeError('yolo5 startup failed, see the log above')
+    WORKER_STEPS['model_warmup'] = warm_up_model
+else:
+    # An ONNX Runtime session owns a thread pool, which does not survive a fork: the master only converts the
+    # model, every worker loads it
+    if not startup.run({'labels': init_names, 'model_export': prepare_model}, ready=False):
+        raise RuntimeError('yolo5 startup failed, see the log above')
+    WORKER_STEPS['model'] = init_model
+
+
+def init_worker():
+    """
+    Finishes the startup in a prefork worker, called by gunicorn right after the fork (see gunicorn.conf.py).
+    The worker answers the probes meanwhile and becomes ready once its steps are done.
+    """
+    startup.start(WORKER_STEPS, FINAL_STEPS)
+
 
 if __name__ == "__main__":
+    # Exit through atexit on `docker stop` so the buffered predictions are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host='0.0.0.0', port=8081)
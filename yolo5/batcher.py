@@ -0,0 +1,62 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from loguru import logger
+
+
+class MicroBatcher:
+    """
+    Collects single-item requests coming from concurrent HTTP handlers and runs them as one batch.
+
+    The first request that arrives opens a window of `window_ms`; everything submitted before the window
+    closes (up to `max_batch_size` items) goes into the same call to `batch_fn`. Each caller gets a
+    `Future` that resolves to its own result, so the extra latency is bounded by the window.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, window_ms=10):
+        """
+        :param batch_fn: callable that takes a list of inputs and returns a list of results in the same order
+        :param max_batch_size: maximum number of requests per batch
+        :param window_ms: how long to wait for more requests after the first one arrives
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queues an item for the next batch and returns a `Future` of its result"""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = self.batch_fn(items)
+            except Exception as e:
+                logger.exception(f'micro-batcher: batch of {len(batch)} failed')
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,205 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from loguru import logger
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_boxes, xyxy2xywh
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
+
+
+# Inference backends: the PyTorch weights as they are, the same model exported to ONNX and run by ONNX Runtime,
+# and that ONNX model with its weights dynamically quantized to int8
+BACKENDS = ('pytorch', 'onnx', 'onnx-int8')
+
+
+def model_version(weights, backend='pytorch'):
+    """
+    Identifies a weights file by its name and content, and the backend running it, so cached predictions of other
+    weights, or of a converted model whose outputs differ slightly, are not reused
+    """
+    digest = hashlib.sha256()
+    with open(weights, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    version = f'{Path(weights).name}:{digest.hexdigest()[:12]}'
+    return version if backend == 'pytorch' else f'{version}+{backend}'
+
+
+def prepare_weights(weights, backend='pytorch', imgsz=640, data='data/coco128.yaml', cache_dir='model_cache'):
+    """
+    Converts the PyTorch weights to the model file `backend` runs, once: the converted model is kept in `cache_dir`
+    under the version of the weights it was made from, and reused by the next starts
+
+    :return: path of the model file to load
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown backend {backend}, expected one of {", ".join(BACKENDS)}')
+    if backend == 'pytorch':
+        return weights
+
+    name = model_version(weights).replace(':', '-')
+    onnx_path = Path(cache_dir) / f'{name}-{imgsz}.onnx'
+    if not onnx_path.exists():
+        from export import run as export_run  # yolov5's export.py
+
+        onnx_path.parent.mkdir(parents=True, exist_ok=True)
+        logger.info(f'detector: exporting {weights} to ONNX')
+        # Dynamic axes, so `detect_batch` can send batches of any size
+        exported = export_run(weights=weights, data=data, imgsz=(imgsz, imgsz), include=('onnx',), dynamic=True)
+        os.replace(exported[0], onnx_path)
+    if backend == 'onnx':
+        return str(onnx_path)
+
+    int8_path = onnx_path.with_name(f'{onnx_path.stem}-int8.onnx')
+    if not int8_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        logger.info(f'detector: quantizing {onnx_path} to int8')
+        tmp_path = int8_path.with_suffix('.tmp')
+        quantize_dynamic(str(onnx_path), str(tmp_path), weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, int8_path)
+    return str(int8_path)
+
+
+class Detector:
+    """
+    Long-lived YOLOv5 detector.
+
+    The weights are loaded, fused and warmed up once when the object is created, so every
+    prediction afterwards only pays for pre-processing, the forward pass and NMS.
+    With `warmup=False` the caller runs `warmup` itself, later.
+    The defaults are the same ones `detect.run()` uses, so the output matches what it produced.
+
+    `backend` selects what runs the forward pass (see `BACKENDS`); the converted models are made from `weights`
+    by `prepare_weights`. Pre-processing, NMS and the outputs are the same whatever the backend.
+    """
+
+    def __init__(self, weights='yolov5s.pt', data='data/coco128.yaml', imgsz=640, conf_thres=0.25,
+                 iou_thres=0.45, max_det=1000, line_thickness=3, device='', backend='pytorch',
+                 cache_dir='model_cache', warmup=True):
+        self.weights = weights
+        self.backend = backend
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self.line_thickness = line_thickness
+
+        self.device = select_device(device)
+        self.model_path = prepare_weights(weights, backend, imgsz, data, cache_dir)
+        self.model = DetectMultiBackend(self.model_path, device=self.device, data=data)
+        if backend != 'pytorch':
+            # DetectMultiBackend sizes the ONNX Runtime thread pool to the whole machine; it gets the same thread
+            # budget as torch instead, which prefork workers set (see gunicorn.conf.py)
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            self.model.session = onnxruntime.InferenceSession(self.model_path, options,
+                                                              providers=self.model.session.get_providers())
+        self.stride, self.names, self.pt = self.model.stride, self.model.names, self.model.pt
+        self.imgsz = check_img_size((imgsz, imgsz), s=self.stride)
+
+        self.version = model_version(weights, backend)
+
+        logger.info(f'detector: loaded {self.model_path} ({self.version}) on {self.device}, imgsz {self.imgsz}')
+        if warmup:
+            self.warmup()
+
+    def warmup(self, batch_size=1):
+        """
+        Runs the model on a blank image, so the first request does not pay for the lazy allocations and kernel
+        selection. `DetectMultiBackend.warmup` does nothing on the CPU, the pass goes through `detect` instead.
+
+        :param batch_size: above 1, warms up `detect_batch` with that many images (a different input shape)
+        """
+        im0 = np.zeros((*self.imgsz, 3), np.uint8)
+        if batch_size > 1:
+            self.detect_batch([im0] * batch_size)
+        else:
+            self.detect(im0)
+        logger.info(f'detector: warm-up done, batch size {batch_size}')
+
+    def preprocess(self, im0, auto=None):
+        """
+        Letterboxes a BGR image (as returned by `cv2.imread`) and converts it to a CHW RGB array
+
+        :param im0: original image, HWC BGR uint8
+        :param auto: minimal padding; defaults to what `detect.run()` uses for this model
+        :return: CHW RGB uint8 array
+        """
+        if auto is None:
+            auto = self.pt
+        im = letterbox(im0, self.imgsz, stride=self.stride, auto=auto)[0]
+        im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        return np.ascontiguousarray(im)
+
+    def detect(self, im0):
+        """
+        Runs the model on a single image
+
+        :param im0: original image, HWC BGR uint8
+        :return: tensor of detections (n, 6) as xyxy, conf, cls in `im0` pixel coordinates
+        """
+        im = self.preprocess(im0)
+        return self._forward(im[None], [im0.shape])[0]
+
+    def detect_batch(self, im0s):
+        """
+        Runs the model on several images in one forward pass
+
+        A batch needs a single input shape, so every image is letterboxed to the full square `imgsz`
+        instead of the minimal padding used for a single image.
+
+        :param im0s: list of original images, HWC BGR uint8
+        :return: list of detection tensors, one per image, in the same order
+        """
+        if len(im0s) == 1:
+            return [self.detect(im0s[0])]
+        ims = np.stack([self.preprocess(im0, auto=False) for im0 in im0s])
+        return self._forward(ims, [im0.shape for im0 in im0s])
+
+    def _forward(self, ims, shapes):
+        im = torch.from_numpy(ims).to(self.model.device)
+        im = im.half() if self.model.fp16 else im.float()
+        im /= 255
+
+        with torch.no_grad():
+            pred = self.model(im)
+        pred = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+
+        for det, shape in zip(pred, shapes):
+            if len(det):
+                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], shape).round()
+        return pred
+
+    def labels(self, det, shape):
+        """
+        Converts detections to the normalized xywh rows `detect.run(save_txt=True)` writes
+
+        :param det: detections returned by `detect`
+        :param shape: shape of the original image
+        :return: list of (cls, cx, cy, width, height, conf) tuples
+        """
+        gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        rows = []
+        for *xyxy, conf, cls in reversed(det):
+            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()
+            rows.append((int(cls), *xywh, float(conf)))
+        return rows
+
+    def annotate(self, im0, det):
+        """
+        Draws the boxes and labels on a copy of the original image, the same way `detect.run()` does
+
+        :return: annotated HWC BGR image
+        """
+        annotator = Annotator(im0.copy(), line_width=self.line_thickness, example=str(self.names))
+        for *xyxy, conf, cls in reversed(det):
+            c = int(cls)
+            annotator.box_label(xyxy, f'{self.names[c]} {conf:.2f}', color=colors(c, True))
+        return annotator.result()
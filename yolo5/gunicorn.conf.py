@@ -0,0 +1,80 @@
+"""
+Prefork serving of the yolo5 app:
+    gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master (`preload_app`), which loads the weights before forking but never runs
+the model (see `app.preload_model`): the workers share the weights copy-on-write. Each worker then warms the
+model up, creates its own Mongo and S3 clients and background threads (`app.init_worker`), and runs inference
+with its share of the CPU cores.
+
+The workers share what must be consistent across them through Mongo: the job queue (JOB_QUEUE_BACKEND defaults
+to mongo here, `memory` is refused with several workers, as a job submitted to one worker may be polled on
+another) and the prediction cache invalidations (see `pred_cache.PredictionCache`).
+
+The local disk caches are not shared: each worker claims a slot and keeps its photos and artifacts under
+`photos/worker-<slot>/` and `static/data/worker-<slot>/`, with 1/WEB_WORKERS of PHOTO_CACHE_MAX_MB and
+ARTIFACT_CACHE_MAX_MB, so together they stay within the budgets (see `app.init_local_caches`). An image cached by
+one worker is downloaded again by another, and GET /cache/local reports the caches of the worker answering it.
+"""
+import os
+import shutil
+import tempfile
+
+# Processes, and request threads in each of them (besides the admission-controlled ones, see below)
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 4))
+
+# The admission control (see the ADMISSION_* flags in app.py) only sees requests that have a thread: with fewer
+# threads than it may hold, running or waiting, the excess queues in gunicorn's unbounded thread pool queue instead
+# and is never shed. So the threads cover all of them, plus WEB_THREADS for the endpoints it does not limit
+# (probes, /metrics, job polls). The flags are read from the environment here, the app cannot be imported yet;
+# ADMISSION_MAX_CONCURRENT defaults to BATCH_MAX_SIZE with micro-batching, as in app.py.
+if os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true':
+    batch_max_size = int(os.environ.get('BATCH_MAX_SIZE', 8))
+    default_concurrent = batch_max_size if os.environ.get('BATCH_ENABLED', 'false').lower() == 'true' else 4
+    admission_slots = (int(os.environ.get('ADMISSION_MAX_CONCURRENT', default_concurrent)) +
+                       int(os.environ.get('ADMISSION_MAX_QUEUE', 16)))
+    threads += admission_slots
+
+if workers > 1 and os.environ.get('JOB_QUEUE_BACKEND', 'mongo') != 'mongo':
+    raise RuntimeError(f'JOB_QUEUE_BACKEND={os.environ["JOB_QUEUE_BACKEND"]} keeps the jobs in one worker, '
+                       f'use mongo with WEB_WORKERS={workers}')
+
+# Intra-op threads of each worker's inference, by default the cores split evenly between the workers
+inference_threads = int(os.environ.get('INFERENCE_THREADS', 0)) or max(1, (os.cpu_count() or 1) // workers)
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 8081)}'
+worker_class = 'gthread'
+preload_app = True
+wsgi_app = 'app:app'
+timeout = 120
+graceful_timeout = 30
+
+# Set before the app, and torch with it, is imported: the OpenMP and BLAS pools of the workers are created with
+# this size, and the app knows it is served by forked workers, and by how many
+os.environ['OMP_NUM_THREADS'] = os.environ['MKL_NUM_THREADS'] = str(inference_threads)
+os.environ['PREFORK'] = 'true'
+os.environ['WEB_WORKERS'] = str(workers)
+
+# The workers write their metrics here, /metrics reports the sum of all of them (see `metrics._registry`)
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='yolo5-metrics-')
+else:
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)  # leftovers of a previous run
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def post_fork(server, worker):
+    import torch
+
+    import app
+
+    torch.set_num_threads(inference_threads)
+    app.init_worker()
+    server.log.info(f'worker {worker.pid}: {inference_threads} inference threads, {threads} request threads')
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,115 @@
+import base64
+import json
+import time
+
+from pred_cache import LRUCache
+
+# Fields of a prediction summary the history endpoints may return
+HISTORY_FIELDS = ('prediction_id', 'chat_id', 'time', 'original_img_path', 'predicted_img_path', 'labels',
+                  'image_hash', 'model_version', 'cached_from')
+# Sort order of the history, and the index backing it (see `mongo_writer.ensure_indexes`)
+HISTORY_SORT = [('time', -1), ('prediction_id', -1)]
+
+
+def encode_cursor(doc):
+    """Opaque paging cursor pointing right after `doc` in the history order"""
+    return base64.urlsafe_b64encode(json.dumps([doc['time'], doc['prediction_id']]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """:raise ValueError: if the cursor was not made by `encode_cursor`"""
+    try:
+        after_time, after_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f'invalid cursor: {cursor}') from e
+    return after_time, after_id
+
+
+class PredictionHistory:
+    """
+    Read side of the `predictions` collection: recent predictions, globally or of one chat, and class
+    frequencies over a time window.
+
+    Paging is by cursor (the `time` and `prediction_id` of the last returned summary) rather than `skip`, so a
+    page costs the same however deep it is. Stats are computed by an aggregation pipeline and kept in an
+    `LRUCache` for `stats_ttl` seconds, so dashboards polling them do not rerun it on every request.
+    """
+
+    def __init__(self, collection, stats_ttl=30, stats_cache_size=256, max_limit=100):
+        self.collection = collection
+        self.stats_cache = LRUCache(stats_cache_size, stats_ttl)
+        self.max_limit = max_limit
+
+    def recent(self, chat_id=None, limit=20, cursor=None, fields=None):
+        """
+        :param chat_id: only predictions requested from this chat, None for every chat
+        :param cursor: `next_cursor` of the previous page, None for the first page
+        :param fields: subset of `HISTORY_FIELDS` to return, None for all of them
+        :return: (summaries newest first, next_cursor or None on the last page)
+        :raise ValueError: on an unknown field or an invalid cursor
+        """
+        unknown = set(fields or ()) - set(HISTORY_FIELDS)
+        if unknown:
+            raise ValueError(f'unknown fields: {", ".join(sorted(unknown))}')
+        limit = max(1, min(int(limit), self.max_limit))
+
+        query = {} if chat_id is None else {'chat_id': chat_id}
+        if cursor:
+            after_time, after_id = decode_cursor(cursor)
+            query['$or'] = [{'time': {'$lt': after_time}},
+                            {'time': after_time, 'prediction_id': {'$lt': after_id}}]
+        # The cursor needs `time` and `prediction_id` whatever was asked for
+        projection = {field: 1 for field in (fields or HISTORY_FIELDS)}
+        projection.update({'_id': 0, 'time': 1, 'prediction_id': 1})
+
+        docs = list(self.collection.find(query, projection).sort(HISTORY_SORT).limit(limit + 1))
+        next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+        return docs[:limit], next_cursor
+
+    def class_stats(self, chat_id=None, window=86400, top=10):
+        """
+        :param window: seconds back from now the stats cover
+        :param top: number of classes returned, the most frequent first
+        :return: dict with the number of predictions and detected objects in the window and the per-class
+            counts and average confidences
+        """
+        # `$limit` takes a positive integer only, a window of 0 s or less would be empty anyway
+        window = max(1, int(window))
+        top = max(1, min(int(top), self.max_limit))
+        key = (chat_id, window, top)
+        stats = self.stats_cache.get(key)
+        if stats is not None:
+            return stats
+
+        since = time.time() - window
+        match = {'time': {'$gte': since}}
+        if chat_id is not None:
+            match['chat_id'] = chat_id
+        pipeline = [
+            {'$match': match},
+            {'$project': {'_id': 0, 'labels.class': 1, 'labels.confidence': 1}},  # the rest is not needed below
+            {'$facet': {
+                'totals': [{'$group': {'_id': None, 'predictions': {'$sum': 1},
+                                       'objects': {'$sum': {'$size': '$labels'}}}}],
+                'classes': [
+                    {'$unwind': '$labels'},
+                    {'$group': {'_id': '$labels.class', 'count': {'$sum': 1},
+                                'avg_confidence': {'$avg': '$labels.confidence'}}},
+                    {'$sort': {'count': -1, '_id': 1}},
+                    {'$limit': top},
+                ],
+            }},
+        ]
+        result = next(self.collection.aggregate(pipeline))
+        totals = result['totals'][0] if result['totals'] else {'predictions': 0, 'objects': 0}
+        stats = {
+            'chat_id': chat_id,
+            'window': window,
+            'since': since,
+            'predictions': totals['predictions'],
+            'objects': totals['objects'],
+            'classes': [{'class': row['_id'], 'count': row['count'], 'avg_confidence': row['avg_confidence']}
+                        for row in result['classes']],
+        }
+        self.stats_cache.put(key, stats)
+        return stats
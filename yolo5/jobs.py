@@ -0,0 +1,175 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import pymongo
+import requests
+from loguru import logger
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def new_job(payload, callback_url=None):
+    return {
+        'job_id': str(uuid.uuid4()),
+        'status': QUEUED,
+        'payload': payload,
+        'callback_url': callback_url,
+        'created': time.time(),
+    }
+
+
+class InProcessJobQueue:
+    """
+    Default job queue backend: a `queue.Queue` of pending jobs and a bounded table of job statuses.
+
+    Only the most recent `max_jobs` statuses are kept, older ones are forgotten by their id.
+    """
+
+    def __init__(self, max_jobs=10000):
+        self.max_jobs = max_jobs
+        self._pending = queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job['job_id']] = dict(job)
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        self._pending.put(job['job_id'])
+
+    def get(self, timeout=1.0):
+        """Claims the next queued job, or returns None if there was none within `timeout` seconds"""
+        try:
+            job_id = self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(status=RUNNING, started=time.time())
+            return dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+class MongoJobQueue:
+    """
+    Job queue backend stored in a Mongo collection, so several yolo5 containers can share one queue.
+
+    Workers claim jobs atomically with `find_one_and_update`, oldest first. A claim is a lease: a job still
+    `running` `lease` seconds after it started is taken to be abandoned by a worker that died (a crash, a gunicorn
+    timeout kill) and is claimed again. A job abandoned `max_attempts` times fails instead of killing more workers.
+    """
+
+    def __init__(self, collection, poll_interval=0.2, lease=300, max_attempts=3):
+        """
+        :param lease: seconds after which a running job is claimed again, longer than any job takes
+        """
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.collection.create_index([('status', pymongo.ASCENDING), ('created', pymongo.ASCENDING)])
+
+    def put(self, job):
+        self.collection.insert_one({'_id': job['job_id'], **job})
+
+    def get(self, timeout=1.0):
+        """Claims the next queued or abandoned job, or returns None if there was none within `timeout` seconds"""
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.time()
+            job = self.collection.find_one_and_update(
+                {'$or': [{'status': QUEUED}, {'status': RUNNING, 'started': {'$lt': now - self.lease}}]},
+                {'$set': {'status': RUNNING, 'started': now}, '$inc': {'attempts': 1}},
+                sort=[('created', pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+            if job is not None:
+                del job['_id']  # not with a projection, mongomock then loses the updated document
+                if job['attempts'] > self.max_attempts:
+                    logger.warning(f'job: {job["job_id"]}. abandoned {self.max_attempts} times, failing it')
+                    self.update(job['job_id'], status=FAILED, finished=now,
+                                error=f'abandoned by {self.max_attempts} workers')
+                    continue
+                if job['attempts'] > 1:
+                    logger.warning(f'job: {job["job_id"]}. still running after {self.lease}s, claimed again')
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(self.poll_interval)
+
+    def update(self, job_id, **fields):
+        self.collection.update_one({'_id': job_id}, {'$set': fields})
+
+    def status(self, job_id):
+        return self.collection.find_one({'_id': job_id}, {'_id': 0})
+
+
+class JobRunner:
+    """
+    Pool of worker threads draining a job queue.
+
+    Each job's payload is passed to `handler`, which returns a (result, http_status) pair like a Flask view.
+    The outcome is stored on the job and, if the job has a `callback_url`, POSTed there as JSON.
+    """
+
+    def __init__(self, job_queue, handler, workers=2, http=None, timeout=10):
+        """
+        :param http: `requests.Session` used for the callbacks
+        :param timeout: timeout of a callback request, seconds or a (connect, read) pair
+        """
+        self.job_queue = job_queue
+        self.handler = handler
+        self.http = http or requests.Session()
+        self.timeout = timeout
+        self._threads = [threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, payload, callback_url=None):
+        job = new_job(payload, callback_url)
+        self.job_queue.put(job)
+        logger.info(f'job: {job["job_id"]}. queued {payload}')
+        return job
+
+    def _run(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                continue
+            job_id = job['job_id']
+            try:
+                result, http_status = self.handler(job['payload'])
+                fields = {'status': DONE, 'result': result, 'http_status': http_status}
+            except Exception as e:
+                logger.exception(f'job: {job_id}. failed')
+                fields = {'status': FAILED, 'error': str(e)}
+            fields['finished'] = time.time()
+            self.job_queue.update(job_id, **fields)
+            logger.info(f'job: {job_id}. {fields["status"]}')
+
+            if job.get('callback_url'):
+                self._callback(job['callback_url'], {'job_id': job_id, **fields})
+
+    def _callback(self, url, body):
+        try:
+            self.http.post(url, json=body, timeout=self.timeout).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.info(f'job: {body["job_id"]}. callback to {url} failed: {e}')
@@ -0,0 +1,82 @@
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Stage latencies range from sub-millisecond cache lookups to multi-second uploads
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGES = ('s3_head', 's3_download', 'decode', 'inference', 'annotate', 'label_parse', 's3_upload', 'mongo_insert',
+          'mongo_bulk_insert')
+
+STAGE_SECONDS = Histogram('yolo5_stage_seconds', 'Time spent in each stage of a prediction', ['stage'],
+                          buckets=STAGE_BUCKETS)
+REQUESTS = Counter('yolo5_requests_total', 'HTTP requests handled', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('yolo5_request_seconds', 'HTTP request latency', ['endpoint'], buckets=STAGE_BUCKETS)
+ERRORS = Counter('yolo5_errors_total', 'HTTP requests that raised an exception', ['endpoint'])
+IN_FLIGHT = Gauge('yolo5_in_flight_requests', 'HTTP requests being handled right now', multiprocess_mode='livesum')
+CACHE_LOOKUPS = Counter('yolo5_prediction_cache_lookups_total', 'Prediction cache lookups', ['result'])
+ADMISSION_REJECTED = Counter('yolo5_admission_rejected_total', 'Prediction requests shed by the admission control',
+                             ['reason'])
+ADMISSION_WAITING = Gauge('yolo5_admission_waiting', 'Prediction requests waiting for a slot',
+                          multiprocess_mode='livesum')
+ARCHIVE_PENDING = Gauge('yolo5_archive_pending', 'Background S3 uploads queued or running',
+                        multiprocess_mode='livesum')
+
+# Label lookups take a lock and a dict access, the hot path uses the children resolved here once
+_stage_children = {stage: STAGE_SECONDS.labels(stage=stage) for stage in STAGES}
+CACHE_HITS = CACHE_LOOKUPS.labels(result='hit')
+CACHE_MISSES = CACHE_LOOKUPS.labels(result='miss')
+
+
+def stage(name):
+    """
+    Times a block of code into the `yolo5_stage_seconds` histogram, e.g. `with stage('inference'): ...`
+    """
+    return _stage_children[name].time()
+
+
+def _endpoint():
+    # The view function name, not the path, so /jobs/<job_id> is one series
+    return request.endpoint or 'unmatched'
+
+
+def instrument(app):
+    """
+    Counts and times every request of a Flask app and serves the metrics on GET /metrics
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        IN_FLIGHT.inc()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = _endpoint()
+        REQUESTS.labels(endpoint=endpoint, status=response.status_code).inc()
+        REQUEST_SECONDS.labels(endpoint=endpoint).observe(time.perf_counter() - g.metrics_start)
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        if 'metrics_start' not in g:
+            return
+        IN_FLIGHT.dec()
+        if exc is not None:
+            ERRORS.labels(endpoint=_endpoint()).inc()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def _registry():
+    # Under prefork serving (gunicorn.conf.py) every worker writes its metrics to PROMETHEUS_MULTIPROC_DIR, and
+    # whichever worker answers /metrics reports the sum of all of them
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        from prometheus_client import REGISTRY
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
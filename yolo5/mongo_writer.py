@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pymongo
+from loguru import logger
+from pymongo.errors import PyMongoError
+from pymongo.write_concern import WriteConcern
+
+from metrics import stage
+
+
+def with_write_concern(collection, w):
+    """
+    :param w: write concern as configured, e.g. '0', '1' or 'majority'
+    :return: the collection with that write concern applied
+    """
+    if w is None or w == '':
+        return collection
+    return collection.with_options(write_concern=WriteConcern(w=int(w) if str(w).isdigit() else w))
+
+
+def ensure_indexes(collection):
+    """Creates the indexes the service queries the predictions collection by (no-op when they exist)"""
+    collection.create_index([('prediction_id', pymongo.ASCENDING)], unique=True)
+    # History pages, globally and per chat, and the time window of the class stats (see `history.py`)
+    collection.create_index([('time', pymongo.DESCENDING), ('prediction_id', pymongo.DESCENDING)])
+    collection.create_index([('chat_id', pymongo.ASCENDING), ('time', pymongo.DESCENDING),
+                             ('prediction_id', pymongo.DESCENDING)])
+    collection.create_index([('labels.class', pymongo.ASCENDING)])
+    collection.create_index([('image_hash', pymongo.ASCENDING), ('model_version', pymongo.ASCENDING)])
+
+
+class BulkWriter:
+    """
+    Buffers documents and writes them with `insert_many` from a background thread.
+
+    A flush happens when `max_batch` documents are buffered or `flush_interval` seconds after the oldest
+    buffered document, whichever comes first. `close()` flushes whatever is left, call it on shutdown.
+    """
+
+    def __init__(self, collection, max_batch=100, flush_interval=1.0):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='mongo-bulk-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, doc):
+        """Buffers a document; it is inserted by the background thread"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('BulkWriter is closed')
+            self._buffer.append(doc)
+            if len(self._buffer) == 1:
+                # The background thread waits without a timeout while the buffer is empty: wake it to start the
+                # flush interval of this document
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            docs, self._buffer = self._buffer, []
+            self._oldest = None
+            return docs
+
+    def flush(self):
+        """Writes everything buffered so far and returns the number of documents written"""
+        with self._flush_lock:
+            docs = self._take()
+            if not docs:
+                return 0
+            try:
+                with stage('mongo_bulk_insert'):
+                    self.collection.insert_many(docs, ordered=False)
+            except PyMongoError as e:
+                logger.error(f'mongo bulk writer: insert of {len(docs)} documents failed: {e}')
+                return 0
+            return len(docs)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._buffer) >= self.max_batch:
+                        break
+                    if self._oldest is not None:
+                        remaining = self._oldest + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self):
+        """Stops the background thread after a final flush"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        logger.info('mongo bulk writer: flushed and closed')
@@ -0,0 +1,117 @@
+"""
+Latency, throughput and detection agreement of the inference backends against the PyTorch baseline.
+
+Each backend runs the same images through `Detector.detect` (one image per call, as `/predict` does) and
+`Detector.detect_batch` (throughput). Its detections are then matched to the PyTorch ones, per image, greedily
+by IoU:
+- box_iou: mean IoU of the matched boxes
+- class_match: share of the matched boxes with the same class
+- recall / precision: share of the baseline / backend boxes matched at IoU >= --iou
+The first run of a converted backend exports and caches the model, it is not part of the timings.
+
+Run from the yolo5 directory (inside the yolo5 image):
+    python -m perf.bench_backends --source data/images --repeat 20 --output backends.json
+"""
+import argparse
+from pathlib import Path
+
+import cv2
+import torch
+
+from detector import BACKENDS, Detector
+from perf.common import print_summary, summarize, time_calls, write_results
+from utils.metrics import box_iou
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+
+def load_images(source):
+    paths = sorted(p for p in Path(source).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES) \
+        if Path(source).is_dir() else [Path(source)]
+    return [cv2.imread(str(path)) for path in paths]
+
+
+def match(baseline, det, iou_thres):
+    """
+    Greedily pairs the boxes of two detection tensors (xyxy, conf, cls), highest IoU first
+    :return: list of (iou, same class) of the pairs with an IoU of at least `iou_thres`
+    """
+    if not len(baseline) or not len(det):
+        return []
+    ious = box_iou(baseline[:, :4], det[:, :4])
+    pairs = []
+    while True:
+        best = ious.max()
+        if best < iou_thres:
+            return pairs
+        i, j = divmod(int(ious.argmax()), ious.shape[1])
+        pairs.append((float(best), int(baseline[i, 5]) == int(det[j, 5])))
+        ious[i, :] = -1
+        ious[:, j] = -1
+
+
+def agreement(baselines, dets, iou_thres):
+    pairs, baseline_boxes, boxes = [], 0, 0
+    for baseline, det in zip(baselines, dets):
+        pairs += match(baseline, det, iou_thres)
+        baseline_boxes += len(baseline)
+        boxes += len(det)
+    return {
+        'box_iou': sum(iou for iou, _ in pairs) / len(pairs) if pairs else float('nan'),
+        'class_match': sum(same for _, same in pairs) / len(pairs) if pairs else float('nan'),
+        'recall': len(pairs) / baseline_boxes if baseline_boxes else float('nan'),
+        'precision': len(pairs) / boxes if boxes else float('nan'),
+        'boxes': boxes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='data/images', help='image, or directory of images')
+    parser.add_argument('--weights', default='yolov5s.pt')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS,
+                        help='pytorch always runs, as the baseline')
+    parser.add_argument('--cache-dir', default='model_cache')
+    parser.add_argument('--batch', type=int, default=8, help='images per detect_batch call')
+    parser.add_argument('--repeat', type=int, default=10, help='passes over the images')
+    parser.add_argument('--iou', type=float, default=0.5, help='IoU from which two boxes match')
+    parser.add_argument('--threads', type=int, help='torch intra-op threads, the default is torch\'s')
+    parser.add_argument('--output', default='bench_backends.json', help='JSON results file')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    images = load_images(args.source)
+    batch = (images * (args.batch // len(images) + 1))[:args.batch]
+    print(f'{len(images)} images, batches of {len(batch)}')
+
+    results, baselines = {}, None
+    for backend in ['pytorch'] + [backend for backend in args.backends if backend != 'pytorch']:
+        detector = Detector(weights=args.weights, data='data/coco128.yaml', backend=backend,
+                            cache_dir=args.cache_dir)
+        dets = [detector.detect(im0) for im0 in images]  # warm-up, and the detections compared below
+        if baselines is None:
+            baselines = dets
+
+        latencies = []
+        for _ in range(args.repeat):
+            for im0 in images:
+                latencies += time_calls(lambda: detector.detect(im0), 1)
+        results[f'{backend}/single'] = summarize(latencies, sum(latencies))
+        print_summary(f'{backend}/single', results[f'{backend}/single'])
+
+        batch_latencies = time_calls(lambda: detector.detect_batch(batch), args.repeat)
+        results[f'{backend}/batch'] = {**summarize(batch_latencies),
+                                       'throughput_ips': len(batch) * args.repeat / sum(batch_latencies)}
+        print_summary(f'{backend}/batch', results[f'{backend}/batch'])
+
+        if backend != 'pytorch':
+            results[f'{backend}/agreement'] = agreement(baselines, dets, args.iou)
+            print_summary(f'{backend}/agreement', results[f'{backend}/agreement'])
+
+    write_results(args.output, 'backends', results,
+                  {'images': len(images), 'batch': len(batch), 'threads': torch.get_num_threads()})
+
+
+if __name__ == '__main__':
+    main()
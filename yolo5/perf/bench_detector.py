@@ -0,0 +1,46 @@
+"""
+Cold vs warm per-request latency of the detector.
+
+"cold" is what `/predict` used to do: a full `detect.run()` per image, which reloads the weights,
+rebuilds and fuses the model and creates a new dataloader.
+"warm" is the long-lived `Detector` the service now keeps in memory.
+
+Run from the yolo5 directory (inside the yolo5 image):
+    python -m perf.bench_detector --source data/images/zidane.jpg --repeat 20
+"""
+import argparse
+import tempfile
+
+import cv2
+
+from detect import run
+from detector import Detector
+from perf.common import print_summary, summarize, time_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='data/images/zidane.jpg', help='image to run the detector on')
+    parser.add_argument('--weights', default='yolov5s.pt')
+    parser.add_argument('--repeat', type=int, default=10, help='requests per mode')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as project:
+        cold = time_calls(lambda: run(weights=args.weights, data='data/coco128.yaml', source=args.source,
+                                      project=project, name='bench', save_txt=True), args.repeat)
+    print_summary('cold (detect.run per request)', summarize(cold))
+
+    detector = Detector(weights=args.weights, data='data/coco128.yaml')
+
+    def warm_request():
+        im0 = cv2.imread(args.source)
+        det = detector.detect(im0)
+        detector.annotate(im0, det)
+        detector.labels(det, im0.shape)
+
+    warm = time_calls(warm_request, args.repeat)
+    print_summary('warm (in-memory Detector)', summarize(warm))
+
+
+if __name__ == '__main__':
+    main()
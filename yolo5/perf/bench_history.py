@@ -0,0 +1,126 @@
+"""
+Prediction history reads on a large synthetic `predictions` collection.
+
+Times the first and a deep page of the history (cursor paging, and `skip` paging for comparison), globally and
+per chat, and the class stats aggregation without and with its result cache. Run once with and once without
+--no-indexes and compare the two result files to see what the compound indexes buy.
+Uses mongomock by default (keep --docs small); pass --uri to run against a local mongod.
+
+Run from the yolo5 directory:
+    python -m perf.bench_history --docs 200000 --uri mongodb://localhost:27017 --output history.json
+    python -m perf.bench_history --docs 200000 --uri mongodb://localhost:27017 --no-indexes --output no_idx.json
+    python ../perf/compare.py no_idx.json history.json
+"""
+import argparse
+import random
+import time
+import uuid
+
+from history import HISTORY_SORT, PredictionHistory
+from mongo_writer import ensure_indexes
+from perf.common import print_summary, summarize, time_calls, write_results
+
+CLASSES = ['person', 'car', 'bicycle', 'dog', 'cat', 'bus', 'truck', 'traffic light', 'bench', 'bird']
+
+
+def fake_summaries(count, chats, span):
+    """`count` summaries spread over the last `span` seconds and over `chats` chats"""
+    now = time.time()
+    for _ in range(count):
+        yield {
+            'prediction_id': str(uuid.uuid4()),
+            'chat_id': random.randrange(chats),
+            'time': now - random.random() * span,
+            'original_img_path': 'tg-photos/photos/bench.jpg',
+            'predicted_img_path': 'tg-photos/photos/predicted_bench.jpg',
+            'labels': [{'class': random.choice(CLASSES), 'cx': 0.5, 'cy': 0.5, 'width': 0.2, 'height': 0.4,
+                        'confidence': random.random()} for _ in range(random.randint(1, 6))],
+            'image_hash': uuid.uuid4().hex,
+            'model_version': 'yolov5s.pt@bench',
+        }
+
+
+def get_collection(uri, docs, chats, span, indexes):
+    if uri:
+        import pymongo
+        client = pymongo.MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    collection = client['bench']['predictions']
+    collection.drop()
+    if indexes:
+        ensure_indexes(collection)
+    batch = []
+    for doc in fake_summaries(docs, chats, span):
+        batch.append(doc)
+        if len(batch) == 10000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    return collection
+
+
+def deep_cursor(history, chat_id, limit, pages):
+    cursor = None
+    for _ in range(pages):
+        _, cursor = history.recent(chat_id, limit, cursor, ['prediction_id'])
+    return cursor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--span-days', type=float, default=90, help='the summaries cover this many days')
+    parser.add_argument('--limit', type=int, default=20, help='page size')
+    parser.add_argument('--deep-page', type=int, default=50, help='page number of the deep page')
+    parser.add_argument('--window-days', type=float, default=7, help='time window of the stats')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--uri', help='MongoDB URI, mongomock if not given')
+    parser.add_argument('--no-indexes', action='store_true', help='do not create the history indexes')
+    parser.add_argument('--output', default='bench_history.json', help='JSON results file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    collection = get_collection(args.uri, args.docs, args.chats, args.span_days * 86400, not args.no_indexes)
+    print(f'{args.docs} summaries inserted in {time.perf_counter() - start:.1f}s')
+
+    history = PredictionHistory(collection, stats_ttl=3600)
+    chat_id = random.randrange(args.chats)
+    window = int(args.window_days * 86400)
+    global_cursor = deep_cursor(history, None, args.limit, args.deep_page)
+    chat_cursor = deep_cursor(history, chat_id, args.limit, min(args.deep_page, 3))
+
+    def skip_page(query):
+        return list(collection.find(query, {'_id': 0}).sort(HISTORY_SORT).skip(args.deep_page * args.limit)
+                    .limit(args.limit))
+
+    def uncached_stats(chat):
+        history.stats_cache.clear()
+        return history.class_stats(chat, window)
+
+    cases = {
+        'recent/global/first': lambda: history.recent(None, args.limit),
+        'recent/global/deep_cursor': lambda: history.recent(None, args.limit, global_cursor),
+        'recent/global/deep_skip': lambda: skip_page({}),
+        'recent/chat/first': lambda: history.recent(chat_id, args.limit),
+        'recent/chat/cursor': lambda: history.recent(chat_id, args.limit, chat_cursor),
+        'stats/global/uncached': lambda: uncached_stats(None),
+        'stats/chat/uncached': lambda: uncached_stats(chat_id),
+        'stats/global/cached': lambda: history.class_stats(None, window),
+    }
+    results = {}
+    for name, call in cases.items():
+        call()  # warm-up
+        latencies = time_calls(call, args.repeat)
+        results[name] = summarize(latencies, sum(latencies))
+        print_summary(name, results[name])
+
+    write_results(args.output, 'history', results,
+                  {'docs': args.docs, 'chats': args.chats, 'indexes': not args.no_indexes, 'uri': bool(args.uri)})
+
+
+if __name__ == '__main__':
+    main()
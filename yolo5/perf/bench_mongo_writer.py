@@ -0,0 +1,84 @@
+"""
+Per-request `insert_one` vs the buffered `BulkWriter` for prediction summaries.
+
+Reports the latency the request path pays per summary and the overall insert throughput (including the
+final flush). Uses mongomock by default; pass --uri to run against a local mongod.
+
+Run from the yolo5 directory:
+    python -m perf.bench_mongo_writer --docs 5000
+    python -m perf.bench_mongo_writer --docs 5000 --uri mongodb://localhost:27017
+"""
+import argparse
+import time
+import uuid
+
+from mongo_writer import BulkWriter, ensure_indexes, with_write_concern
+from perf.common import print_summary, summarize
+
+
+def fake_summary():
+    return {
+        'prediction_id': str(uuid.uuid4()),
+        'original_img_path': 'photos/bench.jpg',
+        'predicted_img_path': 'tg-photos/photos/predicted_bench.jpg',
+        'labels': [{'class': 'person', 'cx': 0.5, 'cy': 0.5, 'width': 0.2, 'height': 0.4, 'confidence': 0.9}] * 3,
+        'time': time.time(),
+    }
+
+
+def get_collection(uri, write_concern):
+    if uri:
+        import pymongo
+        client = pymongo.MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    collection = client['bench']['predictions']
+    collection.drop()
+    ensure_indexes(collection)
+    return with_write_concern(collection, write_concern)
+
+
+def bench_insert_one(collection, docs):
+    latencies = []
+    start = time.perf_counter()
+    for doc in docs:
+        t = time.perf_counter()
+        collection.insert_one(doc)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_bulk_writer(collection, docs, max_batch, flush_interval):
+    writer = BulkWriter(collection, max_batch, flush_interval)
+    latencies = []
+    start = time.perf_counter()
+    for doc in docs:
+        t = time.perf_counter()
+        writer.write(doc)
+        latencies.append(time.perf_counter() - t)
+    writer.close()
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--uri', default=None, help='mongodb uri, mongomock when omitted')
+    parser.add_argument('--write-concern', default='')
+    parser.add_argument('--max-batch', type=int, default=100)
+    parser.add_argument('--flush-interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    collection = get_collection(args.uri, args.write_concern)
+    print_summary('insert_one per request', bench_insert_one(collection, [fake_summary() for _ in range(args.docs)]))
+
+    collection = get_collection(args.uri, args.write_concern)
+    print_summary(f'BulkWriter (batch {args.max_batch}, {args.flush_interval}s)',
+                  bench_bulk_writer(collection, [fake_summary() for _ in range(args.docs)],
+                                    args.max_batch, args.flush_interval))
+    print(f'documents stored: {collection.count_documents({})}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Kept identical in polybot/perf/common.py, the canonical copy, and yolo5/perf/common.py: each service is built
+# from its own directory and cannot import the other's code. Edit the polybot copy and copy it over,
+# polybot/test/test_shared_modules.py fails while they differ.
+import statistics
+import time
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies, wall_time=None):
+    """
+    Summarizes a list of per-request latencies (seconds)
+
+    :param latencies: list of latencies in seconds
+    :param wall_time: total wall time of the run, used for the throughput
+    :return: dict with the count, mean, p50/p95/p99 in ms and the throughput in req/s
+    """
+    summary = {
+        'count': len(latencies),
+        'mean_ms': statistics.fmean(latencies) * 1000 if latencies else float('nan'),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+    if wall_time:
+        summary['throughput_rps'] = len(latencies) / wall_time
+    return summary
+
+
+def time_calls(fn, repeat):
+    """Calls `fn` `repeat` times and returns the list of latencies in seconds"""
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def print_summary(name, summary):
+    fields = ', '.join(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}'
+                       for key, value in summary.items())
+    print(f'{name}: {fields}')
+
+
+def write_results(path, suite, results, meta=None):
+    """
+    Stores benchmark results as JSON, in the format `perf/compare.py` (repo root) compares
+
+    :param results: dict of case name -> dict of metric name -> number
+    """
+    import json
+    import platform
+
+    with open(path, 'w') as f:
+        json.dump({
+            'suite': suite,
+            'created': time.time(),
+            'meta': {'python': platform.python_version(), 'machine': platform.machine(), **(meta or {})},
+            'results': results,
+        }, f, indent=2)
+    print(f'results written to {path}')
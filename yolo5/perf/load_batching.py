@@ -0,0 +1,64 @@
+"""
+Load test of the inference stage with micro-batching off and on.
+
+A number of client threads each send detection requests back to back, the same way concurrent `/predict`
+handlers call the detector. Throughput and p50/p95/p99 latency are reported for each mode.
+
+Run from the yolo5 directory (inside the yolo5 image):
+    python -m perf.load_batching --source data/images/bus.jpg --clients 8 --requests 200 --window-ms 10
+"""
+import argparse
+import threading
+import time
+
+import cv2
+
+from batcher import MicroBatcher
+from detector import Detector
+from perf.common import print_summary, summarize
+
+
+def run_load(detect_fn, im0, clients, requests_total):
+    latencies = []
+    lock = threading.Lock()
+    per_client = requests_total // clients
+
+    def client():
+        local = []
+        for _ in range(per_client):
+            start = time.perf_counter()
+            detect_fn(im0)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='data/images/bus.jpg')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent callers')
+    parser.add_argument('--requests', type=int, default=200, help='total requests per mode')
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--window-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    detector = Detector(weights='yolov5s.pt', data='data/coco128.yaml')
+    im0 = cv2.imread(args.source)
+
+    print_summary('batching off', run_load(detector.detect, im0, args.clients, args.requests))
+
+    batcher = MicroBatcher(detector.detect_batch, args.max_batch_size, args.window_ms)
+    print_summary(f'batching on (max {args.max_batch_size}, {args.window_ms} ms)',
+                  run_load(lambda im: batcher.submit(im).result(), im0, args.clients, args.requests))
+
+
+if __name__ == '__main__':
+    main()
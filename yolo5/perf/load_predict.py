@@ -0,0 +1,139 @@
+"""
+End-to-end load test of the yolo5 prediction endpoints, with local stand-ins for S3 and MongoDB.
+
+S3 is mocked with moto and MongoDB with mongomock, so the whole request path runs in-process: S3 download
+(or request body), cache lookup, inference, annotated image upload and the Mongo write. Concurrent clients
+call the Flask app through its test client and throughput and p50/p95/p99 latency are reported.
+Every request sends a different image (the source JPEG with a unique trailer) unless --same-image is given,
+so the prediction cache does not short-circuit the pipeline. Requests rejected by the admission control (503)
+are counted as `shed`: run a burst with more --clients than ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE, with
+ADMISSION_ENABLED=true and false, to compare the tail latencies.
+
+Run from the yolo5 directory (inside the yolo5 image, with moto and mongomock installed):
+    python -m perf.load_predict --endpoint imgName --clients 4 --requests 100 --output predict.json
+    python ../perf/compare.py predict_before.json predict.json
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import mongomock
+import pymongo
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from perf.common import print_summary, summarize, write_results
+
+BUCKET = 'perf-bucket'
+
+
+def setup_environment():
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    bucket_file = tempfile.NamedTemporaryFile('w', suffix='.secret', delete=False)
+    bucket_file.write(BUCKET)
+    bucket_file.close()
+    os.environ['BUCKET_NAME_FILE'] = bucket_file.name
+    pymongo.MongoClient = mongomock.MongoClient  # the app connects to the replica set at import
+
+
+def image_variants(source, count):
+    with open(source, 'rb') as f:
+        img_bytes = f.read()
+    # Bytes after the JPEG end marker are ignored by decoders but change the content hash
+    return [img_bytes + f'perf-{i}-{time.time_ns()}'.encode() for i in range(count)]
+
+
+def run_load(app_module, endpoint, images, clients, prefix):
+    latencies = []
+    errors = []
+    shed = []
+    lock = threading.Lock()
+    next_index = iter(range(len(images)))
+
+    def client():
+        http = app_module.app.test_client()
+        local, local_errors, local_shed = [], 0, 0
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            if endpoint == 'imgName':
+                response = http.post('/predict', query_string={'imgName': f'{prefix}/img_{i}.jpg'})
+            else:
+                response = http.post('/predict/image', query_string={'name': f'{prefix}/direct_{i}.jpg'},
+                                     data=images[i], content_type='application/octet-stream')
+            local.append(time.perf_counter() - start)
+            if response.status_code == 503:  # shed by the admission control
+                local_shed += 1
+            elif response.status_code not in (200, 404):
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors.append(local_errors)
+            shed.append(local_shed)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    summary = summarize(latencies, time.perf_counter() - start)
+    summary['errors'] = sum(errors)
+    summary['shed'] = sum(shed)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='data/images/bus.jpg')
+    parser.add_argument('--endpoint', choices=['imgName', 'image'], nargs='+', default=['imgName', 'image'])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4], help='concurrency levels')
+    parser.add_argument('--requests', type=int, default=50, help='requests per case')
+    parser.add_argument('--same-image', action='store_true', help='send the same image every time (cache hits)')
+    parser.add_argument('--output', default='load_predict.json', help='JSON results file')
+    args = parser.parse_args()
+
+    setup_environment()
+    with mock_aws():
+        import boto3
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+
+        import app as app_module
+        if not app_module.startup.wait():
+            raise SystemExit(f'yolo5 did not start: {app_module.startup.failed}')
+
+        results = {}
+        for endpoint in args.endpoint:
+            for clients in args.clients:
+                images = image_variants(args.source, 1 if args.same_image else args.requests)
+                images = images * (args.requests // len(images))
+                case = f'{endpoint}/c{clients}'
+                # Keys of their own per case: an image uploaded again under a key of a previous case would be
+                # another object behind a name the service has seen before
+                prefix = f'perf/{case}'
+                if endpoint == 'imgName':
+                    for i, img_bytes in enumerate(images):
+                        app_module.s3.put_object(Bucket=BUCKET, Key=f'{prefix}/img_{i}.jpg', Body=img_bytes)
+                results[case] = run_load(app_module, endpoint, images, clients, prefix)
+                print_summary(case, results[case])
+
+        if app_module.mongo_writer:
+            app_module.mongo_writer.flush()
+        print(f'predictions stored: {app_module.collection.count_documents({})}')
+
+    write_results(args.output, 'predict_pipeline', results,
+                  {'requests': args.requests, 'same_image': args.same_image, 'source': args.source})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Inference throughput of prefork workers: worker processes x intra-op threads per worker.
+
+Reproduces what gunicorn.conf.py does: the detector is loaded once, the workers are forked and share it
+copy-on-write (for the ONNX backends each worker loads the model, as the app does), each sets its thread budget,
+warms the model up and runs `Detector.detect` back to back for --duration seconds. Mongo, S3 and HTTP are left
+out, the sweep is about how to split the cores; pick WEB_WORKERS and INFERENCE_THREADS from the best case.
+
+Run from the yolo5 directory (inside the yolo5 image):
+    python -m perf.sweep_prefork --workers 1 2 4 8 --threads 1 2 4 8 --output prefork.json
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import cv2
+import torch
+
+from detector import BACKENDS, Detector, prepare_weights
+from perf.common import print_summary, summarize, write_results
+
+detector = None  # loaded before forking, inherited by the workers
+
+
+def worker(backend, threads, images, duration, start_at, results):
+    global detector
+    torch.set_num_threads(threads)
+    if detector is None:
+        detector = Detector(weights='yolov5s.pt', data='data/coco128.yaml', backend=backend)
+    else:
+        detector.warmup()
+
+    # Every worker starts measuring at the same time, after the slowest one is warmed up
+    time.sleep(max(0.0, start_at - time.time()))
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        detector.detect(images[len(latencies) % len(images)])
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def run_case(backend, workers, threads, images, duration, warmup):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    start_at = time.time() + warmup
+    processes = [context.Process(target=worker, args=(backend, threads, images, duration, start_at, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    latencies = []
+    for _ in processes:
+        latencies += results.get()
+    for process in processes:
+        process.join()
+    return summarize(latencies, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', nargs='+', default=['data/images/bus.jpg'], help='images, detected in turn')
+    parser.add_argument('--backend', default='pytorch', choices=BACKENDS)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--max-cores', type=int, default=os.cpu_count(),
+                        help='skip the cases using more threads in total')
+    parser.add_argument('--duration', type=float, default=20, help='seconds measured per case')
+    parser.add_argument('--warmup', type=float, default=15, help='seconds for the workers to start and warm up')
+    parser.add_argument('--output', default='sweep_prefork.json', help='JSON results file')
+    args = parser.parse_args()
+
+    global detector
+    if args.backend == 'pytorch':
+        # Loaded without a forward pass and on one thread, as `app.preload_model` does: no OpenMP pool before forking
+        torch.set_num_threads(1)
+        detector = Detector(weights='yolov5s.pt', data='data/coco128.yaml', warmup=False)
+    else:
+        # Converted once up front, in a separate process as the app does (see `app.prepare_model`)
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            pool.apply(prepare_weights, ('yolov5s.pt', args.backend))
+    images = [cv2.imread(source) for source in args.source]
+
+    results = {}
+    for workers in args.workers:
+        for threads in args.threads:
+            if workers * threads > args.max_cores:
+                continue
+            case = f'w{workers}/t{threads}'
+            results[case] = run_case(args.backend, workers, threads, images, args.duration, args.warmup)
+            print_summary(case, results[case])
+
+    best = max(results, key=lambda case: results[case]['throughput_rps'])
+    print(f'best: {best}, {results[best]["throughput_rps"]:.2f} images/s')
+    write_results(args.output, 'prefork', results,
+                  {'backend': args.backend, 'cpus': os.cpu_count(), 'duration': args.duration})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo import ReturnDocument
+
+
+def image_hash(img_bytes):
+    """Content address of an image: the sha256 of its bytes"""
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache with a maximum number of entries and a TTL per entry.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        """
+        :param max_entries: least recently used entries are evicted above this size
+        :param ttl: seconds an entry stays valid after it was stored
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """:return: the cached value, or None if the key is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PredictionCache:
+    """
+    Two-tier cache of prediction summaries keyed by image hash.
+
+    The first tier is an in-process `LRUCache`. The second tier is the `predictions` collection itself: every
+    summary is stored there with its `image_hash` and the `model_version` that produced it, so a lookup by both
+    finds a previous prediction of the same image by the same model.
+
+    Several processes (prefork workers) each have their own first tier. An invalidation bumps a generation
+    counter in the `state` collection, and every process drops its first tier once it sees the counter change.
+    """
+
+    STATE_ID = 'prediction_cache'
+
+    def __init__(self, collection, model_version, max_entries=1024, ttl=3600, state=None, sync_interval=1.0):
+        """
+        :param state: collection holding the invalidation generation shared by the processes, None for a cache
+            private to this process
+        :param sync_interval: seconds between two reads of the shared generation, the longest an invalidation
+            by another process takes to be seen
+        """
+        self.collection = collection
+        self.model_version = model_version
+        self.memory = LRUCache(max_entries, ttl)
+        self.state = state
+        self.sync_interval = sync_interval
+        self.generation = self._read_generation()
+        self._synced_at = time.monotonic()
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+
+    def _read_generation(self):
+        if self.state is None:
+            return 0
+        doc = self.state.find_one({'_id': self.STATE_ID})
+        return doc['generation'] if doc else 0
+
+    def _sync(self):
+        """Drops the first tier if another process invalidated the cache since the last check"""
+        if self.state is None or time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = time.monotonic()
+        generation = self._read_generation()
+        if generation != self.generation:
+            self.memory.clear()
+            self.generation = generation
+
+    def get(self, img_hash):
+        """:return: the cached prediction summary (without `_id`), or None on a miss"""
+        self._sync()
+        summary = self.memory.get(img_hash)
+        if summary is not None:
+            self.memory_hits += 1
+            return summary
+
+        summary = self.collection.find_one({'image_hash': img_hash, 'model_version': self.model_version},
+                                           {'_id': 0}, sort=[('time', -1)])
+        if summary is not None:
+            self.mongo_hits += 1
+            self.memory.put(img_hash, summary)
+            return summary
+
+        self.misses += 1
+        return None
+
+    def put(self, img_hash, summary):
+        self.memory.put(img_hash, summary)
+
+    def invalidate(self):
+        """
+        Drops the in-process tier, of every process sharing the `state` collection. The Mongo tier needs no
+        invalidation: `model_version` identifies the weights the service loaded at startup, the summaries of other
+        weights never match it.
+        """
+        if self.state is not None:
+            doc = self.state.find_one_and_update({'_id': self.STATE_ID}, {'$inc': {'generation': 1}}, upsert=True,
+                                                 return_document=ReturnDocument.AFTER)
+            self.generation = doc['generation']
+        self.memory.clear()
+
+    def stats(self):
+        lookups = self.memory_hits + self.mongo_hits + self.misses
+        return {
+            'model_version': self.model_version,
+            'generation': self.generation,
+            'memory_hits': self.memory_hits,
+            'mongo_hits': self.mongo_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.memory_hits + self.mongo_hits) / lookups if lookups else 0.0,
+            'memory_entries': len(self.memory),
+        }
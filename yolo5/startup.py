@@ -0,0 +1,121 @@
+# Kept identical in polybot/bot/startup.py, the canonical copy, and yolo5/startup.py: each service is built from its
+# own directory and cannot import the other's code. Edit the polybot copy and copy it over,
+# polybot/test/test_shared_modules.py fails while they differ.
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import jsonify, request
+from loguru import logger
+
+# Endpoints served while the service is still starting (index is polybot's root page), everything else answers 503
+# until it is ready
+PROBE_ENDPOINTS = {'index', 'healthz', 'readyz', 'metrics'}
+
+
+class Startup:
+    """
+    Runs the setup steps of a service and tracks whether it is live and ready.
+
+    Steps are grouped in phases: the steps of a phase run in parallel, the next phase starts once they all
+    succeeded. The time each step took is kept for the startup breakdown served on /readyz.
+    """
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.steps = {}  # step name -> seconds
+        self.failed = {}  # step name -> error
+        self.ready_after = None  # seconds from creation to ready
+        self._ready = threading.Event()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def live(self):
+        return not self.failed
+
+    def start(self, *phases):
+        """
+        Runs the phases on a background thread, so the probe endpoints answer while the service starts
+
+        :param phases: dicts of step name -> function without arguments
+        """
+        threading.Thread(target=self.run, args=phases, name='startup', daemon=True).start()
+
+    def run(self, *phases, ready=True):
+        """
+        Runs the phases on the calling thread, returns whether every step succeeded
+
+        :param ready: False when more phases follow later, e.g. the ones run in the master process before
+            prefork workers are forked, which then run the rest with `start`
+        """
+        with ThreadPoolExecutor(max_workers=max(map(len, phases)), thread_name_prefix='startup') as pool:
+            for phase in phases:
+                list(pool.map(self._run_step, phase.keys(), phase.values()))
+                if self.failed:
+                    logger.error(f'startup: failed in {", ".join(self.failed)}, the service will not become ready')
+                    self._done.set()
+                    return False
+        if not ready:
+            return True
+        self.ready_after = time.monotonic() - self.created
+        self._ready.set()
+        self._done.set()
+        logger.info(f'startup: ready after {self.ready_after:.2f}s. '
+                    + ', '.join(f'{name}: {seconds:.2f}s' for name, seconds in self.steps.items()))
+        return True
+
+    def _run_step(self, name, step):
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.exception(f'startup: {name} failed')
+            with self._lock:
+                self.failed[name] = str(e)
+            return
+        with self._lock:
+            self.steps[name] = time.perf_counter() - start
+
+    def mark(self, name):
+        """Records the time since the startup began as step `name`, e.g. for the imports done before the steps"""
+        with self._lock:
+            self.steps[name] = time.monotonic() - self.created
+
+    def wait(self, timeout=None):
+        """Waits for the startup to finish, returns whether the service is ready"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self):
+        with self._lock:
+            return {
+                'live': self.live,
+                'ready': self.ready,
+                'uptime': time.monotonic() - self.created,
+                'ready_after': self.ready_after,
+                'steps': dict(self.steps),
+                'failed': dict(self.failed),
+            }
+
+    def add_probes(self, app):
+        """
+        Adds GET /healthz (liveness: fails only when a startup step failed) and GET /readyz (readiness) to a Flask
+        app, and answers its other endpoints with 503 until the service is ready
+        """
+        @app.route('/healthz', methods=['GET'])
+        def healthz():
+            return jsonify(self.status()), 200 if self.live else 500
+
+        @app.route('/readyz', methods=['GET'])
+        def readyz():
+            return jsonify(self.status()), 200 if self.ready else 503
+
+        @app.before_request
+        def reject_until_ready():
+            if not self.ready and request.endpoint not in PROBE_ENDPOINTS:
+                return 'service is starting', 503, {'Retry-After': '1'}
@@ -0,0 +1,65 @@
+import threading
+import time
+import unittest
+
+from flask import Flask
+
+from admission import AdmissionController
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_admits_up_to_max_concurrent(self):
+        admission = AdmissionController(max_concurrent=2, max_queue=0)
+        self.assertIsNone(admission.acquire())
+        self.assertIsNone(admission.acquire())
+        self.assertEqual(admission.acquire(), 'queue_full')
+        self.assertEqual(admission.stats()['rejected'], {'queue_full': 1, 'timeout': 0})
+
+    def test_waiting_request_gets_released_slot(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=5)
+        admission.acquire()
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(admission.acquire()))
+        waiter.start()
+        while admission.stats()['waiting'] == 0:
+            time.sleep(0.01)
+        self.assertEqual(admission.acquire(), 'queue_full')
+        admission.release(0.1)
+        waiter.join(5)
+        self.assertEqual(results, [None])
+        self.assertEqual(admission.stats()['running'], 1)
+
+    def test_queue_timeout(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+        admission.acquire()
+        self.assertEqual(admission.acquire(), 'timeout')
+        self.assertEqual(admission.stats()['waiting'], 0)
+
+    def test_retry_after_follows_service_time(self):
+        admission = AdmissionController(max_concurrent=1, max_queue=4, alpha=1)
+        self.assertEqual(admission.retry_after(), 1)
+        admission.acquire()
+        admission.release(3)
+        admission.acquire()
+        self.assertEqual(admission.retry_after(), 6)  # the running request and the rejected one, 3 s each
+
+    def test_protect_sheds_only_the_given_endpoints(self):
+        app = Flask(__name__)
+        admission = AdmissionController(max_concurrent=1, max_queue=0)
+        admission.protect(app, {'limited'})
+        app.add_url_rule('/limited', 'limited', lambda: 'ok')
+        app.add_url_rule('/free', 'free', lambda: 'ok')
+        client = app.test_client()
+
+        self.assertEqual(client.get('/limited').status_code, 200)
+        self.assertEqual(admission.stats()['running'], 0)
+
+        admission.acquire()  # the only slot is taken
+        response = client.get('/limited')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(client.get('/free').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import threading
+import unittest
+
+from batcher import MicroBatcher
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def test_concurrent_items_share_a_batch(self):
+        batches = []
+        batcher = MicroBatcher(lambda items: (batches.append(list(items)), [item * 2 for item in items])[1],
+                               max_batch_size=8, window_ms=200)
+        futures = [batcher.submit(i) for i in range(3)]
+        self.assertEqual([future.result(5) for future in futures], [0, 2, 4])
+        self.assertEqual(batches, [[0, 1, 2]])
+
+    def test_batches_are_capped(self):
+        batches = []
+        release = threading.Event()
+
+        def batch_fn(items):
+            release.wait(5)
+            batches.append(len(items))
+            return items
+
+        batcher = MicroBatcher(batch_fn, max_batch_size=2, window_ms=50)
+        futures = [batcher.submit(i) for i in range(5)]
+        release.set()
+        self.assertEqual([future.result(5) for future in futures], [0, 1, 2, 3, 4])
+        self.assertTrue(all(size <= 2 for size in batches))
+        self.assertEqual(sum(batches), 5)
+
+    def test_batch_error_reaches_every_caller(self):
+        def fail(items):
+            raise RuntimeError('boom')
+
+        batcher = MicroBatcher(fail, window_ms=100)
+        futures = [batcher.submit(i) for i in range(2)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(5)
+        ok = MicroBatcher(lambda items: items, window_ms=1)
+        self.assertEqual(ok.submit(1).result(5), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import time
+import unittest
+
+import mongomock
+
+from history import PredictionHistory
+
+
+class TestPredictionHistory(unittest.TestCase):
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.predictions
+        self.history = PredictionHistory(self.collection, stats_ttl=0, max_limit=3)
+        self.now = time.time()
+
+    def store(self, n, chat_id=1, labels=(), age=0):
+        self.collection.insert_one({'prediction_id': f'p{n:02d}', 'chat_id': chat_id, 'time': self.now - age - n,
+                                    'original_img_path': f'img{n}.jpg', 'labels': list(labels)})
+
+    def test_pages_follow_the_cursor(self):
+        for n in range(5):
+            self.store(n)
+        page, cursor = self.history.recent(limit=2)
+        self.assertEqual([doc['prediction_id'] for doc in page], ['p00', 'p01'])
+        page, cursor = self.history.recent(limit=2, cursor=cursor)
+        self.assertEqual([doc['prediction_id'] for doc in page], ['p02', 'p03'])
+        page, cursor = self.history.recent(limit=2, cursor=cursor)
+        self.assertEqual([doc['prediction_id'] for doc in page], ['p04'])
+        self.assertIsNone(cursor)
+
+    def test_equal_times_are_paged_by_prediction_id(self):
+        for n in range(3):
+            self.collection.insert_one({'prediction_id': f'p{n}', 'time': self.now})
+        page, cursor = self.history.recent(limit=2)
+        rest, _ = self.history.recent(limit=2, cursor=cursor)
+        self.assertEqual([doc['prediction_id'] for doc in page + rest], ['p2', 'p1', 'p0'])
+
+    def test_chat_filter(self):
+        self.store(0, chat_id=1)
+        self.store(1, chat_id=2)
+        page, _ = self.history.recent(chat_id=2)
+        self.assertEqual([doc['prediction_id'] for doc in page], ['p01'])
+
+    def test_limit_is_clamped(self):
+        for n in range(5):
+            self.store(n)
+        self.assertEqual(len(self.history.recent(limit=100)[0]), 3)
+        self.assertEqual(len(self.history.recent(limit=0)[0]), 1)
+
+    def test_projection_keeps_the_cursor_fields(self):
+        self.store(0)
+        (doc,), _ = self.history.recent(fields=['labels'])
+        self.assertEqual(set(doc), {'labels', 'time', 'prediction_id'})
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            self.history.recent(fields=['password'])
+        with self.assertRaises(ValueError):
+            self.history.recent(cursor='not-a-cursor')
+
+    def test_class_stats(self):
+        self.store(0, labels=[{'class': 'dog', 'confidence': 0.5}, {'class': 'cat', 'confidence': 0.9}])
+        self.store(1, labels=[{'class': 'dog', 'confidence': 0.7}])
+        self.store(2, labels=[{'class': 'bus', 'confidence': 0.8}], age=3600)
+        stats = self.history.class_stats(window=60, top=1)
+        self.assertEqual((stats['predictions'], stats['objects']), (2, 3))
+        self.assertEqual(stats['classes'], [{'class': 'dog', 'count': 2, 'avg_confidence': 0.6}])
+
+    def test_class_stats_arguments_are_clamped(self):
+        self.store(0, labels=[{'class': 'dog', 'confidence': 0.5}])
+        stats = self.history.class_stats(window=-5, top=0)
+        self.assertEqual(stats['window'], 1)
+        self.assertEqual(len(self.history.class_stats(top=-1)['classes']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import time
+import unittest
+from unittest.mock import Mock
+
+import mongomock
+import requests
+
+from jobs import DONE, FAILED, QUEUED, RUNNING, InProcessJobQueue, JobRunner, MongoJobQueue, new_job
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.01)
+
+
+class JobQueueTests:
+    """Behaviour both backends share, run against each by the subclasses"""
+
+    def make_queue(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.queue = self.make_queue()
+
+    def test_get_claims_oldest_first(self):
+        first, second = new_job({'n': 1}), new_job({'n': 2})
+        self.queue.put(first)
+        self.queue.put(second)
+        claimed = self.queue.get(timeout=0.1)
+        self.assertEqual(claimed['job_id'], first['job_id'])
+        self.assertEqual(claimed['status'], RUNNING)
+        self.assertIn('started', claimed)
+        self.assertEqual(self.queue.get(timeout=0.1)['job_id'], second['job_id'])
+
+    def test_get_times_out_when_empty(self):
+        self.assertIsNone(self.queue.get(timeout=0.05))
+
+    def test_a_job_is_claimed_once(self):
+        self.queue.put(new_job({}))
+        self.assertIsNotNone(self.queue.get(timeout=0.1))
+        self.assertIsNone(self.queue.get(timeout=0.05))
+
+    def test_update_and_status(self):
+        job = new_job({'img_name': 'a.jpg'})
+        self.queue.put(job)
+        self.assertEqual(self.queue.status(job['job_id'])['status'], QUEUED)
+        self.queue.update(job['job_id'], status=DONE, result={'labels': []})
+        status = self.queue.status(job['job_id'])
+        self.assertEqual(status['status'], DONE)
+        self.assertEqual(status['payload'], {'img_name': 'a.jpg'})
+        self.assertIsNone(self.queue.status('missing'))
+
+
+class TestInProcessJobQueue(JobQueueTests, unittest.TestCase):
+    def make_queue(self):
+        return InProcessJobQueue()
+
+    def test_old_statuses_are_forgotten(self):
+        queue = InProcessJobQueue(max_jobs=2)
+        jobs = [new_job({}) for _ in range(3)]
+        for job in jobs:
+            queue.put(job)
+        self.assertIsNone(queue.status(jobs[0]['job_id']))
+        self.assertIsNotNone(queue.status(jobs[2]['job_id']))
+
+
+class TestMongoJobQueue(JobQueueTests, unittest.TestCase):
+    def make_queue(self):
+        self.collection = mongomock.MongoClient().db.jobs
+        return MongoJobQueue(self.collection, poll_interval=0.01, lease=60, max_attempts=2)
+
+    def abandon(self, job_id):
+        # As if the worker running the job died a lease ago
+        self.collection.update_one({'_id': job_id}, {'$inc': {'started': -61}})
+
+    def test_running_job_is_reclaimed_after_the_lease(self):
+        job = new_job({})
+        self.queue.put(job)
+        self.assertEqual(self.queue.get(timeout=0.1)['attempts'], 1)
+        self.assertIsNone(self.queue.get(timeout=0.05))
+
+        self.abandon(job['job_id'])
+        reclaimed = self.queue.get(timeout=0.1)
+        self.assertEqual(reclaimed['job_id'], job['job_id'])
+        self.assertEqual(reclaimed['attempts'], 2)
+
+    def test_finished_job_is_not_reclaimed(self):
+        job = new_job({})
+        self.queue.put(job)
+        self.queue.get(timeout=0.1)
+        self.queue.update(job['job_id'], status=DONE)
+        self.abandon(job['job_id'])
+        self.assertIsNone(self.queue.get(timeout=0.05))
+
+    def test_job_abandoned_too_often_fails(self):
+        job = new_job({})
+        self.queue.put(job)
+        for _ in range(2):
+            self.queue.get(timeout=0.1)
+            self.abandon(job['job_id'])
+        self.assertIsNone(self.queue.get(timeout=0.05))
+        status = self.queue.status(job['job_id'])
+        self.assertEqual(status['status'], FAILED)
+        self.assertIn('abandoned', status['error'])
+
+
+class TestJobRunner(unittest.TestCase):
+    def setUp(self):
+        self.queue = InProcessJobQueue()
+        self.http = Mock()
+
+    def run_job(self, handler, callback_url=None):
+        runner = JobRunner(self.queue, handler, workers=1, http=self.http, timeout=3)
+        job = runner.submit({'img_name': 'a.jpg'}, callback_url)
+        wait_for(lambda: self.queue.status(job['job_id'])['status'] in (DONE, FAILED))
+        return self.queue.status(job['job_id'])
+
+    def test_result_is_stored(self):
+        status = self.run_job(lambda payload: ({'img': payload['img_name']}, 200))
+        self.assertEqual(status['status'], DONE)
+        self.assertEqual(status['result'], {'img': 'a.jpg'})
+        self.assertEqual(status['http_status'], 200)
+        self.http.post.assert_not_called()
+
+    def test_handler_error_fails_the_job(self):
+        status = self.run_job(Mock(side_effect=RuntimeError('boom')))
+        self.assertEqual(status['status'], FAILED)
+        self.assertEqual(status['error'], 'boom')
+
+    def test_callback_gets_the_outcome(self):
+        status = self.run_job(lambda payload: ({'labels': []}, 200), callback_url='http://bot/callback')
+        wait_for(lambda: self.http.post.called)
+        url, = self.http.post.call_args.args
+        body = self.http.post.call_args.kwargs['json']
+        self.assertEqual(url, 'http://bot/callback')
+        self.assertEqual(body['job_id'], status['job_id'])
+        self.assertEqual(body['status'], DONE)
+        self.assertEqual(body['result'], {'labels': []})
+        self.assertEqual(self.http.post.call_args.kwargs['timeout'], 3)
+
+    def test_failed_callback_keeps_the_runner_going(self):
+        self.http.post.side_effect = requests.exceptions.ConnectionError()
+        self.run_job(lambda payload: ({}, 200), callback_url='http://bot/callback')
+        wait_for(lambda: self.http.post.called)
+        self.assertEqual(self.run_job(lambda payload: ({}, 200))['status'], DONE)
+
+
+if __name__ == '__main__':
+    unittest.main()
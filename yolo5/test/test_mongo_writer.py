@@ -0,0 +1,44 @@
+import time
+import unittest
+
+import mongomock
+
+from mongo_writer import BulkWriter
+
+
+class TestBulkWriter(unittest.TestCase):
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.predictions
+
+    def wait_for_count(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.collection.count_documents({}) < count:
+            if time.monotonic() > deadline:
+                raise AssertionError(f'{self.collection.count_documents({})} documents, expected {count}')
+            time.sleep(0.01)
+
+    def test_flushes_a_full_batch_right_away(self):
+        writer = BulkWriter(self.collection, max_batch=3, flush_interval=60)
+        self.addCleanup(writer.close)
+        for i in range(3):
+            writer.write({'prediction_id': str(i)})
+        self.wait_for_count(3)
+
+    def test_flushes_after_the_interval(self):
+        writer = BulkWriter(self.collection, max_batch=100, flush_interval=0.05)
+        self.addCleanup(writer.close)
+        writer.write({'prediction_id': '1'})
+        self.wait_for_count(1)
+
+    def test_close_flushes_the_rest(self):
+        writer = BulkWriter(self.collection, max_batch=100, flush_interval=60)
+        writer.write({'prediction_id': '1'})
+        writer.write({'prediction_id': '2'})
+        writer.close()
+        self.assertEqual(self.collection.count_documents({}), 2)
+        with self.assertRaises(RuntimeError):
+            writer.write({'prediction_id': '3'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import mongomock
+
+from pred_cache import PredictionCache, image_hash
+
+
+class TestPredictionCache(unittest.TestCase):
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.predictions
+        self.cache = PredictionCache(self.collection, 'yolov5s.pt:abc', max_entries=2)
+        self.img_hash = image_hash(b'image')
+
+    def store(self, model_version, prediction_id='p1'):
+        summary = {'prediction_id': prediction_id, 'image_hash': self.img_hash, 'model_version': model_version,
+                   'labels': [], 'time': 1.0}
+        self.collection.insert_one(dict(summary))
+        return summary
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(self.img_hash))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_memory_hit(self):
+        self.cache.put(self.img_hash, {'prediction_id': 'p1'})
+        self.assertEqual(self.cache.get(self.img_hash)['prediction_id'], 'p1')
+        self.assertEqual(self.cache.stats()['memory_hits'], 1)
+
+    def test_mongo_hit_of_the_same_model_only(self):
+        self.store('yolov5s.pt:old', 'p0')
+        self.assertIsNone(self.cache.get(self.img_hash))
+        self.store('yolov5s.pt:abc', 'p1')
+        summary = self.cache.get(self.img_hash)
+        self.assertEqual(summary['prediction_id'], 'p1')
+        self.assertNotIn('_id', summary)
+        self.assertEqual(self.cache.stats()['mongo_hits'], 1)
+
+    def test_invalidate_keeps_the_mongo_tier(self):
+        self.store('yolov5s.pt:abc', 'p1')
+        self.cache.get(self.img_hash)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.stats()['memory_entries'], 0)
+        self.assertEqual(self.cache.get(self.img_hash)['prediction_id'], 'p1')
+        self.assertEqual(self.cache.stats()['mongo_hits'], 2)
+
+    def test_invalidation_reaches_the_other_processes(self):
+        state = mongomock.MongoClient().db.cache_state
+        cache = PredictionCache(self.collection, 'yolov5s.pt:abc', state=state, sync_interval=0)
+        other = PredictionCache(self.collection, 'yolov5s.pt:abc', state=state, sync_interval=0)
+        other.put(self.img_hash, {'prediction_id': 'p1'})
+
+        cache.invalidate()
+        self.assertEqual(cache.generation, 1)
+        self.assertIsNone(other.get(self.img_hash))
+        self.assertEqual(other.generation, 1)
+
+    def test_invalidation_is_seen_after_the_sync_interval(self):
+        state = mongomock.MongoClient().db.cache_state
+        cache = PredictionCache(self.collection, 'yolov5s.pt:abc', state=state)
+        other = PredictionCache(self.collection, 'yolov5s.pt:abc', state=state, sync_interval=3600)
+        other.put(self.img_hash, {'prediction_id': 'p1'})
+
+        cache.invalidate()
+        self.assertIsNotNone(other.get(self.img_hash))
+        other._synced_at -= 3600
+        self.assertIsNone(other.get(self.img_hash))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import cv2
+
+
+def sample_frames(path, sample_fps=2.0, max_frames=120):
+    """
+    Decodes a video or an animated GIF as a stream and yields the sampled frames, one at a time: only the frame
+    being yielded is ever in memory. The frames in between are skipped with `grab`, without being decoded to
+    images.
+
+    :param sample_fps: frames per second of video kept, every frame if the video has fewer
+    :param max_frames: number of sampled frames after which the rest of the video is ignored
+    :return: generator of (frame index, timestamp in seconds, HWC BGR frame)
+    """
+    capture = cv2.VideoCapture(str(path))
+    if not capture.isOpened():
+        raise ValueError(f'{path}: not a video or an animation OpenCV can decode')
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0
+        step = max(1, round(fps / sample_fps)) if fps > 0 else 1
+        index = sampled = 0
+        while sampled < max_frames:
+            if index % step:
+                if not capture.grab():
+                    break
+            else:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                sampled += 1
+                yield index, index / fps if fps > 0 else None, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def batched(frames, size):
+    """Groups an iterable in lists of at most `size` items, without consuming it ahead of the current batch"""
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class FrameCounts:
+    """
+    Per-class object counts aggregated across the sampled frames of a video. The same object shows up in many
+    frames, so the count that says how many there are is the most seen in a single frame (`max_per_frame`).
+    """
+
+    def __init__(self, names):
+        """:param names: class index -> class name, as in the model's labels"""
+        self.names = names
+        self.frames = 0
+        self.classes = {}  # class name -> dict of the counts
+
+    def add(self, det):
+        """:param det: detections of one frame, (n, 6) as xyxy, conf, cls"""
+        self.frames += 1
+        in_frame = {}
+        for *_, conf, cls in det.tolist():
+            name = self.names[int(cls)]
+            counts = in_frame.setdefault(name, {'count': 0, 'confidence': 0.0})
+            counts['count'] += 1
+            counts['confidence'] += conf
+        for name, counts in in_frame.items():
+            total = self.classes.setdefault(name, {'class': name, 'max_per_frame': 0, 'frames': 0, 'detections': 0,
+                                                   'confidence_sum': 0.0})
+            total['max_per_frame'] = max(total['max_per_frame'], counts['count'])
+            total['frames'] += 1
+            total['detections'] += counts['count']
+            total['confidence_sum'] += counts['confidence']
+
+    def summary(self):
+        """:return: the classes seen, the most frequent first"""
+        rows = []
+        for total in self.classes.values():
+            row = {key: value for key, value in total.items() if key != 'confidence_sum'}
+            row['avg_confidence'] = total['confidence_sum'] / total['detections']
+            rows.append(row)
+        return sorted(rows, key=lambda row: (-row['max_per_frame'], -row['frames'], row['class']))